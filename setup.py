@@ -27,6 +27,7 @@ setup(
     platforms = "any",
     url = "http://sourceforge.net/projects/tappy, http://gitlab.em.pml.ac.uk/pica/PyFVCOM, https://github.com/pwcazenave/tappy",
     packages=['tappy', 'tappy.tappy_lib'],
+    package_data={'tappy.tappy_lib': ['parameter_database.json']},
     long_description=read('README.md'),
     classifiers=classifiers
 )
@@ -43,21 +43,90 @@ EXAMPLES:
 from __future__ import print_function
 
 import os
+import re
 import sys
+import copy
 import datetime
+import hashlib
+import json
 import operator
+import itertools
+from collections import OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 import tappy_lib
 
-import baker
-
 import numpy as np
 
-import astronomia.calendar as cal
+# scipy.optimize, pyparsing (through sparser), baker, and astronomia are
+# slow to import and are only imported where they are needed, so that
+# prediction from a fresh interpreter doesn't pay for them.
+
+def parameter_database_files():
+    """
+    Returns the file names of parameter_database.py and its compact JSON
+    form written by write_parameter_database.
+    """
+
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'tappy_lib')
+    return (os.path.join(directory, 'parameter_database.py'),
+            os.path.join(directory, 'parameter_database.json'))
+
+
+def source_digest(filename):
+    """
+    Returns the SHA1 of the contents of filename.
+    """
+
+    fpi = open(filename, 'rb')
+    digest = hashlib.sha1(fpi.read()).hexdigest()
+    fpi.close()
+    return digest
+
+
+def load_parameter_database():
+    """
+    Returns _master_speed_dict and letter_to_factor_map from the compact
+    JSON form of parameter_database, which loads much faster than
+    compiling the module, or from parameter_database itself if the JSON is
+    missing or was written from a different parameter_database.py.
+    """
+
+    (source, compact) = parameter_database_files()
+    try:
+        fpi = open(compact)
+        database = json.load(fpi)
+        fpi.close()
+        if (not os.path.exists(source) or
+                database['source'] == source_digest(source)):
+            return (database['_master_speed_dict'],
+                    database['letter_to_factor_map'])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    from tappy_lib.parameter_database import _master_speed_dict, letter_to_factor_map
+    return _master_speed_dict, letter_to_factor_map
+
+
+def write_parameter_database():
+    """
+    Writes the compact JSON form of parameter_database read by
+    load_parameter_database.
+    """
+
+    from tappy_lib.parameter_database import _master_speed_dict, letter_to_factor_map
+    (source, compact) = parameter_database_files()
+    fpo = open(compact, 'w')
+    json.dump({'source': source_digest(source),
+               '_master_speed_dict': _master_speed_dict,
+               'letter_to_factor_map': letter_to_factor_map},
+              fpo, sort_keys=True, separators=(',', ':'))
+    fpo.close()
+
 
-from scipy.optimize import leastsq
-from numpy import pad
-from tappy_lib.parameter_database import _master_speed_dict, letter_to_factor_map
-from tappy_lib import sparser
+(_master_speed_dict, letter_to_factor_map) = load_parameter_database()
 
 # ===globals======================
 modname = "tappy"
@@ -185,67 +254,833 @@ def node_factor_235(ii, nu):
             0.0981)**0.5  # eq 235 schureman
 
 
+def polynomial(coefficients, t):
+    """
+    Evaluates coefficients[0] + coefficients[1]*t + ... by Horner's rule.
+    """
+    result = np.zeros_like(t) + coefficients[-1]
+    for c in coefficients[-2::-1]:
+        result = result * t + c
+    return result
+
+
+def mean_longitudes(jd):
+    """
+    Calculates the mean longitudes needed by Util.astronomic for an array of
+    Julian days, with the same polynomials used by astronomia.
+
+    Parameters
+    ----------
+    jd : ndarray
+        Julian days.
+
+    Returns
+    -------
+    Nv, p, s, h, p1 : ndarray
+        Longitude of the Moon's ascending node, the lunar perigee, the Moon,
+        the Sun and the solar perigee, in radians between 0 and 2*pi.
+
+    """
+
+    jd = np.asarray(jd, dtype=np.float64)
+    # Julian centuries from J2000.0
+    T = (jd - 2451545.0) / 36525.0
+
+    # Meeus, Astronomical Algorithms, 2nd ed., 47.1, 47.7 and 47.8.  The
+    # T**4 term of the node has the opposite sign in astronomia, which is
+    # about 1e-7 radians at the ends of 1600 to 2100.
+    s = polynomial((218.3164477, 481267.88123421, -0.0015786,
+                    1.0/538841, -1.0/65194000), T)
+    Nv = polynomial((125.0445479, -1934.1362891, 0.0020754,
+                     1.0/467441, -1.0/60616000), T)
+    p = polynomial((83.3532465, 4069.0137287, -0.0103200,
+                    -1.0/80053, 1.0/18999000), T)
+    # Meeus 32.2, in Julian millennia
+    h = polynomial((280.4664567, 360007.6982779, 0.03032028,
+                    1.0/49931, -1.0/15300, -1.0/2000000), T/10.0)
+    # Schureman, table 1, in Julian centuries from 1900
+    p1 = polynomial((1012395.0, 6189.03, 1.63, 0.012), T + 1.0)/3600.0
+
+    return tuple(np.mod(np.deg2rad(i), 2*np.pi) for i in (Nv, p, s, h, p1))
+
+
+def datetime64_dates(dates):
+    """
+    Returns datetime.datetime or numpy.datetime64 dates as a
+    numpy.datetime64 array to the whole second.
+    """
+
+    return np.asarray(dates).astype('datetime64[s]')
+
+
+def datetime_dates(dates):
+    """
+    Returns numpy.datetime64 dates as an array of datetime.datetime for
+    output.  Other dates are returned as they are.
+    """
+
+    dates = np.asarray(dates)
+    if np.issubdtype(dates.dtype, np.datetime64):
+        return dates.astype('datetime64[s]').astype(object)
+    return dates
+
+
+def time_grid(start_date, end_date, interval):
+    """
+    Returns the numpy.datetime64 start and step, and the number of dates,
+    of a time axis every interval minutes from start_date up to a minute
+    past end_date.
+    """
+
+    start = np.datetime64(start_date, 's')
+    step = np.timedelta64(int(round(interval * 60)), 's')
+    last = np.datetime64(end_date, 's') + np.timedelta64(60, 's')
+    length = -((start - last) // step)
+    return start, step, max(int(length), 1)
+
+
+def interpolate_angle(x, xp, fp):
+    """
+    Linearly interpolates angles fp in radians at xp onto x, unwrapping
+    through 2*pi.  The result is between 0 and 2*pi.
+    """
+
+    return np.mod(np.interp(x, xp, np.unwrap(fp)), 2 * np.pi)
+
+
+class NodeGrid:
+    """
+    Linear interpolation from the dates cjd of a coarse grid, picked by
+    node_index or the rows of a NodeTable, to every date in jd.  Every date
+    is interpolated from the grid point at or before it, so the grid is
+    only searched once.
+    """
+
+    def __init__(self, jd, cjd):
+        position = np.clip(np.searchsorted(cjd, jd, side='right') - 1,
+                           0, len(cjd) - 2)
+        self.counts = np.bincount(position, minlength=len(cjd) - 1)
+        self.step = np.diff(cjd)
+        self.dt = jd - np.repeat(cjd[:-1], self.counts)
+
+    def __call__(self, values, period=None):
+        """
+        Returns values on the grid interpolated to every date.  Angles that
+        repeat every period are unwrapped first and returned between 0 and
+        period.
+        """
+
+        if period is not None:
+            values = np.unwrap(values, period=period)
+        result = np.repeat(values[:-1], self.counts)
+        result += np.repeat(np.diff(values) / self.step, self.counts) * self.dt
+        if period is not None:
+            result = np.mod(result, period)
+        return result
+
+
+# The extended Doodson numbers of the constituents in parameter_database as
+# an integer matrix, one row per constituent in the order of doodson_keys.
+# A few use letters that are not in letter_to_factor_map and are left out.
+doodson_keys = sorted(key for key in _master_speed_dict
+                      if set(_master_speed_dict[key]['edn']) <=
+                      set(letter_to_factor_map))
+doodson_index = dict((key, i) for i, key in enumerate(doodson_keys))
+doodson_matrix = np.array([[letter_to_factor_map[i]
+                            for i in _master_speed_dict[key]['edn']]
+                           for key in doodson_keys], dtype=int)
+
+
+# The constituents that the letters in the names of compound constituents
+# stand for.  Where a letter stands for more than one the extended Doodson
+# number decides.
+compound_letters = {
+    'M': ['M2'], 'S': ['S2', 'S1'], 'K': ['K1', 'K2'], 'N': ['N2'],
+    'O': ['O1'], 'L': ['L2'], 'Q': ['Q1'], 'P': ['P1'], 'T': ['T2'],
+    'R': ['R2'], 'J': ['J1'], 'nu': ['nu2'], 'mu': ['mu2'],
+    'lambda': ['lambda2'],
+}
+
+_node_components = {}
+
+
+def compound_components(key):
+    """
+    Returns the (constituent, multiple) pairs that compound constituent key
+    is made of, or None if its name can't be read as one.
+
+    The letters of the name are given the signs, and S and K the species,
+    that add up to the extended Doodson number of key, leaving out the
+    phase column, so '2MS2K2' is 2*M2 + S2 - 2*K2 and 'M10' is 5*M2.
+    """
+
+    tokens = re.findall(r'\d+|\(|\)|nu|mu|lambda|[A-Z]', key)
+    if ''.join(tokens) != key or not tokens[-1].isdigit():
+        return None
+    letters = []
+    multiple = 1
+    group = 1
+    for token in tokens[:-1]:
+        if token.isdigit():
+            multiple = int(token)
+        elif token == '(':
+            (group, multiple) = (multiple, 1)
+        elif token == ')':
+            group = 1
+        elif token in compound_letters:
+            letters.append((token, multiple * group))
+            multiple = 1
+        else:
+            return None
+    if not letters:
+        return None
+
+    row = doodson_matrix[doodson_index[key]][:6]
+    if len(letters) == 1:
+        # An overtide, the multiple comes from the species
+        for name in compound_letters[letters[0][0]]:
+            n = int(row[0] // doodson_matrix[doodson_index[name]][0])
+            if np.array_equal(row, n * doodson_matrix[doodson_index[name]][:6]):
+                return [(name, n)]
+        return None
+    choices = [[(name, sign * n) for name in compound_letters[letter]
+                for sign in (1, -1)] for (letter, n) in letters]
+    for components in itertools.product(*choices):
+        total = sum(n * doodson_matrix[doodson_index[name]][:6]
+                    for (name, n) in components)
+        if np.array_equal(total, row):
+            return list(components)
+    return None
+
+
+def node_components(key, explicit):
+    """
+    Returns the (constituent, multiple) pairs of constituents in explicit
+    whose node factors make up those of key.
+
+    A compound constituent is made of the constituents compound_components
+    finds.  Any other takes the node factors of the constituent in
+    explicit of the same species and group that is nearest in the rest of
+    the Doodson number, as a satellite does.  The list is empty if there
+    is none.
+    """
+
+    if key not in _node_components:
+        components = compound_components(key)
+        if components is None:
+            row = doodson_matrix[doodson_index[key]]
+            near = []
+            for name in explicit:
+                diff = np.abs(doodson_matrix[doodson_index[name]] - row)
+                if not diff[:2].any():
+                    near.append((diff[2], diff[3:6].sum(), name))
+            components = [(min(near)[2], 1)] if near else []
+        _node_components[key] = components
+    return _node_components[key]
+
+
+# The constituents which_constituents includes and the record length in
+# hours, times rayleigh_comp, needed to separate each from its neighbours
+# by the Rayleigh criterion, from Foreman.  The order is also the priority
+# of these constituents in auto_constituents.
+rayleigh_tiers = [
+    (0, ['M2']),
+    (24, ['K1']),
+    (25, ['M3', 'M4']),
+    (26, ['M6', 'M8']),
+    (235, ['S6']),
+    (328, ['O1']),
+    # Might need to move 2SM2 to another time span - couldn't find this in
+    # Foreman for Rayleigh comparison pair.
+    (355, ['S2', '2MS6', '2SM6', 'MSf', 'SK3', '2SM2', 'MS4', 'S4']),
+    (651, ['OO1']),
+    # Seems like 2MK3 in Schureman is equivalent to MO3 in Foreman
+    (656, ['MK3', 'MO3']),
+    # Seems like KJ2 in Schureman is equivalent to eta2 in Foreman and KQ1
+    # to ups1.
+    (662, ['N2', '2MN6', '2Q1', 'Q1', 'J1', 'eta2', 'ups1', 'NO1', 'MN4']),
+    # Need: ALPHA1
+    (764, ['Mm', 'L2', 'mu2', 'MNS2', 'SN4']),
+    # Seems like A54 in Schureman is equivalent to MKS2 in Foreman.  Can't
+    # find beta1 (A19 in Schureman) in eXtended Doodson numbers.
+    # Need MSN3, SK4, 2MK6, MSK6
+    (4383, ['Ssa', 'Mf', 'P1', 'K2', 'SO3', 'phi1', 'SO1', 'MKS2', 'MP1',
+            'MK4', 'MSN2']),
+    # Seems like A4 in Schureman is equivalent to MSm in Foreman
+    (4942, ['2N2', 'nu2', 'MSm', 'nuJ1', 'rho1', 'chi1', 'theta1',
+            'lambda2']),
+    (8766, ['Sa']),
+    (8767, ['S1', 'T2', 'R2', 'pi1', 'psi1']),
+    # GAM2 from Foreman should go at 11326 hours, but couldn't find
+    # comparable constituent information from Schureman.
+    # This is what is required to separate NO1 and M1
+    (77554, ['M1']),
+]
+
+
+# Increase whenever tidal_table changes so that node tables written by
+# earlier versions are not used.
+node_table_version = 4
+node_table_magic = b'TAPPY node table\n'
+
+
+def parameter_digest():
+    """
+    Returns a digest of the constituent definitions in parameter_database,
+    so that node tables are not used after they change.
+    """
+
+    text = json.dumps([_master_speed_dict, letter_to_factor_map],
+                      sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def node_table_header(keys, start, interval, length, ephemeris_backend):
+    """
+    Returns the header of a node table, the magic line followed by a line
+    of JSON that describes the data after it.
+    """
+
+    header = {'version': node_table_version,
+              'parameters': parameter_digest(),
+              'ephemeris_backend': ephemeris_backend,
+              'start': start,
+              'interval': interval,
+              'length': length,
+              'fields': NodeTable.fields,
+              'keys': keys}
+    return node_table_magic + (json.dumps(header) + '\n').encode('utf-8')
+
+
+class NodeTable:
+    """
+    Memory mapped table written by Util.write_node_table of the node factor
+    (FF), V, V + u without the hour angle T (VAU), speed, and the multiple of
+    T in V + u (T) of every constituent at evenly spaced Julian days.  The
+    data is float64 with shape (length, fields, keys) so the rows covering a
+    record are read together.
+    """
+
+    fields = ['FF', 'V', 'VAU', 'speed', 'T']
+
+    def __init__(self, filename):
+        fpi = open(filename, 'rb')
+        magic = fpi.readline()
+        line = fpi.readline()
+        fpi.close()
+        if magic != node_table_magic:
+            raise ValueError('{0} is not a node table'.format(filename))
+        self.header = json.loads(line.decode('utf-8'))
+        self.current = (self.header['version'] == node_table_version and
+                        self.header['parameters'] == parameter_digest() and
+                        self.header['fields'] == self.fields)
+        self.keys = self.header['keys']
+        self.ephemeris_backend = self.header['ephemeris_backend']
+        self.start = self.header['start']
+        self.interval = self.header['interval']
+        self.length = self.header['length']
+        self.data = np.memmap(filename, dtype='<f8', mode='r',
+                              offset=len(magic) + len(line),
+                              shape=(self.length, len(self.fields),
+                                     len(self.keys)))
+
+    def covers(self, jd):
+        """
+        True if the table is current and covers all of jd.
+        """
+
+        end = self.start + self.interval * (self.length - 1)
+        return self.current and jd[0] >= self.start and jd[-1] <= end
+
+    def rows(self, jd):
+        """
+        Returns the first and one past the last of the rows around jd, at
+        least two of them.
+        """
+
+        position = (np.asarray(jd) - self.start) / self.interval
+        first = min(int(np.floor(position[0])), self.length - 2)
+        last = min(max(int(np.floor(position[-1])) + 2, first + 2),
+                   self.length)
+        return first, last
+
+    def dates(self, first, last):
+        """
+        Returns the Julian days of rows first to last.
+        """
+
+        return self.start + self.interval * np.arange(first, last)
+
+    def tidal_dict(self, jd, first, last, grid):
+        """
+        Returns a tidal dictionary like Util.tidal_table for jd from rows
+        first to last, with FF interpolated to every date by grid, a
+        NodeGrid from the dates of the rows.  V and VAU at jd[0] are
+        continued from the row before it at its speed, with what that
+        leaves to the next row interpolated.  Each constituent is read from
+        the table the first time it is looked up.
+        """
+
+        columns = dict((key, i) for i, key in enumerate(self.keys))
+        position = (jd[0] - self.start) / self.interval
+        row = min(int(np.floor(position)), last - 2)
+        fraction = position - row
+        hours = self.interval * 24
+
+        def advance(angle, rate):
+            # angle at fraction of the way from the row to the next
+            rest = np.mod(angle[1] - angle[0] - rate * hours + 180, 360) - 180
+            return np.mod(angle[0] + fraction * (rate * hours + rest), 360)
+
+        # T as in Util.node_arguments
+        T = 360. * (jd[0] - 2400000.5)
+
+        def build(key):
+            # Only this constituent's column of the rows is read.
+            data = np.array(self.data[first:last, :, columns[key]])
+            (V, VAU, speed, multiple) = data[row - first:row - first + 2, 1:].T
+            # V and VAU leave out the hour angle of the mean sun.
+            rate = speed[0] * rad2deg - 15.0 * doodson_matrix[
+                doodson_index[key]][0]
+            return {'FF': grid(data[:, 0]),
+                    'V': advance(V, rate),
+                    'VAU': np.mod(advance(VAU, rate) + multiple[0] * T, 360),
+                    'speed': speed[0] + fraction * (speed[1] - speed[0])}
+
+        return LazyDict(build, self.keys, sources=(grid.dt, ))
+
+
+# NodeTable for each file name and ephemeris backend, opened once.
+node_tables = {}
+
+
+def open_node_table(filename, ephemeris_backend):
+    """
+    Returns the NodeTable for filename, or None if it was written by
+    another version of TAPPY, for other constituent definitions, or from
+    another ephemeris_backend than the one asked for.
+    """
+
+    if (filename, ephemeris_backend) not in node_tables:
+        table = NodeTable(filename)
+        if not table.current:
+            print("{0} is out of date, rebuild it with build_node_table".format(filename))
+            table = None
+        elif table.ephemeris_backend != ephemeris_backend:
+            print("{0} was built with ephemeris_backend {1}, not {2}, so the node factors are calculated instead".format(
+                filename, table.ephemeris_backend, ephemeris_backend))
+            table = None
+        node_tables[(filename, ephemeris_backend)] = table
+    return node_tables[(filename, ephemeris_backend)]
+
+
+# Inferred constituents, used when the major constituents they are inferred
+# from can be resolved, but they can't.  Each entry is
+#   (name, amplitude reference, amplitude ratio, phase a, phase b, k)
+# where amplitude = ratio * H[amplitude reference]
+# and   phase = phase[a] + k * (phase[a] - phase[b])
+inference_table = [
+    ('J1', 'O1', 0.079, 'K1', 'O1', 0.496),
+    ('M1', 'O1', 0.071, 'K1', 'O1', -0.5),
+    ('OO1', 'O1', 0.043, 'K1', 'O1', 1.0),
+    ('P1', 'K1', 0.331, 'K1', 'O1', -0.075),
+    ('Q1', 'O1', 0.194, 'K1', 'O1', -1.496),
+    ('2Q1', 'O1', 0.026, 'K1', 'O1', -1.992),
+    ('rho1', 'O1', 0.038, 'K1', 'O1', -1.429),
+    ('K2', 'S2', 0.272, 'S2', 'M2', 0.081),
+    ('L2', 'M2', 0.028, 'S2', 'M2', -0.464),
+    ('N2', 'M2', 0.194, 'S2', 'M2', -1.536),
+    ('2N2', 'M2', 0.026, 'S2', 'M2', -2.072),
+    ('R2', 'S2', 0.008, 'S2', 'M2', 0.040),
+    ('T2', 'S2', 0.059, 'S2', 'M2', -0.040),
+    ('lambda2', 'M2', 0.007, 'S2', 'M2', -0.536),
+    ('mu2', 'M2', 0.024, 'S2', 'M2', -2.0),
+    ('nu2', 'M2', 0.038, 'S2', 'M2', -1.464),
+]
+
+
+class LazyDict(MutableMapping):
+    """
+    Dictionary with the keys of keys where the value for a key is made by
+    build(key) the first time it is looked up.  sources are the containers
+    that build uses, so that entry_nbytes can count them.
+    """
+
+    def __init__(self, build, keys, sources=()):
+        self.build = build
+        self.keys_ = list(keys)
+        self.built = {}
+        self.sources = tuple(sources)
+
+    def __getitem__(self, key):
+        try:
+            return self.built[key]
+        except KeyError:
+            if key not in self.keys_:
+                raise
+        self.built[key] = self.build(key)
+        return self.built[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.keys_:
+            self.keys_.append(key)
+        self.built[key] = value
+
+    def __delitem__(self, key):
+        self.keys_.remove(key)
+        self.built.pop(key, None)
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def __contains__(self, key):
+        return key in self.keys_
+
+
+class ConstituentTable:
+    """
+    The constituents names from a tidal dictionary as arrays, the speed, V,
+    and VAU vectors and the node factor matrix FF with one row per
+    constituent.  index maps each name to its row.  The rows of FF are ones
+    where the node factors are not length long, as for the short term
+    harmonic analysis.
+    """
+
+    def __init__(self, tidal_dict, names, length):
+        self.names = list(names)
+        self.index = dict((key, i) for i, key in enumerate(self.names))
+        entries = [tidal_dict[key] for key in self.names]
+        self.speed = np.array([entry['speed'] for entry in entries],
+                              dtype=np.float64)
+        self.V = np.array([entry['V'] for entry in entries], dtype=np.float64)
+        self.VAU = np.array([entry['VAU'] for entry in entries],
+                            dtype=np.float64)
+        self.FF = np.ones((len(entries), length))
+        for row, entry in zip(self.FF, entries):
+            ff = np.squeeze(entry['FF'])
+            if np.ndim(ff) == 1 and len(ff) == length:
+                row[:] = ff
+
+    def head(self, names):
+        """
+        Returns the table of names, which are the first of self.names, with
+        arrays that are views of this table's.
+        """
+
+        count = len(names)
+        table = copy.copy(self)
+        table.names = self.names[:count]
+        table.index = dict((key, i) for i, key in enumerate(table.names))
+        table.speed = self.speed[:count]
+        table.V = self.V[:count]
+        table.VAU = self.VAU[:count]
+        table.FF = self.FF[:count]
+        return table
+
+    def __getitem__(self, key):
+        i = self.index[key]
+        return {'speed': self.speed[i],
+                'V': self.V[i],
+                'VAU': self.VAU[i],
+                'FF': self.FF[i]}
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
 # ====================================
 class Util:
+    # Where astronomic gets the mean longitudes from, either the astronomia
+    # package or mean_longitudes.
+    ephemeris_backend = 'astronomia'
+    # If set, astronomic and tidal_table evaluate the ephemeris and node
+    # factors about every node_interval hours and interpolate in between,
+    # see node_index.
+    node_interval = 0
+    node_tolerance = 1.0e-6
+    node_index_key = None
+    node_index_value = None
+    node_index_grid = None
+    node_index_package = None
+    node_index_table = None
+    node_table_key = None
+    node_table_value = None
+    # File name of a table written by write_node_table to read the node
+    # factors and equilibrium arguments from.
+    node_table = None
+    # Either 'standard' for the constituents in rayleigh_tiers or 'auto' for
+    # auto_constituents.
+    selection = 'standard'
+
     def __init__(self, r, phase):
         self.r = r
         self.phase = phase
 
-    def sum_signals(self, skey_list, hours, speed_dict, amp=None, phase=None):
-        fpss = open('/tmp/ss.log', 'w')
-        fpss.write('{0}'.format(hours.shape))
-        total = np.zeros(len(hours), dtype='f')
-        if isinstance(hours[0], datetime.datetime):
+    def sum_signals(self, skey_list, hours, speed_dict, amp=None, phase=None,
+                    dtype=np.float64, out=None, method='direct'):
+        """
+        Returns the sum of the constituents in skey_list at hours, or at
+        dates, as R * FF * cos(speed * hours - (phase - VAU)) with R and
+        phase from self.r and self.phase and the rest from speed_dict.  All
+        constituents are summed at once as a matrix-vector product over
+        blocks of hours.  If amp or phase are given, their deviations from
+        their average are added to R and phase of every constituent.  The
+        sum is calculated in dtype, or written to and returned as out if
+        given.  With method 'recurrence' evenly spaced hours are summed by
+        rotating the phasor of each constituent instead of calculating
+        every cosine, see sum_signals_recurrence.
+        """
+
+        if method not in ['direct', 'recurrence']:
+            print("method must be one of 'direct' (the default) or 'recurrence'")
+            sys.exit()
+
+        hours = np.asarray(hours)
+        if len(hours) and isinstance(hours[0], (datetime.datetime, np.datetime64)):
             hours = self.dates2jd(hours)
             hours = (hours - hours[0]) * 24
-        for i in skey_list:
-            if amp is None:
-                R = self.r[i]
+        hours = np.asarray(hours, dtype=np.float64)
+        if out is None:
+            out = np.empty(len(hours), dtype=dtype)
+        dtype = out.dtype
+        if len(skey_list) == 0:
+            out[:] = 0.0
+            return out
+
+        entries = [speed_dict[i] for i in skey_list]
+        speed = np.array([entry['speed'] for entry in entries],
+                         dtype=np.float64)
+        R = np.array([self.r[i] for i in skey_list], dtype=np.float64)
+        p = np.array([self.phase[i] for i in skey_list], dtype=np.float64)
+        VAU = np.array([entry['VAU'] for entry in entries], dtype=np.float64)
+        lag = (p - VAU) * deg2rad
+        # As in ConstituentTable, node factors that are not as long as
+        # hours are taken as one.
+        FF = []
+        for entry in entries:
+            ff = np.squeeze(entry['FF'])
+            if np.ndim(ff) != 1 or len(ff) != len(hours):
+                ff = None
+            FF.append(ff)
+        if amp is not None:
+            amp = np.asarray(amp) - np.average(amp)
+        if phase is not None:
+            phase = (np.asarray(phase) - np.average(phase)) * deg2rad
+        elif method == 'recurrence' and amp is None and len(hours) > 1:
+            span = hours[-1] - hours[0]
+            step = span / (len(hours) - 1)
+            # The hours of dates are only as exact as the Julian day, about
+            # 1e-8 hours.
+            grid = hours[0] + np.arange(len(hours)) * step
+            if np.max(np.abs(hours - grid)) <= max(1.0e-12 * abs(span), 1.0e-7):
+                return self.sum_signals_recurrence(speed, R, lag, FF, hours,
+                                                   step, out)
+
+        # Keep each block to about 2**22 elements.
+        block = max(1, 2**22 // len(skey_list))
+        for start in range(0, len(hours), block):
+            stop = min(start + block, len(hours))
+            if dtype == np.float64:
+                arg = np.outer(speed, hours[start:stop])
+                if phase is None:
+                    arg -= lag[:, np.newaxis]
+                else:
+                    arg -= lag[:, np.newaxis] + phase[start:stop]
             else:
-                R = (amp - np.average(amp)) + self.r[i]
-            if phase is None:
-                p = self.phase[i]
+                # The arguments are too large for single precision, so they
+                # are reduced to less than a cycle first.
+                arg = np.outer(speed / (2 * np.pi), hours[start:stop])
+                if phase is None:
+                    arg -= lag[:, np.newaxis] / (2 * np.pi)
+                else:
+                    arg -= (lag[:, np.newaxis] + phase[start:stop]) / (2 * np.pi)
+                arg -= np.floor(arg)
+                arg *= 2 * np.pi
+                arg = arg.astype(dtype)
+            signal = np.cos(arg, out=arg)
+            for row, ff in zip(signal, FF):
+                if ff is not None:
+                    row *= ff[start:stop]
+            if amp is None:
+                np.dot(R.astype(dtype), signal, out=out[start:stop])
             else:
-                p = (phase - np.average(phase)) + self.phase[i]
-            component = R*speed_dict[i]['FF']*np.cos(speed_dict[i]['speed']*hours - (p - speed_dict[i]['VAU']) * deg2rad)
-            fpss.write('{0}'.format(speed_dict[i]['FF'].shape))
-            fpss.write('{0}'.format(component.shape))
-            total = total + component
-            fpss.write('{0}'.format(total.shape))
-        return total
+                weight = (R[:, np.newaxis] + amp[start:stop]).astype(dtype)
+                np.sum(weight * signal, axis=0, out=out[start:stop])
+        return out
+
+    def sum_signals_recurrence(self, speed, R, lag, FF, hours, step, out):
+        """
+        The sum of sum_signals for hours that are step apart.  The
+        rotations exp(i * speed * step * j) of every constituent over a
+        block of hours are calculated once, then each block starts from the
+        exact phasors R * exp(i * (speed * hour - lag)) at its first hour
+        and is summed with a matrix-vector product of their real and
+        imaginary parts with the rotations.  Starting every block anew at
+        its own hour keeps the rounding errors from accumulating.
+        """
+
+        dtype = out.dtype
+        # Keep the rotations to about 2**20 elements.
+        block = max(1, min(len(out), 2**20 // len(speed)))
+        angle = np.outer(speed, np.arange(block) * step)
+        real = np.cos(angle).astype(dtype)
+        imag = np.sin(angle).astype(dtype)
+        varying = [ff is not None for ff in FF]
+        for start in range(0, len(out), block):
+            stop = min(start + block, len(out))
+            anchor = speed * hours[start] - lag
+            a = (R * np.cos(anchor)).astype(dtype)
+            b = (R * np.sin(anchor)).astype(dtype)
+            if not any(varying):
+                np.dot(a, real[:, :stop - start], out=out[start:stop])
+                out[start:stop] -= np.dot(b, imag[:, :stop - start])
+                continue
+            signal = real[:, :stop - start] * a[:, np.newaxis]
+            signal -= imag[:, :stop - start] * b[:, np.newaxis]
+            for row, ff in zip(signal, FF):
+                if ff is not None:
+                    row *= ff[start:stop]
+            np.sum(signal, axis=0, out=out[start:stop])
+        return out
+
+    def predict_iter(self, skey_list, start_date, end_date, interval,
+                     chunk=100000, dtype=np.float64, method='direct',
+                     workers=1):
+        """
+        Generator of (dates, heights) arrays of the prediction of the
+        constituents in skey_list, with amplitudes and phases from self.r
+        and self.phase, every interval minutes from start_date to
+        end_date.  Each block has at most chunk dates and its own node
+        factors and V + u, so that memory does not depend on the length of
+        the prediction.  Z0 is added to the heights if it is in skey_list.
+        With more than one worker the blocks are calculated in a pool of
+        processes, a few ahead of the one yielded, and are the same as
+        calculated serially.
+        """
+
+        length = time_grid(start_date, end_date, interval)[2]
+        blocks = [(begin, min(begin + chunk, length))
+                  for begin in range(0, length, chunk)]
+
+        if workers is None or workers > 1:
+            from collections import deque
+            from concurrent.futures import ProcessPoolExecutor
+
+            options = dict((name, getattr(self, name))
+                           for name in prediction_options)
+            with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=prediction_init,
+                    initargs=(self.r, self.phase, options)) as executor:
+                pending = deque()
+                for (begin, end) in blocks:
+                    pending.append(executor.submit(
+                        prediction_block, skey_list, start_date, interval,
+                        begin, end, dtype, method))
+                    if len(pending) > 2 * (workers or os.cpu_count() or 1):
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            return
+
+        for (begin, end) in blocks:
+            yield self.predict_block(skey_list, start_date, interval, begin,
+                                     end, dtype=dtype, method=method)
+
+    def predict_block(self, skey_list, start_date, interval, begin, end,
+                      dtype=np.float64, method='direct'):
+        """
+        Returns the dates and heights from begin up to end intervals after
+        start_date of the prediction of predict_iter.
+        """
+
+        step = np.timedelta64(int(round(interval * 60)), 's')
+        dates = np.datetime64(start_date, 's') + np.arange(begin, end) * step
+        self.dates = dates
+        package = self.astronomic(dates)
+        self.tidal_dict = self.tidal_table(len(dates), package)
+        hours = np.arange(len(dates), dtype=np.float64) * interval / 60.0
+        heights = self.sum_signals([key for key in skey_list if key != 'Z0'],
+                                   hours, self.tidal_dict, dtype=dtype,
+                                   method=method)
+        if 'Z0' in skey_list:
+            heights += self.r['Z0']
+        return dates, heights
+
+    def extrema(self, skey_list, start_date, end_date, interval=60,
+                chunk=100000):
+        """
+        Returns the dates, heights, and whether each is a high water of the
+        high and low waters of the constituents in skey_list from
+        start_date to end_date, see predict_extrema.
+        """
+
+        r = dict((key, self.r[key]) for key in skey_list)
+        options = dict((name, getattr(self, name))
+                       for name in prediction_options)
+        return predict_extrema([(r, self.phase)], start_date, end_date,
+                               interval=interval, chunk=chunk, **options)[0]
 
     def dates2jd(self, dates):
         """
         Given a dates vector will return a vector of Julian days as required
-        by astronomia.
+        by astronomia.  The dates can be datetime.datetime or
+        numpy.datetime64, and are used to the whole second.
+
+        Same arithmetic as astronomia's cal_to_jd + hms_to_fday (Meeus 7.1),
+        but on whole arrays.
         """
 
-        if isinstance(dates[0], datetime.datetime):
-            jd = [cal.cal_to_jd(i.year, i.month, i.day) +
-                  cal.hms_to_fday(i.hour, i.minute, i.second) for i in dates]
-            jd = np.array(jd).flatten()
-        else:
-            jd = dates
-        return jd
-
-    def write_file(self, x, y, fname='-'):
-        fp = open('/tmp/tap.log', 'w')
-        fp.write('{0}'.format(x))
-        fp.write('{0}'.format(y))
-        fp.write('{0}'.format(y.shape))
-        fp.write(fname)
+        dates = np.asarray(dates)
+        if not (np.issubdtype(dates.dtype, np.datetime64) or
+                isinstance(dates.flat[0], (datetime.datetime, np.datetime64))):
+            return dates
+
+        seconds = dates.astype('datetime64[s]')
+        days = seconds.astype('datetime64[D]')
+        months = days.astype('datetime64[M]')
+        yr = days.astype('datetime64[Y]').astype('i8') + 1970
+        mo = months.astype('i8') % 12 + 1
+        day = (days - months).astype('i8') + 1
+        sec = (seconds - days).astype('i8')
+        hr = sec // 3600
+        mn = (sec // 60) % 60
+        sec = sec % 60
+
+        early = mo <= 2
+        yr = np.where(early, yr - 1, yr)
+        mo = np.where(early, mo + 12, mo)
+        A = np.trunc(yr / 100.0)
+        B = 2 - A + np.trunc(A / 4.0)
+        jd = (np.trunc(365.25 * (yr + 4716)) + np.trunc(30.6001 * (mo + 1)) +
+              day + B - 1524.5)
+        jd = jd + ((hr / 24.0) + (mn / 1440.0) + (sec / 86400.0))
+        return jd.flatten()
+
+    def write_file(self, x, y, fname='-', mode='w'):
         if isinstance(y, dict):
             for key in list(y.keys()):
                 nfname = "%s_%s.dat" % (os.path.splitext(fname)[-2], key)
-                self.write_file(x, y[key], fname=nfname)
+                self.write_file(x, y[key], fname=nfname, mode=mode)
         else:
+            x = datetime_dates(x)
             if fname == '-':
                 for d, v in zip(x, y):
                     print("%s %f" % (d.isoformat(), v))
             else:
-                fpo = open(fname, "w")
+                fpo = open(fname, mode)
                 for d, v in zip(x, y):
                     fpo.write("%s %f\n" % (d.isoformat(), v))
+                fpo.close()
 
     def astronomic(self, dates):
         """
@@ -255,18 +1090,59 @@ class Util:
         in the dates vector.
         """
 
-        from astronomia import lunar as elp
-        from astronomia import sun
+        jd = self.dates2jd(dates)
+        coarse = self.node_table_grid(jd)
+        if coarse is not None:
+            # On the dates of the rows of the node table.
+            (table, first, last, grid) = coarse
+            cjd = table.dates(first, last)
+            package = self.node_arguments(cjd, *self.mean_longitudes(cjd))
+        else:
+            index = self.node_index(jd)
+            if index is None:
+                return self.node_arguments(jd, *self.mean_longitudes(jd))
+            # node_index calculated the package on its grid.
+            (package, grid) = (self.node_index_package, self.node_index_grid)
+
+        # Q is between pi/2 and 3*pi/2 and jumps by pi.  T is for the first
+        # date as in node_arguments.
+        (zeta, nu, nup, nupp, kap_p, i, R, Q, T, cjd, s, h, Nv, p, p1) = package
+        T = 360. * (jd[0] - 2400000.5) * deg2rad
+        return (grid(zeta), grid(nu), grid(nup), grid(nupp),
+                grid(kap_p, 2 * np.pi), grid(i), grid(R, 2 * np.pi),
+                grid(Q - 0.5 * np.pi, np.pi) + 0.5 * np.pi, T, jd,
+                grid(s, 2 * np.pi), grid(h, 2 * np.pi), grid(Nv, 2 * np.pi),
+                grid(p, 2 * np.pi), grid(p1, 2 * np.pi))
+
+    def mean_longitudes(self, jd):
+        """
+        Returns the mean longitudes of the Moon's node, the lunar perigee,
+        the Moon, the Sun, and the solar perigee from ephemeris_backend.
+        """
 
-        lunar_eph = elp.Lunar()
-        solar_eph = sun.Sun()
+        if self.ephemeris_backend == 'numpy':
+            return mean_longitudes(jd)
+        elif self.ephemeris_backend == 'astronomia':
+            from astronomia import lunar as elp
+            from astronomia import sun
+
+            lunar_eph = elp.Lunar()
+            solar_eph = sun.Sun()
+
+            Nv = lunar_eph.mean_longitude_ascending_node(jd)
+            p = lunar_eph.mean_longitude_perigee(jd)
+            s = lunar_eph.mean_longitude(jd)
+            h = solar_eph.mean_longitude(jd)
+            p1 = solar_eph.mean_longitude_perigee(jd)
+            return Nv, p, s, h, p1
+        else:
+            print("ephemeris_backend must be one of 'astronomia' (the default) or 'numpy'")
+            sys.exit()
 
-        jd = self.dates2jd(dates)
-        Nv = lunar_eph.mean_longitude_ascending_node(jd)
-        p = lunar_eph.mean_longitude_perigee(jd)
-        s = lunar_eph.mean_longitude(jd)
-        h = solar_eph.mean_longitude(jd)
-        p1 = solar_eph.mean_longitude_perigee(jd)
+    def node_arguments(self, jd, Nv, p, s, h, p1):
+        """
+        Calculates the astronomic package from the mean longitudes.
+        """
 
         # Calculate constants for V+u
         # I, inclination of Moon's orbit, pg 156, Schureman
@@ -309,14 +1185,46 @@ class Util:
         # the larger sized vector when filling missing values.
         return zeta, nu, nup, nupp, kap_p, i, R, Q, T, jd, s, h, Nv, p, p1
 
-    def which_constituents(self, length, package, rayleigh_comp=1.0):
+    def tidal_table(self, length, package, coarse=True, first=True):
         """
-        Establishes which constituents are able to be determined according to
-        the length of the water elevation vector.
+        Returns a dictionary of all of the constituents that TAPPY knows
+        about, with the node factor (FF) as a vector equal in length to the
+        astronomic package and the speed, V, and V + u (VAU) for the first
+        date, or for every date if not first.  Each constituent is
+        calculated the first time it is looked up.  If coarse the dictionary is
+        read from node_table if it covers the dates, otherwise if
+        node_interval is set the node factors are interpolated from the
+        dates picked by node_index.
         """
 
         (zeta, nu, nup, nupp, kap_p, ii, R, Q, T, jd, s, h, Nv, p, p1) = package
-        speed_dict = {}
+
+        if coarse and first and self.node_table:
+            table = self.node_table_grid(jd)
+            if table is not None:
+                return table[0].tidal_dict(jd, *table[1:])
+
+        if coarse and first:
+            index = self.node_index(jd)
+            if index is not None:
+                # node_index already built the table on its grid.
+                (first_date, coarse_dict) = self.node_index_table
+                if first_date != self.dates[0]:
+                    coarse_dict = self.tidal_table(
+                        len(index), self.package_subset(package, index),
+                        coarse=False)
+
+                grid = self.node_index_grid
+
+                def interpolate(key):
+                    entry = dict(coarse_dict[key])
+                    ff = entry['FF']
+                    if np.ndim(ff) == 1 and len(ff) == len(index):
+                        entry['FF'] = grid(ff)
+                    return entry
+
+                return LazyDict(interpolate, coarse_dict,
+                                sources=(coarse_dict, jd, grid.dt))
 
         # Set data into speed_dict depending on length of time series
         # Required length of time series depends on Raleigh criteria to
@@ -328,151 +1236,151 @@ class Util:
 
         # TASK has the following constituents
         #  MSN6       87.4238337
-        self.tidal_dict = {}
+        table = {}
 
-        self.tidal_dict["M2"] = {
+        table["M2"] = lambda: {
             'ospeed': 28.984104252 * deg2rad,
             'VAU': 2 * (T - s + h + zeta - nu),
             'u':   2 * (zeta - nu),
             'FF': node_factor_78(ii)
         }
-        self.tidal_dict["K1"] = {
+        table["K1"] = lambda: {
             'ospeed': 15.041068632 * deg2rad,
             'VAU': T + h - 90 * deg2rad - nup,
             'u': -nup,
             'FF': node_factor_227(ii, nu)
         }
-        self.tidal_dict["M3"] = {
+        table["M3"] = lambda: {
             'ospeed': 43.476156360 * deg2rad,
             'VAU': 3 * (T - s + h + zeta - nu),
             'u': 3 * (zeta - nu),
             'FF': node_factor_149(ii)
         }
-        self.tidal_dict["M4"] = {
+        table["M4"] = lambda: {
             'ospeed': 57.968208468 * deg2rad,
-            'VAU': 2. * self.tidal_dict['M2']['VAU'],
-            'FF': self.tidal_dict['M2']['FF']**2
+            'VAU': 2. * raw['M2']['VAU'],
+            'FF': raw['M2']['FF']**2
         }
-        self.tidal_dict["M6"] = {
+        table["M6"] = lambda: {
             'ospeed': 86.952312720 * deg2rad,
-            'VAU': 3. * self.tidal_dict['M2']['VAU'],
+            'VAU': 3. * raw['M2']['VAU'],
             # Parker, et. al node factor for M6 is square of M2.  This is
             # inconsistent with IHOTC, Schureman, and FF of M4 and M8.
-            'FF': self.tidal_dict['M2']['FF']**3
+            'FF': raw['M2']['FF']**3
         }
-        self.tidal_dict["M8"] = {
+        table["M8"] = lambda: {
             'ospeed': 115.936416972 * deg2rad,
-            'VAU': 4. * self.tidal_dict['M2']['VAU'],
-            'FF': self.tidal_dict['M2']['FF']**4
+            'VAU': 4. * raw['M2']['VAU'],
+            'FF': raw['M2']['FF']**4
         }
-        self.tidal_dict["S6"] = {
+        table["S6"] = lambda: {
             'ospeed': 90.0 * deg2rad,
             'VAU': 6*T,
             'FF': np.ones(length)
         }
-        self.tidal_dict["O1"] = {
+        table["O1"] = lambda: {
             'ospeed': 13.943035584 * deg2rad,
             'VAU': T - 2 * s + h + 90 * deg2rad + 2 * zeta - nu,
             'u': 2*zeta - nu,
             'FF': node_factor_75(ii)
         }
-        self.tidal_dict["S2"] = {
+        table["S2"] = lambda: {
             'ospeed': 30.0000000 * deg2rad,
             'VAU': 2 * T,
             'FF': np.ones(length)
         }
-        self.tidal_dict["2MS6"] = {
+        table["2MS6"] = lambda: {
             'ospeed': 87.968208492 * deg2rad,  # ?
-            'VAU': (2.0 * self.tidal_dict['M2']['VAU'] +
-                    self.tidal_dict['S2']['VAU']),
-            'FF': self.tidal_dict['M2']['FF']**2
+            'VAU': (2.0 * raw['M2']['VAU'] +
+                    raw['S2']['VAU']),
+            'FF': raw['M2']['FF']**2
         }
-        self.tidal_dict["2SM6"] = {
+        table["2SM6"] = lambda: {
             'ospeed': 88.984104228 * deg2rad,  # ?
-            'VAU': (2.0 * self.tidal_dict['S2']['VAU'] +
-                    self.tidal_dict['M2']['VAU']),
-            'FF': self.tidal_dict['M2']['FF']
+            'VAU': (2.0 * raw['S2']['VAU'] +
+                    raw['M2']['VAU']),
+            'FF': raw['M2']['FF']
         }
-        self.tidal_dict["MSf"] = {
+        table["MSf"] = lambda: {
             'ospeed': 1.0158957720 * deg2rad,
             'VAU': 2.0 * (s - h),
             'FF': node_factor_75(ii)
         }
-        self.tidal_dict["SK3"] = {
+        table["SK3"] = lambda: {
             'ospeed': 45.041068656 * deg2rad,
-            'VAU': self.tidal_dict['S2']['VAU'] + self.tidal_dict['K1']['VAU'],
-            'FF': self.tidal_dict['K1']['FF']
+            'VAU': raw['S2']['VAU'] + raw['K1']['VAU'],
+            'FF': raw['K1']['FF']
         }
         # Might need to move this to another time span - couldn't find this
         # in Foreman for Rayleigh comparison pair.
-        self.tidal_dict["2SM2"] = {
+        table["2SM2"] = lambda: {
             'ospeed': 31.01589576 * deg2rad,
-            'VAU': (2.0 * self.tidal_dict['S2']['VAU'] -
-                    self.tidal_dict['M2']['VAU']),
-            'FF': self.tidal_dict['M2']['FF']
+            'VAU': (2.0 * raw['S2']['VAU'] -
+                    raw['M2']['VAU']),
+            'FF': raw['M2']['FF']
         }
-        self.tidal_dict["MS4"] = {
+        table["MS4"] = lambda: {
             'ospeed': 58.984104240 * deg2rad,
-            'VAU': (self.tidal_dict['M2']['VAU'] +
-                    self.tidal_dict['S2']['VAU']),
-            'FF': self.tidal_dict['M2']['FF']**2
+            'VAU': (raw['M2']['VAU'] +
+                    raw['S2']['VAU']),
+            'FF': raw['M2']['FF']**2
         }
-        self.tidal_dict["S4"] = {
+        table["S4"] = lambda: {
             'ospeed': 60.0 * deg2rad,
             'VAU': 4 * T,
             'FF': np.ones(length)
         }
-        self.tidal_dict["OO1"] = {
+        table["OO1"] = lambda: {
             'ospeed': 16.139101680 * deg2rad,
             'VAU': T + 2 * s + h - 90 * deg2rad - 2*zeta - nu,
             'FF': node_factor_77(ii)
         }
-        self.tidal_dict["MK3"] = {
+        table["MK3"] = lambda: {
             'ospeed': 44.025172884 * deg2rad,
-            'VAU': self.tidal_dict['M2']['VAU'] + self.tidal_dict['K1']['VAU'],
-            'FF': self.tidal_dict['M2']['FF']*self.tidal_dict['K1']['FF']
+            'VAU': raw['M2']['VAU'] + raw['K1']['VAU'],
+            'FF': raw['M2']['FF']*raw['K1']['FF']
         }
         # Seems like 2MK3 in Schureman is equivalent to MO3 in Foreman
-        self.tidal_dict["MO3"] = {
+        table["MO3"] = lambda: {
             'ospeed': 42.927139836 * deg2rad,
-            'VAU': (2 * self.tidal_dict['M2']['VAU'] -
-                    self.tidal_dict['K1']['VAU']),
-            'FF': self.tidal_dict['M2']['FF']**2 * self.tidal_dict['K1']['FF']
+            'VAU': (2 * raw['M2']['VAU'] -
+                    raw['K1']['VAU']),
+            'FF': raw['M2']['FF']**2 * raw['K1']['FF']
         }
-        self.tidal_dict["N2"] = {
+        table["N2"] = lambda: {
             'ospeed': 28.439729568 * deg2rad,
             'VAU': 2 * T - 3 * s + 2 * h + p + 2 * zeta - 2 * nu,
-            'FF': self.tidal_dict['M2']['FF']
+            'FF': raw['M2']['FF']
         }
-        self.tidal_dict["2MN6"] = {
+        table["2MN6"] = lambda: {
             'ospeed': 86.407938036 * deg2rad,
-            'VAU': (2 * self.tidal_dict['M2']['VAU'] +
-                    self.tidal_dict['N2']['VAU']),
-            'FF': self.tidal_dict['M2']['FF']**3
+            'VAU': (2 * raw['M2']['VAU'] +
+                    raw['N2']['VAU']),
+            'FF': raw['M2']['FF']**3
         }
-        self.tidal_dict["2Q1"] = {
+        table["2Q1"] = lambda: {
             'ospeed': 12.854286252 * deg2rad,
             'VAU': T - 4 * s + h + 2 * p + 90 * deg2rad + 2 * zeta - nu,
-            'FF': self.tidal_dict['O1']['FF']
+            'FF': raw['O1']['FF']
         }
-        self.tidal_dict["Q1"] = {
+        table["Q1"] = lambda: {
             'ospeed': 13.3986609 * deg2rad,
             'VAU': T - 3 * s + h + p + 90 * deg2rad + 2 * zeta - nu,
-            'FF': self.tidal_dict['O1']['FF']
+            'FF': raw['O1']['FF']
         }
-        self.tidal_dict["J1"] = {
+        table["J1"] = lambda: {
             'ospeed': 15.5854433 * deg2rad,
             'VAU': T + s + h - p - 90 * deg2rad - nu,
             'FF': node_factor_76(ii)
         }
         # Seems like KJ2 in Schureman is equivalent to eta2 in Foreman
-        self.tidal_dict["eta2"] = {
+        table["eta2"] = lambda: {
             'ospeed': 30.626511948 * deg2rad,
             'VAU': 2 * T + s + 2 * h - p - 2 * nu,
             'FF': node_factor_79(ii)
         }
         # Seems like KQ1 in Schureman is equivalent to ups1 in Foreman
-        self.tidal_dict["ups1"] = {
+        table["ups1"] = lambda: {
             'ospeed': 16.683476328 * deg2rad,
             'VAU': T + 3 * s + h - p - 90 * deg2rad - 2 * zeta - nu,
             'FF': node_factor_77(ii)
@@ -513,374 +1421,663 @@ class Util:
         # M1            14.492052126  From Schureman A71
         # NO1           14.496693984  From Schureman M1
 
-        self.tidal_dict["M1"] = {
+        table["M1"] = lambda: {
             'ospeed': 14.4920521 * deg2rad,
             'VAU': T - s + h + zeta + nu,  # term A71 in Schureman
             'FF': node_factor_144(ii)
         }
-        self.tidal_dict["NO1"] = {
+        table["NO1"] = lambda: {
             'ospeed': 14.496693984 * deg2rad,
             'VAU': T - s + h - 90 * deg2rad + zeta - nu + Q,
             # 2.307**0.5 factor was missed in Darwin's analysis and the wrong
             # factor was used for M1 for many years.  Indicates the importance
             # of M1 and NO1.  As with many constituents listed here, I have
             # included them for completeness rather than necessity.
-            'FF': (self.tidal_dict['O1']['FF']*
+            'FF': (raw['O1']['FF']*
                    (2.31 + 1.435 * np.cos(2.0 * kap_p))**0.5 / 2.307**0.5)
         }
-        self.tidal_dict["MN4"] = {
+        table["MN4"] = lambda: {
             'ospeed': 57.423833820 * deg2rad,   # From TASK
-            'VAU': self.tidal_dict['M2']['VAU'] + self.tidal_dict['N2']['VAU'],
-            'FF': self.tidal_dict['M2']['FF']**2
+            'VAU': raw['M2']['VAU'] + raw['N2']['VAU'],
+            'FF': raw['M2']['FF']**2
         }
-        self.tidal_dict["Mm"] = {
+        table["Mm"] = lambda: {
             'ospeed': 0.5443747 * deg2rad,
             'VAU': s - p,
             'FF': node_factor_73(ii)
         }
-        self.tidal_dict["L2"] = {
+        table["L2"] = lambda: {
             'ospeed': 29.5284789 * deg2rad,
             'VAU': 2 * T - s + 2 * h - p + 180 * deg2rad + 2 * zeta - 2 * nu - R,
-            'FF': (self.tidal_dict['M2']['FF'] /
+            'FF': (raw['M2']['FF'] /
                    (1.0 / (1.0 - 12.0 * np.tan(0.5 * ii)**2 * np.cos(2.0 * kap_p) +
                     36.0 * np.tan(0.5 * ii)**4)**0.5))  # eq 215, schureman
         }
-        self.tidal_dict["mu2"] = {
+        table["mu2"] = lambda: {
             'ospeed': 27.9682084 * deg2rad,
             'VAU': 2 * T - 4 * s + 4 * h + 2 * zeta - 2 * nu,
-            'FF': self.tidal_dict['M2']['FF']
+            'FF': raw['M2']['FF']
         }
-#        self.tidal_dict["ALPHA1"] =
+#        table["ALPHA1"] =
 # eps2 = MNS2
-        self.tidal_dict["MNS2"] = {
+        table["MNS2"] = lambda: {
             'ospeed': 27.423833796 * deg2rad,
             'VAU': 2 * T - 5 * s + 4 * h + p + 4 * zeta - 4 * nu,  # verify
-            'FF': self.tidal_dict['M2']['FF']**2
+            'FF': raw['M2']['FF']**2
         }
-        self.tidal_dict["SN4"] = {
+        table["SN4"] = lambda: {
             'ospeed': 58.4397295560 * deg2rad,
             'VAU': 2 * T - 5 * s + 4*h + p + 4 * zeta - 4 * nu,
-            'FF': self.tidal_dict['M2']['FF']**2
+            'FF': raw['M2']['FF']**2
         }
-        self.tidal_dict["Ssa"] = {
+        table["Ssa"] = lambda: {
             'ospeed': 0.0821373 * deg2rad,
             'VAU': 2.0 * h,
             'FF': np.ones(length)
         }
-        self.tidal_dict["Mf"] = {
+        table["Mf"] = lambda: {
             'ospeed': 1.0980331 * deg2rad,
             'VAU': 2.0 * (s - zeta),
             'FF': node_factor_74(ii)
         }
-        self.tidal_dict["P1"] = {
+        table["P1"] = lambda: {
             'ospeed': 14.9589314 * deg2rad,
             'VAU': T - h + 90 * deg2rad,
             'FF': np.ones(length)
         }
-        self.tidal_dict["K2"] = {
+        table["K2"] = lambda: {
             'ospeed': 30.0821373 * deg2rad,
             'VAU': 2 * (T + h - nupp),
             'FF': node_factor_235(ii, nu)
         }
-        self.tidal_dict["SO3"] = {
+        table["SO3"] = lambda: {
             'ospeed': 43.9430356 * deg2rad,
             'VAU': 3 * T - 2 * s + h + 90 * deg2rad + 2 * zeta - nu,
-            'FF': self.tidal_dict["O1"]["FF"]
+            'FF': raw["O1"]["FF"]
         }
-        self.tidal_dict["phi1"] = {
+        table["phi1"] = lambda: {
             'ospeed': 15.1232059 * deg2rad,
             'VAU': T + 3 * h - 90 * deg2rad,
             'FF': np.ones(length)
         }
-        self.tidal_dict["SO1"] = {
+        table["SO1"] = lambda: {
             'ospeed': 16.0569644 * deg2rad,
             'VAU': T + 2 * s - h - 90 * deg2rad - nu,
-            'FF': self.tidal_dict['J1']['FF']
+            'FF': raw['J1']['FF']
         }
         # Seems like A54 in Schureman is equivalent to MKS2 in Foreman
-        self.tidal_dict["MKS2"] = {
+        table["MKS2"] = lambda: {
             'ospeed': 29.066241528 * deg2rad,
             'VAU': 2 * T - 2 * s + 4 * h - 2 * nu,
-            'FF': self.tidal_dict['eta2']['FF']
+            'FF': raw['eta2']['FF']
         }
         # Seems like MP1 in Schureman is equivalent to tau1 in Foreman
-        self.tidal_dict["MP1"] = {
+        table["MP1"] = lambda: {
             'ospeed': 14.025172896 * deg2rad,
             'VAU': T - 2 * s + 3 * h - 90 * deg2rad - nu,
-            'FF': self.tidal_dict['J1']['FF']
+            'FF': raw['J1']['FF']
         }
         # Seems like A19 in Schureman is equivalent to BET1 in Foreman
         # Can't find BET1 in eXtended Doodson numbers
-#        self.tidal_dict["beta1"] = {
+#        table["beta1"] = lambda: {
 #            'ospeed': 14.414556708 * deg2rad,
 #            'VAU': T - s - h + p - 90 * deg2rad - 2*zeta - nu,
-#            'FF': self.tidal_dict['O1']['FF']
+#            'FF': raw['O1']['FF']
 #        }
-        self.tidal_dict["MK4"] = {
+        table["MK4"] = lambda: {
             'ospeed': 59.066241516 * deg2rad,
-            'VAU': self.tidal_dict['M2']['VAU'] + self.tidal_dict['K2']['VAU'],
-            'FF': self.tidal_dict['M2']['FF'] * self.tidal_dict['K2']['FF']
+            'VAU': raw['M2']['VAU'] + raw['K2']['VAU'],
+            'FF': raw['M2']['FF'] * raw['K2']['FF']
         }
-        self.tidal_dict["MSN2"] = {
+        table["MSN2"] = lambda: {
             'ospeed': 30.544374672 * deg2rad,
-            'VAU': self.tidal_dict['M2']['VAU'] + self.tidal_dict['K2']['VAU'],
-            'FF': self.tidal_dict['M2']['FF'] * self.tidal_dict['K2']['FF']
+            'VAU': raw['M2']['VAU'] + raw['K2']['VAU'],
+            'FF': raw['M2']['FF'] * raw['K2']['FF']
         }
-        self.tidal_dict["2N2"] = {
+        table["2N2"] = lambda: {
             'ospeed': 27.8953548 * deg2rad,
             'VAU': 2 * (T - 2 * s + h + p + zeta - nu),
-            'FF': self.tidal_dict['M2']['FF']
+            'FF': raw['M2']['FF']
         }
-        self.tidal_dict["nu2"] = {
+        table["nu2"] = lambda: {
             'ospeed': 28.5125831 * deg2rad,
             'VAU': 2 * T - 3 * s + 4 * h - p + 2 * zeta - 2 * nu,
-            'FF': self.tidal_dict['M2']['FF']
+            'FF': raw['M2']['FF']
         }
         # Seems like A4 in Schureman is equivalent to MSm in Foreman
-        self.tidal_dict["MSm"] = {
+        table["MSm"] = lambda: {
             'ospeed': 0.4715210880 * deg2rad,
             'VAU': s - 2 * h + p,
-            'FF': self.tidal_dict['Mm']['FF']
+            'FF': raw['Mm']['FF']
         }
         # nuJ1 = sigma1
-        self.tidal_dict["nuJ1"] = {
+        table["nuJ1"] = lambda: {
             'ospeed': 12.9271398 * deg2rad,
             'VAU': T - 4 * s + 3 * h + 90 * deg2rad + 2 * zeta - nu,
-            'FF': self.tidal_dict['O1']['FF']
+            'FF': raw['O1']['FF']
         }
-        self.tidal_dict["rho1"] = {
+        table["rho1"] = lambda: {
             'ospeed': 13.4715145 * deg2rad,
             'VAU': T - 3 * s + 3 * h - p + 90 * deg2rad + 2 * zeta - nu,
-            'FF': self.tidal_dict['O1']['FF']
+            'FF': raw['O1']['FF']
         }
-        self.tidal_dict["chi1"] = {
+        table["chi1"] = lambda: {
             'ospeed': 14.5695476 * deg2rad,
             'VAU': T - s + 3 * h - p - 90 * deg2rad - nu,
-            'FF': self.tidal_dict['J1']['FF']
+            'FF': raw['J1']['FF']
         }
-        self.tidal_dict["theta1"] = {
+        table["theta1"] = lambda: {
             'ospeed': 15.5125897 * deg2rad,
             'VAU': T + s - h + p - 90 * deg2rad - nu,
-            'FF': self.tidal_dict['J1']['FF']
+            'FF': raw['J1']['FF']
         }
-#        self.tidal_dict["OQ2"] =
-        self.tidal_dict["lambda2"] = {
+#        table["OQ2"] =
+        table["lambda2"] = lambda: {
             'ospeed': 29.4556253 * deg2rad,
             'VAU': 2 * T - s + p + 180 * deg2rad,
-            'FF': self.tidal_dict['M2']['FF']
+            'FF': raw['M2']['FF']
         }
-        self.tidal_dict["Sa"] = {
+        table["Sa"] = lambda: {
             'ospeed': 0.0410686 * deg2rad,
             'VAU': h,
             'FF': np.ones(length)
         }
-        self.tidal_dict["S1"] = {
+        table["S1"] = lambda: {
             'ospeed': 15.0000000 * deg2rad,
             'VAU': T,
             'FF': np.ones(length)
         }
-        self.tidal_dict["T2"] = {
+        table["T2"] = lambda: {
             'ospeed': 29.9589333 * deg2rad,
             'VAU': 2 * T - h + p1,
             'FF': np.ones(length)
         }
-        self.tidal_dict["R2"] = {
+        table["R2"] = lambda: {
             'ospeed': 30.0410667 * deg2rad,
             'VAU': 2 * T + h - p1 + 180 * deg2rad,
             'FF': np.ones(length)
         }
-        self.tidal_dict["pi1"] = {
+        table["pi1"] = lambda: {
             'ospeed': 14.9178647 * deg2rad,
             'VAU': T - 2 * h + p1 + 90 * deg2rad,
             'FF': np.ones(length)
 #'pi1': [1, 'AAWZZAY', [1, 1, -3, 0, 0, 1, -1]],
         }
-        self.tidal_dict["psi1"] = {
+        table["psi1"] = lambda: {
             'ospeed': 15.0821352 * deg2rad,
             'VAU': T + 2 * h - p1 - 90 * deg2rad,
             'FF': np.ones(length)
 #'psi1': [1, 'AAAZZYA', [1, 1, 1, 0, 0, -1, 1]],
         }
 
+        # The rest of the constituents in parameter_database, for
+        # auto_constituents.  V comes from the extended Doodson number, u
+        # and f from the constituents above that node_components finds,
+        # times and plus those given in parameter_database.
+        def equilibrium(key):
+            (a, b, c, d, e, f, g) = doodson_matrix[doodson_index[key]]
+            return (a * (T - s + h) + b * s + c * h + d * p + e * Nv +
+                    f * p1 + g * 90 * deg2rad)
+
+        def master_entry(key):
+            components = node_components(key, explicit)
+
+            def entry():
+                VAU = equilibrium(key) + _master_speed_dict[key]['u']
+                FF = _master_speed_dict[key]['f'] * np.ones(length)
+                for (name, n) in components:
+                    VAU = VAU + n * (raw[name]['VAU'] - equilibrium(name))
+                    FF = FF * raw[name]['FF']**abs(n)
+                return {'VAU': VAU, 'FF': FF}
+            return entry
+        explicit = [key for key in table if key in doodson_index]
+        for key in doodson_keys:
+            if key not in table:
+                table[key] = master_entry(key)
+
         # Can calculate the speed at the begining of the time series.
         # Doesn't really matter unless analyzing tides in 5000 C.E., because
         # the speeds do change.
-        (zetatoss, nutoss, nuptoss, nupptoss, kap_ptoss, itoss, Rtoss, Qtoss, Tbeg, jdtoss, sbeg, hbeg, Nvbeg, pbeg, p1beg) = self.astronomic([self.dates[0], self.dates[0] + datetime.timedelta(hours = 1)])
         Tspeed = 15.0 * deg2rad
+        if first:
+            w = self.argument_speeds(self.dates[0])
+
+            # The equilibrium arguments can be for the first time only since the
+            # VAU argument as it progresses will be at the same speed.
+            vw1 = [(15.0 * deg2rad + h[0] - s[0]), s[0], h[0], p[0], Nv[0], p1[0], 90 * deg2rad]
+            vw1 = np.array(vw1)
+        else:
+            # Speeds and equilibrium arguments at every date, for
+            # write_node_table.
+            (Nvbeg, pbeg, sbeg, hbeg, p1beg) = self.mean_longitudes(jd + 1.0/24.0)
+            sspeed = sbeg - s
+            hspeed = hbeg - h
+            w = np.array([(Tspeed - sspeed + hspeed), sspeed, hspeed, pbeg - p,
+                          Nvbeg - Nv, p1beg - p1, np.zeros_like(jd)]) * rad2deg
+            vw1 = np.array([(15.0 * deg2rad + h - s), s, h, p, Nv, p1,
+                            np.zeros_like(jd) + 90 * deg2rad])
+
+        # Calculate speeds and V of all of the constituents at once from
+        # their Doodson numbers.
+        keys = list(table)
+        rows = dict((key, i) for i, key in enumerate(keys))
+        doodson = doodson_matrix[[doodson_index[key] for key in keys]]
+        speed = np.mod(np.dot(doodson, w), 360) * deg2rad
+        V = np.mod(np.dot(doodson, vw1) * rad2deg, 360)
+
+        def finish(key):
+            before = set(raw.built)
+            entry = dict(raw[key])
+            # Only the raw entries of the constituents that others are
+            # derived from are kept, for the next constituent derived from
+            # them.
+            parents.update(set(raw.built) - before - set([key]))
+            if key not in parents:
+                del raw.built[key]
+            entry['speed'] = speed[rows[key]]
+            entry['V'] = V[rows[key]]
+
+            # Change VAU to degree and between 0 and 360
+            entry['VAU'] = entry['VAU'] * rad2deg
+            if not first:
+                entry['VAU'] = np.mod(entry['VAU'], 360)
+                return entry
+            try:
+                entry['VAU'] = np.mod(entry['VAU'], 360)[0]
+            except IndexError:
+                entry['VAU'] = np.mod(entry['VAU'], 360)
+            return entry
+
+        # Only the constituents that are looked up are calculated.  raw
+        # holds VAU in radians for every date, which the constituents
+        # derived from others are calculated from.
+        raw = LazyDict(lambda key: table[key](), table)
+        parents = set()
+        return LazyDict(finish, table, sources=(raw, ))
+
+    def argument_speeds(self, date):
+        """
+        Returns the speeds in degrees per hour at date of the astronomic
+        arguments that the columns of doodson_matrix multiply.
+        """
+
+        Tspeed = 15.0 * deg2rad
+        (zetatoss, nutoss, nuptoss, nupptoss, kap_ptoss, itoss, Rtoss, Qtoss, Tbeg, jdtoss, sbeg, hbeg, Nvbeg, pbeg, p1beg) = self.astronomic(np.datetime64(date, 's') + np.array([0, 3600], dtype='timedelta64[s]'))
         sspeed = (sbeg[1] - sbeg[0])
         hspeed = (hbeg[1] - hbeg[0])
         Nvspeed = (Nvbeg[1] - Nvbeg[0])
         pspeed = (pbeg[1] - pbeg[0])
         ppspeed = (p1beg[1] - p1beg[0])
-        w = np.array([(Tspeed - sspeed + hspeed), sspeed, hspeed, pspeed, Nvspeed, ppspeed, 0.0]) * rad2deg
+        return np.array([(Tspeed - sspeed + hspeed), sspeed, hspeed, pspeed, Nvspeed, ppspeed, 0.0]) * rad2deg
 
-        # The equilibrium arguments can be for the first time only since the
-        # VAU argument as it progresses will be at the same speed.
-        vw1 = [(15.0 * deg2rad + h[0] - s[0]), s[0], h[0], p[0], Nv[0], p1[0], 90 * deg2rad]
-        vw1 = np.array(vw1)
+    def package_subset(self, package, index):
+        """
+        Returns the astronomic package at index.  T is the same for all
+        dates and is passed through.
+        """
 
-        for key in self.tidal_dict:
-            # Calculate speeds
-            constituent_factors = [letter_to_factor_map[i]
-                                   for i in _master_speed_dict[key]['edn']]
-            self.tidal_dict[key]['speed'] = np.sum(np.array(constituent_factors) * w)
-            self.tidal_dict[key]['speed'] = np.mod(self.tidal_dict[key]['speed'], 360)
-            self.tidal_dict[key]['speed'] = self.tidal_dict[key]['speed'] * deg2rad
+        return tuple(i if np.ndim(i) == 0 else np.asarray(i)[index]
+                     for i in package)
 
-            self.tidal_dict[key]['V'] = np.sum(np.array(constituent_factors) * vw1)
-            self.tidal_dict[key]['V'] = self.tidal_dict[key]['V'] * rad2deg
-            self.tidal_dict[key]['V'] = np.mod(self.tidal_dict[key]['V'], 360)
+    def node_table_grid(self, jd):
+        """
+        Returns the NodeTable of node_table if it covers jd, the first and
+        one past the last of its rows around jd, and the NodeGrid from
+        their dates to jd, or None.
+        """
 
-            # Change VAU to degree and between 0 and 360
-            self.tidal_dict[key]['VAU'] = self.tidal_dict[key]['VAU'] * rad2deg
-            try:
-                self.tidal_dict[key]['VAU'] = np.mod(self.tidal_dict[key]['VAU'], 360)[0]
-            except IndexError:
-                self.tidal_dict[key]['VAU'] = np.mod(self.tidal_dict[key]['VAU'], 360)
+        if not self.node_table:
+            return None
+        table = open_node_table(self.node_table, self.ephemeris_backend)
+        if table is None or not table.covers(jd):
+            return None
+        key = (table, jd[0], jd[-1], len(jd))
+        if self.node_table_key != key:
+            (first, last) = table.rows(jd)
+            self.node_table_key = key
+            self.node_table_value = (table, first, last,
+                                     NodeGrid(jd, table.dates(first, last)))
+        return self.node_table_value
+
+    def node_index(self, jd):
+        """
+        Returns the indices of jd where the ephemeris and node factors are
+        evaluated when node_interval is set, or None if they should be
+        evaluated at every date.  Starting from node_interval hours apart,
+        the interval is halved until linear interpolation between the
+        indices matches the mean longitudes, and the node factors of the
+        constituents that can be selected, midway between them to within
+        node_tolerance.  The astronomic package and tidal table at the
+        indices, and the NodeGrid to interpolate them, are kept for
+        astronomic and tidal_table.
+        """
+
+        if not self.node_interval or len(jd) < 3:
+            return None
+        key = (jd[0], jd[-1], len(jd), self.node_interval,
+               self.node_tolerance, self.ephemeris_backend)
+        if self.node_index_key == key:
+            return self.node_index_value
+
+        if self.selection == 'auto':
+            keys = doodson_keys
+        else:
+            keys = [key for (hours, names) in rayleigh_tiers for key in names]
+        keys = keys + [row[0] for row in inference_table]
+
+        interval = float(self.node_interval) / 24.0
+        while True:
+            grid = np.arange(jd[0], jd[-1], interval)
+            index = np.unique(np.append(np.searchsorted(jd, grid),
+                                        len(jd) - 1))
+            if 2 * len(index) > len(jd):
+                # Not worth it, the dates are about as far apart as the
+                # interval.
+                index = None
+                break
+            cjd = jd[index]
+            mjd = 0.5 * (cjd[:-1] + cjd[1:])
+            clong = self.mean_longitudes(cjd)
+            mlong = self.mean_longitudes(mjd)
+            error = 0.0
+            for c, m in zip(clong, mlong):
+                diff = interpolate_angle(mjd, cjd, c) - m
+                diff = np.mod(diff + np.pi, 2 * np.pi) - np.pi
+                error = max(error, np.max(np.abs(diff)))
+            cpackage = self.node_arguments(cjd, *clong)
+            ctable = self.tidal_table(len(cjd), cpackage, coarse=False)
+            mtable = self.tidal_table(len(mjd),
+                                      self.node_arguments(mjd, *mlong),
+                                      coarse=False)
+            for k in keys:
+                if k in ctable and np.ndim(ctable[k]['FF']) == 1:
+                    diff = 0.5 * (ctable[k]['FF'][:-1] + ctable[k]['FF'][1:]) - mtable[k]['FF']
+                    error = max(error, np.max(np.abs(diff)))
+            if error <= self.node_tolerance:
+                break
+            interval = interval / 2.0
+
+        self.node_index_key = key
+        self.node_index_value = index
+        if index is not None:
+            # For astronomic and tidal_table to interpolate from rather
+            # than build again.
+            self.node_index_grid = NodeGrid(jd, jd[index])
+            self.node_index_package = cpackage
+            self.node_index_table = (self.dates[0], ctable)
+        return index
+
+    def write_node_table(self, filename, start_date, end_date, interval=24,
+                         rows=8760):
+        """
+        Writes FF, V, VAU, and speed for every constituent in tidal_table
+        every interval hours from start_date to end_date to filename, to be
+        read by NodeTable.  The table is calculated rows dates at a time.
+        """
+
+        interval = float(interval) / 24.0
+        start = self.dates2jd([start_date])[0]
+        length = int(np.floor((self.dates2jd([end_date])[0] - start) /
+                              interval)) + 1
+        if length < 2:
+            print("The node table needs at least two dates")
+            sys.exit()
+        jd = start + interval * np.arange(length)
+
+        keys = None
+        fpo = None
+        for begin in range(0, length, rows):
+            cjd = jd[begin:begin + rows]
+            package = self.node_arguments(cjd, *self.mean_longitudes(cjd))
+            # VAU is written without T, which is added back for the first of
+            # the dates read, and with the multiple of T found from a small
+            # step in it.
+            step = 0.01
+            tidal_dict = self.tidal_table(len(cjd), package[:8] + (0.0, ) +
+                                          package[9:], coarse=False,
+                                          first=False)
+            stepped = self.tidal_table(len(cjd), package[:8] + (step, ) +
+                                       package[9:], coarse=False, first=False)
+            for key in tidal_dict:
+                tidal_dict[key]['T'] = np.round(
+                    (np.mod(stepped[key]['VAU'] - tidal_dict[key]['VAU'] +
+                            180, 360) - 180) / (step * rad2deg))
+            if keys is None:
+                keys = sorted(tidal_dict)
+                header = node_table_header(keys, start, interval, length,
+                                           self.ephemeris_backend)
+                fpo = open(filename, 'wb')
+                fpo.write(header)
+                fpo.close()
+                data = np.memmap(filename, dtype='<f8', mode='r+',
+                                 offset=len(header),
+                                 shape=(length, len(NodeTable.fields),
+                                        len(keys)))
+            for index, field in enumerate(NodeTable.fields):
+                data[begin:begin + len(cjd), index, :] = np.transpose(
+                    [np.broadcast_to(tidal_dict[key][field], cjd.shape)
+                     for key in keys])
+        data.flush()
+        del data
+
+    def which_constituents(self, length, package, rayleigh_comp=1.0,
+                           interval=None):
+        """
+        Establishes which constituents are able to be determined according to
+        the length of the water elevation vector, from rayleigh_tiers or if
+        selection is 'auto' from auto_constituents, with the sampling
+        interval in minutes if the dates of package are not the samples.
+        """
+
+        jd = package[9]
+        speed_dict = {}
+
+        self.basis_entry = None
+        self.tidal_dict = self.tidal_table(length, package)
 
         num_hours = (jd[-1] - jd[0]) * 24
         if num_hours < 13:
             print("Cannot calculate any constituents from this record length")
             sys.exit()
-        speed_dict["M2"] = self.tidal_dict["M2"]
-        if num_hours >= (24 * rayleigh_comp):
-            speed_dict["K1"] = self.tidal_dict["K1"]
-        if num_hours >= 25 * rayleigh_comp:
-            speed_dict["M3"] = self.tidal_dict["M3"]
-            speed_dict["M4"] = self.tidal_dict["M4"]
-        if num_hours >= 26 * rayleigh_comp:
-            speed_dict["M6"] = self.tidal_dict["M6"]
-            speed_dict["M8"] = self.tidal_dict["M8"]
-        if num_hours >= 235 * rayleigh_comp:
-            # Slower than diurnal: S6
-            # Diurnal:
-            # Semidiurnal:
-            # Shallow water:
-            # Need:
-            speed_dict["S6"] = self.tidal_dict["S6"]
-        if num_hours >= 328 * rayleigh_comp:
-            # Slower than diurnal:
-            # Diurnal: O1
-            # Semidiurnal:
-            # Shallow water:
-            # Need:
-            speed_dict["O1"] = self.tidal_dict["O1"]
-        if num_hours >= 355 * rayleigh_comp:
-            # Slower than diurnal: MSf
-            # Diurnal:
-            # Semidiurnal: S2
-            # Shallow water: SK3, MS4, S4, 2MS6, 2SM6
-            # Need:
-            speed_dict["S2"] = self.tidal_dict["S2"]
-            speed_dict["2MS6"] = self.tidal_dict["2MS6"]
-            speed_dict["2SM6"] = self.tidal_dict["2SM6"]
-            speed_dict["MSf"] = self.tidal_dict["MSf"]
-            speed_dict["SK3"] = self.tidal_dict["SK3"]
-            # Might need to move this to another time span - couldn't find this
-            # in Foreman for Rayleigh comparison pair.
-            speed_dict["2SM2"] = self.tidal_dict["2SM2"]
-            speed_dict["MS4"] = self.tidal_dict["MS4"]
-            speed_dict["S4"] = self.tidal_dict["S4"]
-        if num_hours >= 651 * rayleigh_comp:
-            # Slower than diurnal:
-            # Diurnal: OO1
-            # Semidiurnal:
-            # Shallow water:
-            # Need:
-            speed_dict["OO1"] = self.tidal_dict["OO1"]
-        if num_hours >= 656 * rayleigh_comp:
-            # Slower than diurnal:
-            # Diurnal:
-            # Semidiurnal:
-            # Shallow water: MK3, MO3
-            # Need:
-            speed_dict["MK3"] = self.tidal_dict["MK3"]
-            # Seems like 2MK3 in Schureman is equivalent to MO3 in Foreman
-            speed_dict["MO3"] = self.tidal_dict["MO3"]
-        if num_hours >= 662 * rayleigh_comp:
-            # Slower than diurnal:
-            # Diurnal: 2Q1, Q1, NO1, J1, ups1
-            # Semidiurnal: N2, eta2
-            # Shallow water: MN4, 2MN6
-            # Need:
-            speed_dict["N2"] = self.tidal_dict["N2"]
-            speed_dict["2MN6"] = self.tidal_dict["2MN6"]
-            speed_dict["2Q1"] = self.tidal_dict["2Q1"]
-            speed_dict["Q1"] = self.tidal_dict["Q1"]
-            speed_dict["J1"] = self.tidal_dict["J1"]
-            # Seems like KJ2 in Schureman is equivalent to eta2 in Foreman
-            speed_dict["eta2"] = self.tidal_dict["eta2"]
-            # Seems like KQ1 in Schureman is equivalent to ups1 in Foreman
-            speed_dict["ups1"] = self.tidal_dict["ups1"]
-            speed_dict["NO1"] = self.tidal_dict["NO1"]
-            speed_dict["MN4"] = self.tidal_dict["MN4"]
-        if num_hours >= 764 * rayleigh_comp:
-            # Slower than diurnal: Mm
-            # Diurnal: ALPHA1
-            # Semidiurnal: MNS2, mu2, L2
-            # Shallow water: SN4
-            # Need: ALPHA1
-            speed_dict["Mm"] = self.tidal_dict["Mm"]
-            speed_dict["L2"] = self.tidal_dict["L2"]
-            speed_dict["mu2"] = self.tidal_dict["mu2"]
-#            speed_dict["ALPHA1"] = self.tidal_dict["ALPHA1"]
-            speed_dict["MNS2"] = self.tidal_dict["MNS2"]
-            speed_dict["SN4"] = self.tidal_dict["SN4"]
-        if num_hours >= 4383 * rayleigh_comp:
-            # Slower than diurnal: Ssa, Mf
-            # Diurnal: phi1, P1, bet1, MP1, (only found bet1 in Foreman)
-            # Semidiurnal: K2, MSN2
-            # Shallow water: SO1, MKS2, MSN3, SO3, MK4, SK4, 2MK6, MSK6
-            # Need MSN3, SK4, 2MK6, MSK6
-            speed_dict["Ssa"] = self.tidal_dict["Ssa"]
-            speed_dict["Mf"] = self.tidal_dict["Mf"]
-            speed_dict["P1"] = self.tidal_dict["P1"]
-            speed_dict["K2"] = self.tidal_dict["K2"]
-            speed_dict["SO3"] = self.tidal_dict["SO3"]
-            speed_dict["phi1"] = self.tidal_dict["phi1"]
-            speed_dict["SO1"] = self.tidal_dict["SO1"]
-            # Seems like A54 in Schureman is equivalent to MKS2 in Foreman
-            speed_dict["MKS2"] = self.tidal_dict["MKS2"]
-            # Seems like MP1 in Schureman is equivalent to MP1 in Foreman
-            speed_dict["MP1"] = self.tidal_dict["MP1"]
-            # Seems like A19 in Schureman is equivalent to BET1 in Foreman
-            # Can't find bet1 or beta1 in eXtended Doodson numbers
-            # speed_dict["beta1"] = self.tidal_dict["beta1"]
-            speed_dict["MK4"] = self.tidal_dict["MK4"]
-            speed_dict["MSN2"] = self.tidal_dict["MSN2"]
-        if num_hours >= 4942 * rayleigh_comp:
-            speed_dict["2N2"] = self.tidal_dict["2N2"]
-            speed_dict["nu2"] = self.tidal_dict["nu2"]
-            # Seems like A4 in Schureman is equivalent to MSm in Foreman
-            speed_dict["MSm"] = self.tidal_dict["MSm"]
-            speed_dict["nuJ1"] = self.tidal_dict["nuJ1"]
-            speed_dict["rho1"] = self.tidal_dict["rho1"]
-            speed_dict["chi1"] = self.tidal_dict["chi1"]
-            speed_dict["theta1"] = self.tidal_dict["theta1"]
-#            speed_dict["OQ2"] =self.tidal_dict["OQ2"]
-            speed_dict["lambda2"] = self.tidal_dict["lambda2"]
-        if num_hours >= 8766 * rayleigh_comp:
-            speed_dict["Sa"] = self.tidal_dict["Sa"]
-        if num_hours >= 8767 * rayleigh_comp:
-            speed_dict["S1"] = self.tidal_dict["S1"]
-            speed_dict["T2"] = self.tidal_dict["T2"]
-            speed_dict["R2"] = self.tidal_dict["R2"]
-            speed_dict["pi1"] = self.tidal_dict["pi1"]
-            speed_dict["psi1"] = self.tidal_dict["psi1"]
-#            speed_dict["H1"] =self.tidal_dict["H1"]
-#            speed_dict["H2"] =self.tidal_dict["H2"]
-        if num_hours >= 11326 * rayleigh_comp:
-            # GAM2 from Foreman should go here, but couldn't find comparable
-            # constituent information from Schureman
-            pass
-        # This is what is required to separate NO1 and M1
-        if num_hours >= 77554 * rayleigh_comp:
-            speed_dict["M1"] = self.tidal_dict["M1"]
+        if self.selection == 'auto':
+            names = self.auto_constituents(jd, rayleigh_comp=rayleigh_comp,
+                                           interval=interval)
+        elif self.selection != 'standard':
+            print("selection must be one of 'standard' (the default) or 'auto'")
+            sys.exit()
+        else:
+            names = [key for (hours, keys) in rayleigh_tiers
+                     if num_hours >= hours * rayleigh_comp
+                     for key in keys]
+        for key in names:
+            speed_dict[key] = self.tidal_dict[key]
 
         key_list = sorted(list(speed_dict.keys()))
 
         return (speed_dict, key_list)
 
+    def auto_constituents(self, jd, rayleigh_comp=1.0, interval=None):
+        """
+        Returns the names of the constituents in parameter_database that can
+        be separated from their neighbours in speed, and from the mean, by
+        the Rayleigh criterion for a record from jd[0] to jd[-1], and that
+        are slower than the Nyquist frequency of the sampling every interval
+        minutes, or of jd if interval is None.  Where
+        neighbours are too close the one with the lower priority is left
+        out, first the constituents in rayleigh_tiers in order, then the
+        rest with the smallest Doodson numbers first.
+        """
+
+        num_hours = (jd[-1] - jd[0]) * 24
+        # Degrees per hour
+        resolution = 360.0 * rayleigh_comp / num_hours
+        if interval is None:
+            interval = np.median(np.diff(jd)) * 24 * 60
+        nyquist = 180.0 / (interval / 60.0)
+
+        speed = np.abs(np.dot(doodson_matrix, self.argument_speeds(self.dates[0])))
+        tier = dict((key, i) for (i, key) in
+                    enumerate(key for (hours, keys) in rayleigh_tiers
+                              for key in keys))
+        priority = np.array([tier.get(key, len(tier)) for key in doodson_keys])
+        # The mean, Zo, is always kept.
+        priority[speed == 0] = -1
+        size = np.abs(doodson_matrix[:, 1:6]).sum(axis=1)
+        rank = np.empty(len(doodson_keys), dtype=int)
+        rank[np.lexsort((np.arange(len(doodson_keys)), size, priority))] = np.arange(len(doodson_keys))
+
+        keep = speed < nyquist
+        while True:
+            index = np.flatnonzero(keep)
+            index = index[np.argsort(speed[index], kind='mergesort')]
+            close = np.diff(speed[index]) < resolution
+            if not np.any(close):
+                break
+            left = index[:-1][close]
+            right = index[1:][close]
+            loser = np.where(rank[left] > rank[right], left, right)
+            winner = np.where(rank[left] > rank[right], right, left)
+            # A constituent that loses to one that is itself left out might
+            # be separable from what remains, so wait for the next pass.
+            keep[loser[~np.isin(winner, loser)]] = False
+
+        return [key for (key, use) in zip(doodson_keys, keep & (speed > 0))
+                if use]
+
+
+class NormalEquations:
+    """
+    Accumulates the normal equations X'X and X'y of a linear least squares
+    problem one block of rows at a time.  Memory depends only on the number
+    of columns, not on the number of rows.
+    """
+
+    def __init__(self, ncols):
+        self.XtX = np.zeros((ncols, ncols))
+        self.Xty = np.zeros(ncols)
+        self.count = 0
+
+    def add(self, X, y):
+        self.XtX += np.dot(X.T, X)
+        self.Xty += np.dot(X.T, y)
+        self.count = self.count + len(y)
+
+    def solve(self):
+        return np.linalg.lstsq(self.XtX, self.Xty, rcond=None)[0]
+
+
+class RecursiveLeastSquares:
+    """
+    Recursive least squares update of a linear least squares solution.
+    Each new row x with value y is folded into the coefficients and the
+    inverse of the information matrix P = (X'X)**-1 in O(k**2) operations for
+    k columns.  A forgetting factor less than 1.0 exponentially down weights
+    older rows.
+    """
+
+    def __init__(self, coef, P, forgetting=1.0):
+        self.coef = np.array(coef, dtype='f8')
+        self.P = np.array(P, dtype='f8')
+        self.forgetting = forgetting
+
+    def update(self, x, y):
+        Px = np.dot(self.P, x)
+        gain = Px / (self.forgetting + np.dot(x, Px))
+        self.coef = self.coef + gain * (y - np.dot(x, self.coef))
+        self.P = (self.P - np.outer(gain, Px)) / self.forgetting
+
+
+class BasisCache:
+    """
+    Least recently used cache of the astronomic package, constituent tables,
+    and node factor weighted harmonic basis (design_matrix) for a time grid,
+    so that repeated analyses over the same dates don't have to recalculate
+    them.  Entries are dictionaries of arrays, evicted oldest first when the
+    total size of the cached arrays is larger than max_bytes.  The tidal
+    dictionaries fill in as constituents are looked up, so the entries are
+    measured again on every get and put.  The hits and misses attributes
+    count the lookups.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses = self.misses + 1
+            return None
+        self.entries[key] = entry
+        self.hits = self.hits + 1
+        # Keep the entry being returned even if it is too large by itself.
+        self.evict(keep=1)
+        return entry
+
+    def put(self, key, entry):
+        """
+        Adds or replaces entry, then evicts the least recently used entries
+        until the cache fits in max_bytes.
+        """
+
+        if key in self.entries:
+            del self.entries[key]
+            del self.sizes[key]
+        self.entries[key] = entry
+        self.evict()
+
+    def evict(self, keep=0):
+        """
+        Measures the entries and evicts the least recently used until the
+        cache fits in max_bytes or only keep entries are left.
+        """
+
+        for key, entry in self.entries.items():
+            self.sizes[key] = entry_nbytes(entry)
+        self.nbytes = sum(self.sizes.values())
+        while self.nbytes > self.max_bytes and len(self.entries) > keep:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.nbytes = self.nbytes - self.sizes.pop(old_key)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+
+
+def entry_nbytes(item, seen=None):
+    """
+    Returns the total size of the numpy arrays in nested dictionaries,
+    lists, and tuples, counting arrays that appear more than once only once.
+    """
+
+    if seen is None:
+        seen = set()
+    if id(item) in seen:
+        return 0
+    seen.add(id(item))
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if isinstance(item, LazyDict):
+        # Only what has been calculated so far.
+        return (entry_nbytes(item.built, seen) +
+                entry_nbytes(item.sources, seen))
+    if isinstance(item, ConstituentTable):
+        return entry_nbytes(item.__dict__, seen)
+    if isinstance(item, dict):
+        return sum([entry_nbytes(i, seen) for i in item.values()])
+    if isinstance(item, (list, tuple)):
+        return sum([entry_nbytes(i, seen) for i in item])
+    return 0
+
+
+basis_cache = BasisCache()
+
 
 class tappy(Util):
 
@@ -905,13 +2102,27 @@ class tappy(Util):
         self.filter = kwds.pop('filter')
         self.pad_filters = kwds.pop('pad_filters')
         self.include_inferred = kwds.pop('include_inferred')
+        self.solver = kwds.pop('solver', 'nonlinear')
+        self.ephemeris_backend = kwds.pop('ephemeris_backend', 'astronomia')
+        self.node_interval = kwds.pop('node_interval', 0)
+        self.node_tolerance = kwds.pop('node_tolerance', 1.0e-6)
+        self.node_table = kwds.pop('node_table', None)
+        self.selection = kwds.pop('selection', 'standard')
 
         # ---instance variables---
+        self.basis_entry = None
+        self.basis_entry_key = None
         self.speed_dict = {}
         self.elevation = []
         self.dates = []
 
-    def open(self, filename, def_filename=None):
+    def read(self, filename, def_filename=None):
+        """
+        Generator of the (date, water_level) records in filename.
+        """
+
+        from tappy_lib import sparser
+
         # Read and parse data filename
         fp = sparser.ParseFileLineByLine(filename,
                                          def_filename=def_filename,
@@ -921,29 +2132,53 @@ class tappy(Util):
                 print('Warning: record %i did not parse according to the supplied definition file' % line.line_number)
                 continue
             if 'datetime' in list(line.parsed_dict.keys()):
-                self.dates.append(line.parsed_dict['datetime'])
+                date = line.parsed_dict['datetime']
             elif ('year' in list(line.parsed_dict.keys()) and
                   'month' in list(line.parsed_dict.keys()) and
                   'day' in list(line.parsed_dict.keys()) and
                   'hour' in list(line.parsed_dict.keys())):
                 line.parsed_dict.setdefault('minute', 0)
                 line.parsed_dict.setdefault('second', 0)
-                self.dates.append(datetime.datetime(line.parsed_dict['year'],
-                                                    line.parsed_dict['month'],
-                                                    line.parsed_dict['day'],
-                                                    line.parsed_dict['hour'],
-                                                    line.parsed_dict['minute'],
-                                                    line.parsed_dict['second']))
+                date = datetime.datetime(line.parsed_dict['year'],
+                                         line.parsed_dict['month'],
+                                         line.parsed_dict['day'],
+                                         line.parsed_dict['hour'],
+                                         line.parsed_dict['minute'],
+                                         line.parsed_dict['second'])
             else:
                 print('Warning: record %i did not parse the date and time according to the supplied definition file' % line.line_number)
                 print('Requires "year", "month", "day", and "hour" ("minute" and "second" are optional and default to zero) OR a Julian date/time')
                 continue
-            self.elevation.append(line.parsed_dict['water_level'])
+            yield date, line.parsed_dict['water_level']
+
+    def open(self, filename, def_filename=None):
+        for date, water_level in self.read(filename, def_filename=def_filename):
+            self.dates.append(date)
+            self.elevation.append(water_level)
         if len(self.elevation) == 0:
             print('No data was found in the input file.')
             sys.exit()
         self.elevation = np.array(self.elevation)
-        self.dates = np.array(self.dates)
+        self.dates = datetime64_dates(self.dates)
+
+    def open_chunks(self, filename, def_filename=None, chunk=100000):
+        """
+        Generator of (dates, elevation) arrays with at most chunk records
+        each, so that a record can be analyzed without reading all of it
+        into memory.
+        """
+
+        dates = []
+        elevation = []
+        for date, water_level in self.read(filename, def_filename=def_filename):
+            dates.append(date)
+            elevation.append(water_level)
+            if len(dates) == chunk:
+                yield datetime64_dates(dates), np.array(elevation)
+                dates = []
+                elevation = []
+        if dates:
+            yield datetime64_dates(dates), np.array(elevation)
 
     def missing(self, task, dates, elev):
         """
@@ -957,32 +2192,24 @@ class tappy(Util):
         if task == 'ignore':
             return (dates, elev)
 
+        dates = datetime64_dates(dates)
         interval = dates[1:] - dates[:-1]
 
-        if np.any(interval > datetime.timedelta(seconds = 3600)):
+        if np.any(interval > np.timedelta64(3600, 's')):
             if task == 'fail':
                 print("There is a difference of greater than one hour between values")
                 sys.exit()
 
         if task == 'fill':
-            # Create real dates
-            start = dates[0]
             # Dominant interval
             interval.sort()
-            interval = interval[len(interval)/2]
-
-            dt = dates[0]
-            dates_filled = []
-            while dt <= (dates[-1] + datetime.timedelta(minutes = 1)):
-                dates_filled.append(dt)
-                dt = dt + interval
+            interval = interval[len(interval)//2]
 
-            dates_filled = np.array(dates_filled)
+            dates_filled = np.arange(dates[0],
+                                     dates[-1] + np.timedelta64(61, 's'),
+                                     interval)
 
-            where_good = np.zeros(len(dates_filled), dtype='bool')
-
-            for dt in dates:
-                where_good[dates_filled == dt] = True
+            where_good = np.isin(dates_filled, dates)
 
             if np.all(where_good):
                 return (dates, elev)
@@ -998,7 +2225,10 @@ class tappy(Util):
             (self.zeta, self.nu, self.nup, self.nupp, self.kap_p, self.ii, self.R, self.Q, self.T, self.jd, self.s, self.h, self.N, self.p, self.p1) = package
 
             #self.constituents()
-            total = self.sum_signals(self.key_list, dates_filled, self.speed_dict)
+            # The filled record can be long enough to resolve more
+            # constituents than were analyzed.
+            analyzed = [i for i in self.key_list if i in self.r]
+            total = self.sum_signals(analyzed, dates_filled, self.speed_dict)
 
             residuals[where_good] = elev - total[where_good]
 
@@ -1025,113 +2255,193 @@ class tappy(Util):
         self.elevation = np.compress(good, self.elevation)
         self.dates = np.compress(good, self.dates)
 
-    def residuals(self, p, ht, t, key_list):
+    def basis_key(self, rayleigh_comp=1.0):
         """
-        Used for least squares fit.
+        Returns the basis_cache key for self.dates.  Evenly spaced dates are
+        identified by the start, interval, length, and ephemeris options,
+        with the modification time and size of node_table, anything else
+        also needs a digest of all of the dates.
         """
 
-        H = {}
-        phase = {}
-        slope = {}
-        for index, key in enumerate(key_list):
-            H[key] = p[index]
-            phase[key] = p[index + len(key_list)]
-            # print('---')
-            # print(key)
-            # print(self.speed_dict[key]['FF'][:3])
-        if len(self.speed_dict[key_list[0]]['FF']) == len(t):
-            ff = self.tidal_dict
-        else:
-            # This is for the short term harmonic analysis.
-            ff = {}
-            for key in key_list:
-                ff[key] = {'FF': np.ones(len(t))}
+        dates = np.asarray(self.dates)
+        if len(dates) < 2:
+            return None
+        # A node table that is rebuilt must not match the bases built
+        # from it before.
+        node_table = self.node_table
+        if node_table and os.path.exists(node_table):
+            stat = os.stat(node_table)
+            node_table = (node_table, stat.st_mtime_ns, stat.st_size)
+        interval = dates[1] - dates[0]
+        if np.all((dates[1:] - dates[:-1]) == interval):
+            return (dates[0], interval, len(dates), float(rayleigh_comp),
+                    self.ephemeris_backend, self.node_interval,
+                    self.node_tolerance, node_table, self.selection)
+        digest = hashlib.sha1(dates.astype('datetime64[us]').tobytes()).hexdigest()
+        return (dates[0], None, len(dates), float(rayleigh_comp),
+                self.ephemeris_backend, self.node_interval,
+                self.node_tolerance, node_table, self.selection, digest)
+
+    def prepare(self, rayleigh_comp=1.0):
+        """
+        Calculates the astronomic package and establishes the constituents
+        for self.dates, the same as calling astronomic and then
+        which_constituents, but reusing the result from basis_cache if these
+        dates have been seen before.
+        """
+
+        key = self.basis_key(rayleigh_comp)
+        entry = None
+        if key is not None:
+            entry = basis_cache.get(key)
+        if entry is None:
+            package = self.astronomic(self.dates)
+            (speed_dict, key_list) = self.which_constituents(len(self.dates),
+                                                             package,
+                                                             rayleigh_comp=rayleigh_comp)
+            entry = {'package': package,
+                     'tidal_dict': self.tidal_dict,
+                     'speed_dict': speed_dict,
+                     'key_list': key_list}
+            if key is not None:
+                basis_cache.put(key, entry)
+        package = entry['package']
+        (self.zeta, self.nu, self.nup, self.nupp, self.kap_p, self.ii, self.R, self.Q, self.T, self.jd, self.s, self.h, self.N, self.p, self.p1) = package
+        self.tidal_dict = entry['tidal_dict']
+        # Copies since the analysis can add to them.
+        self.speed_dict = dict(entry['speed_dict'])
+        self.key_list = list(entry['key_list'])
+        self.basis_entry = entry
+        self.basis_entry_key = key
+        return package
+
+    def cached_design_matrix(self, t, key_list):
+        """
+        Returns design_matrix(t, key_list), from basis_cache if it was
+        already built for the dates, constituents, and linear_trend setup by
+        prepare.
+        """
+
+        entry = self.basis_entry
+        if (entry is None or
+                len(t) != len(entry['package'][9]) or
+                key_list != entry['key_list']):
+            return self.design_matrix(t, key_list)
+        name = ('X', bool(self.linear_trend))
+        if name not in entry:
+            entry[name] = self.design_matrix(t, key_list)
+            if self.basis_entry_key is not None:
+                # Account for the new array.
+                basis_cache.put(self.basis_entry_key, entry)
+        return entry[name]
+
+    def constituent_table(self, names, length, tidal_dict=None):
+        """
+        Returns the ConstituentTable of names from tidal_dict, which
+        defaults to self.tidal_dict.  The table of self.tidal_dict is kept
+        with the basis setup by prepare, and the tables of its first
+        constituents, such as the fitted constituents out of the fitted and
+        inferred constituents, are views of it.
+        """
+
+        entry = self.basis_entry
+        if (tidal_dict is not None or
+                entry is None or
+                entry['tidal_dict'] is not self.tidal_dict or
+                length != len(entry['package'][9])):
+            if tidal_dict is None:
+                tidal_dict = self.tidal_dict
+            return ConstituentTable(tidal_dict, names, length)
+        names = list(names)
+        table = entry.get('table')
+        if table is None or table.names[:len(names)] != names:
+            table = ConstituentTable(self.tidal_dict, names, length)
+            entry['table'] = table
+            if self.basis_entry_key is not None:
+                # Account for the new array.
+                basis_cache.put(self.basis_entry_key, entry)
+        return table.head(names)
+
+    def inference_matrix(self, key_list):
+        """
+        Returns (inferred_key_list, amplitude, phase) for the constituents
+        that can be inferred from those in key_list, where the inferred
+        amplitudes are np.dot(amplitude, H) and the inferred phases are
+        np.dot(phase, phases) for H and phases in key_list order.
+        """
 
-        self.inferred_key_list = []
+        inferred_key_list = []
+        rows = []
+        if self.include_inferred:
+            for (key, ref, ratio, pa, pb, k) in inference_table:
+                if pa not in key_list or pb not in key_list or key in key_list:
+                    continue
+                inferred_key_list.append(key)
+                rows.append((key_list.index(ref), ratio,
+                             key_list.index(pa), key_list.index(pb), k))
+        amplitude = np.zeros((len(rows), len(key_list)))
+        phase = np.zeros((len(rows), len(key_list)))
+        for index, (iref, ratio, ia, ib, k) in enumerate(rows):
+            amplitude[index, iref] = ratio
+            phase[index, ia] = phase[index, ia] + 1.0 + k
+            phase[index, ib] = phase[index, ib] - k
+        return inferred_key_list, amplitude, phase
+
+    def infer(self, H, phase, key_list):
+        """
+        Sets self.inferred_key_list, self.inferred_r and self.inferred_phase
+        for the constituents that could not be resolved by the record
+        length, based on the ratios to the major constituents in H and
+        phase.
+        """
+
+        (self.inferred_key_list,
+         amplitude,
+         phases) = self.inference_matrix(key_list)
         self.inferred_r = {}
         self.inferred_phase = {}
-        if self.include_inferred:
-            if 'O1' in key_list and 'K1' in key_list:
-                if 'J1' not in key_list:
-                    self.inferred_key_list.append('J1')
-                    self.inferred_r['J1'] = H['J1'] = 0.079 * H['O1']
-                    self.inferred_phase['J1'] = phase['J1'] = phase['K1'] + 0.496 * (phase['K1'] - phase['O1'])
-                # How should I handle this?  Shureman seems to confuse M1 and NO1
-                if 'M1' not in key_list:
-                    self.inferred_key_list.append('M1')
-                    self.inferred_r['M1'] = H['M1'] = 0.071 * H['O1']
-                    self.inferred_phase['M1'] = phase['M1'] = phase['K1'] - 0.5 * (phase['K1'] - phase['O1'])
-                if 'OO1' not in key_list:
-                    self.inferred_key_list.append('OO1')
-                    self.inferred_r['OO1'] = H['OO1'] = 0.043 * H['O1']
-                    self.inferred_phase['OO1'] = phase['OO1'] = phase['K1'] + 1.0 * (phase['K1'] - phase['O1'])
-                if 'P1' not in key_list:
-                    self.speed_dict["P1"] = self.tidal_dict["P1"]
-                    self.inferred_key_list.append('P1')
-                    self.inferred_r['P1'] = H['P1'] = 0.331 * H['K1']
-                    self.inferred_phase['P1'] = phase['P1'] = phase['K1'] - 0.075 * (phase['K1'] - phase['O1'])
-                if 'Q1' not in key_list:
-                    self.inferred_key_list.append('Q1')
-                    self.inferred_r['Q1'] = H['Q1'] = 0.194 * H['O1']
-                    self.inferred_phase['Q1'] = phase['Q1'] = phase['K1'] - 1.496 * (phase['K1'] - phase['O1'])
-                if '2Q1' not in key_list:
-                    self.inferred_key_list.append('2Q1')
-                    self.inferred_r['2Q1'] = H['2Q1'] = 0.026 * H['O1']
-                    self.inferred_phase['2Q1'] = phase['2Q1'] = phase['K1'] - 1.992 * (phase['K1'] - phase['O1'])
-                if 'rho1' not in key_list:
-                    self.inferred_key_list.append('rho1')
-                    self.inferred_r['rho1'] = H['rho1'] = 0.038 * H['O1']
-                    self.inferred_phase['rho1'] = phase['rho1'] = phase['K1'] - 1.429 * (phase['K1'] - phase['O1'])
-            if 'S2' in key_list and 'M2' in key_list:
-                if 'K2' not in key_list:
-                    self.inferred_key_list.append('K2')
-                    self.inferred_r['K2'] = H['K2'] = 0.272 * H['S2']
-                    self.inferred_phase['K2'] = phase['K2'] = phase['S2'] + 0.081 * (phase['S2'] - phase['M2'])
-                if 'L2' not in key_list:
-                    self.inferred_key_list.append('L2')
-                    self.inferred_r['L2'] = H['L2'] = 0.028 * H['M2']
-                    self.inferred_phase['L2'] = phase['L2'] = phase['S2'] - 0.464 * (phase['S2'] - phase['M2'])
-                if 'N2' not in key_list:
-                    self.inferred_key_list.append('N2')
-                    self.inferred_r['N2'] = H['N2'] = 0.194 * H['M2']
-                    self.inferred_phase['N2'] = phase['N2'] = phase['S2'] - 1.536 * (phase['S2'] - phase['M2'])
-                if '2N2' not in key_list:
-                    self.inferred_key_list.append('2N2')
-                    self.inferred_r['2N2'] = H['2N2'] = 0.026 * H['M2']
-                    self.inferred_phase['2N2'] = phase['2N2'] = phase['S2'] - 2.072 * (phase['S2'] - phase['M2'])
-                if 'R2' not in key_list:
-                    self.inferred_key_list.append('R2')
-                    self.inferred_r['R2'] = H['R2'] = 0.008 * H['S2']
-                    self.inferred_phase['R2'] = phase['R2'] = phase['S2'] + 0.040 * (phase['S2'] - phase['M2'])
-                if 'T2' not in key_list:
-                    self.inferred_key_list.append('T2')
-                    self.inferred_r['T2'] = H['T2'] = 0.059 * H['S2']
-                    self.inferred_phase['T2'] = phase['T2'] = phase['S2'] - 0.040 * (phase['S2'] - phase['M2'])
-                if 'lambda2' not in key_list:
-                    self.inferred_key_list.append('lambda2')
-                    self.inferred_r['lambda2'] = H['lambda2'] = 0.007 * H['M2']
-                    self.inferred_phase['lambda2'] = phase['lambda2'] = phase['S2'] - 0.536 * (phase['S2'] - phase['M2'])
-                if 'mu2' not in key_list:
-                    self.inferred_key_list.append('mu2')
-                    self.inferred_r['mu2'] = H['mu2'] = 0.024 * H['M2']
-                    self.inferred_phase['mu2'] = phase['mu2'] = phase['S2'] - 2.0 * (phase['S2'] - phase['M2'])
-                if 'nu2' not in key_list:
-                    self.inferred_key_list.append('nu2')
-                    self.inferred_r['nu2'] = H['nu2'] = 0.038 * H['M2']
-                    self.inferred_phase['nu2'] = phase['nu2'] = phase['S2'] - 1.464 * (phase['S2'] - phase['M2'])
-            for key in self.inferred_key_list:
-                if self.inferred_r[key] < 0:
-                    self.inferred_r[key] = abs(self.inferred_r[key])
-                    self.inferred_phase[key] = self.inferred_phase[key] + 180.0
-                try:
-                    self.inferred_phase[key] = np.mod(self.inferred_phase[key] + self.tidal_dict[key]['VAU'], 360)[0]
-                except IndexError:
-                    self.inferred_phase[key] = np.mod(self.inferred_phase[key] + self.tidal_dict[key]['VAU'], 360)
-
-
-        sumterm = np.zeros((len(t)))
-        for i in key_list + self.inferred_key_list:
-            sumterm = sumterm + H[i] * np.squeeze(ff[i]['FF']) * np.cos(self.tidal_dict[i]['speed'] * t - phase[i])
+        Hv = np.array([H[key] for key in key_list])
+        phasev = np.array([phase[key] for key in key_list])
+        for index, key in enumerate(self.inferred_key_list):
+            self.inferred_r[key] = np.dot(amplitude[index], Hv)
+            self.inferred_phase[key] = np.dot(phases[index], phasev)
+
+            # Written to also work on arrays of stations from
+            # batch_constituents.
+            negative = np.asarray(self.inferred_r[key]) < 0
+            self.inferred_r[key] = np.abs(self.inferred_r[key])
+            self.inferred_phase[key] = self.inferred_phase[key] + 180.0 * negative
+            self.inferred_phase[key] = np.mod(self.inferred_phase[key] + self.tidal_dict[key]['VAU'], 360)
+
+    def compile_fit(self, t, key_list):
+        """
+        Precompiles the arrays used by residuals and jacobian so that each
+        function evaluation is only a few array operations.  The inferred
+        constituents are included through the inference matrices, which map
+        the fitted amplitudes and phases to all of the constituents summed.
+        """
+
+        (inferred_key_list,
+         amplitude,
+         phase) = self.inference_matrix(key_list)
+        nkeys = len(key_list)
+        table = self.constituent_table(key_list + inferred_key_list, len(t))
+        self.fit = (np.vstack((np.identity(nkeys), amplitude)),
+                    np.vstack((np.identity(nkeys), phase)),
+                    np.outer(table.speed, t),
+                    table.FF)
+
+    def residuals(self, p, ht, t, key_list):
+        """
+        Used for least squares fit.  Requires compile_fit.
+        """
+
+        (amplitude, phase, angle, ff) = self.fit
+        nkeys = len(key_list)
+        H = np.dot(amplitude, p[:nkeys])
+        ph = np.dot(phase, p[nkeys:2 * nkeys])
+
+        sumterm = np.dot(H, ff * np.cos(angle - ph[:, np.newaxis]))
 
         if self.linear_trend:
             self.err = ht - (p[-2] * t + p[-1] + sumterm)
@@ -1140,45 +2450,263 @@ class tappy(Util):
 
         return self.err
 
+    def jacobian(self, p, ht, t, key_list):
+        """
+        Analytic Jacobian of residuals for the least squares fit, with one
+        row per parameter (leastsq col_deriv=1).  Requires compile_fit.
+        """
+
+        (amplitude, phase, angle, ff) = self.fit
+        nkeys = len(key_list)
+        H = np.dot(amplitude, p[:nkeys])
+        ph = np.dot(phase, p[nkeys:2 * nkeys])
+        arg = angle - ph[:, np.newaxis]
+
+        jac = np.zeros((len(p), len(t)))
+        jac[:nkeys] = -np.dot(amplitude.T, ff * np.cos(arg))
+        jac[nkeys:2 * nkeys] = -np.dot(phase.T, H[:, np.newaxis] * ff * np.sin(arg))
+        if self.linear_trend:
+            jac[-2] = -t
+        jac[-1] = -1.0
+        return jac
+
+    def design_matrix(self, t, key_list, tidal_dict=None):
+        """
+        Returns the harmonic basis as a 2-D array with one row per time in t.
+        Each constituent has an in-phase (cos) and a quadrature (sin) column
+        weighted by the node factor, followed by the columns for the linear
+        trend (if requested) and the average.  The speeds and node factors
+        come from tidal_dict, which defaults to self.tidal_dict.
+        """
+
+        nkeys = len(key_list)
+        ncols = 2 * nkeys + 1
+        if self.linear_trend:
+            ncols = ncols + 1
+        X = np.empty((len(t), ncols))
+        table = self.constituent_table(key_list, len(t), tidal_dict)
+        arg = np.outer(t, table.speed)
+        X[:, :nkeys] = table.FF.T * np.cos(arg)
+        X[:, nkeys:2 * nkeys] = table.FF.T * np.sin(arg)
+        if self.linear_trend:
+            X[:, -2] = t
+        X[:, -1] = 1.0
+        return X
+
+    def linear_leastsq(self, ht, t, key_list):
+        """
+        Linear least squares alternative to fitting residuals with leastsq.
+
+        Since H*cos(speed*t - phase) = a*cos(speed*t) + b*sin(speed*t) the
+        in-phase and quadrature coefficients a and b can be found in a single
+        solve, from which H = sqrt(a**2 + b**2) and phase = arctan2(b, a).
+
+        Unlike residuals, the sum doesn't include the inferred constituents.
+        Their phases are multiples of the fitted phases that aren't linear
+        in a and b, nor periodic in the fitted phases, so they are
+        calculated from the result by infer instead.
+
+        Returns the same parameter vector as leastsq:
+        [H..., phase..., slope, average].
+        """
+
+        X = self.cached_design_matrix(t, key_list)
+        coef = np.linalg.lstsq(X, ht, rcond=None)[0]
+        return self.harmonic_parameters(coef, key_list)
+
+    def harmonic_parameters(self, coef, key_list):
+        """
+        Converts the coefficients of the columns of design_matrix to the
+        parameter vector used by leastsq: [H..., phase..., slope, average].
+        If coef is 2-D, each column is a station.
+        """
+
+        nkeys = len(key_list)
+        a = coef[:nkeys]
+        b = coef[nkeys:2 * nkeys]
+        p = np.zeros((2 * nkeys + 2,) + coef.shape[1:])
+        p[:nkeys] = np.sqrt(a**2 + b**2)
+        p[nkeys:2 * nkeys] = np.arctan2(b, a)
+        if self.linear_trend:
+            p[-2] = coef[-2]
+        p[-1] = coef[-1]
+        return p
+
     # --------------------------
 
     def constituents(self):
-        difference = np.asarray(self.dates[1:]) - np.asarray(self.dates[:-1])
-        if np.any(difference < datetime.timedelta(seconds=0)):
+        difference = np.diff(datetime64_dates(self.dates))
+        if np.any(difference < np.timedelta64(0, 's')):
             print("Let's do the time warp again!")
             print("The date values reverse - they must be constantly increasing.")
             sys.exit()
 
-        p0 = [1.0] * (len(self.speed_dict) * 2 + 2)
+        if self.solver not in ['nonlinear', 'linear']:
+            print("solver must be one of 'nonlinear' (the default) or 'linear'")
+            sys.exit()
+
+        p0 = [1.0] * (len(self.key_list) * 2 + 2)
         p0[-2] = 0.0
         p0[-1] = np.average(self.elevation)
         self.ntimes = (self.jd - self.jd[0]) * 24
 
-        lsfit = leastsq(self.residuals, p0, args=(np.array(self.elevation), np.array(self.ntimes), self.key_list))
+        if self.solver == 'linear':
+            lsfit = self.linear_leastsq(np.array(self.elevation),
+                                        np.array(self.ntimes),
+                                        self.key_list)
+            self.linear_constituents(lsfit)
+        else:
+            from scipy.optimize import leastsq
+
+            self.compile_fit(np.array(self.ntimes), self.key_list)
+            lsfit = leastsq(self.residuals, p0, args=(np.array(self.elevation), np.array(self.ntimes), self.key_list), Dfun=self.jacobian, col_deriv=1)[0]
+            H = {}
+            phase = {}
+            for index, key in enumerate(self.key_list):
+                H[key] = lsfit[index]
+                phase[key] = lsfit[index + len(self.key_list)]
+            self.infer(H, phase, self.key_list)
+            self.set_constituents(lsfit)
+            self.fitted_average = p0[-1]
+            self.slope = p0[-2]
+        # Should probably return something rather than change self.*
+
+    def online_start(self, forgetting=1.0):
+        """
+        Starts incremental updates of the analysis of self.dates and
+        self.elevation with online_update.  The linear least squares
+        solution and the inverse of its information matrix are kept, and
+        forgetting (between 0 and 1) exponentially down weights older
+        observations as new ones are added.
+        """
+
+        self.ntimes = (self.jd - self.jd[0]) * 24
+        X = self.cached_design_matrix(np.array(self.ntimes), self.key_list)
+        P = np.linalg.pinv(np.dot(X.T, X))
+        coef = np.dot(P, np.dot(X.T, np.asarray(self.elevation, dtype='f8')))
+        self.rls = RecursiveLeastSquares(coef, P, forgetting=forgetting)
+        self.linear_constituents(self.harmonic_parameters(coef, self.key_list))
+
+    def online_update(self, dates, elevation):
+        """
+        Folds new observations into the analysis started by online_start
+        and updates the constituents, average, and slope.  The constituents
+        analyzed don't change, and self.dates and self.elevation are not
+        extended.
+        """
+
+        package = self.astronomic(dates)
+        tidal_dict = self.tidal_table(len(dates), package)
+        ntimes = (package[9] - self.jd[0]) * 24
+        X = self.design_matrix(ntimes, self.key_list, tidal_dict)
+        for x, y in zip(X, np.asarray(elevation, dtype='f8')):
+            self.rls.update(x, y)
+        self.linear_constituents(self.harmonic_parameters(self.rls.coef,
+                                                          self.key_list))
+
+    def batch_constituents(self, elevation):
+        """
+        Linear least squares analysis of many stations that share the same
+        dates, for example the nodes of a model grid.  The elevation is a 2-D
+        array with one row per date in self.dates and one column per station.
+        The harmonic basis is built and factored once and all of the stations
+        are solved together.
+
+        Sets self.r, self.phase, self.inferred_r, and self.inferred_phase as
+        dictionaries of arrays with one value per station, and
+        self.fitted_average and self.slope as arrays.  Returns (self.r,
+        self.phase).
+        """
+
+        self.ntimes = (self.jd - self.jd[0]) * 24
+        X = self.cached_design_matrix(np.array(self.ntimes), self.key_list)
+        coef = np.linalg.lstsq(X, np.asarray(elevation, dtype='f8'),
+                               rcond=None)[0]
+        self.linear_constituents(self.harmonic_parameters(coef, self.key_list))
+        return self.r, self.phase
+
+    def linear_constituents(self, lsfit):
+        """
+        Sets the constituents, average, and slope from the parameter vector
+        of a linear fit.  The inferred constituents are not part of the
+        linear fit, but are calculated from the fitted constituents, so the
+        fitted constituents are those of the nonlinear solver without
+        include_inferred.
+        """
+
+        H = {}
+        phase = {}
+        for index, key in enumerate(self.key_list):
+            H[key] = lsfit[index]
+            phase[key] = lsfit[index + len(self.key_list)]
+        self.infer(H, phase, self.key_list)
+        self.set_constituents(lsfit)
+        self.fitted_average = lsfit[-1]
+        self.slope = lsfit[-2]
+
+    def set_constituents(self, lsfit):
+        """
+        Sets self.r and self.phase from the fitted parameter vector, moving
+        the phase from the start of the record to Greenwich with V + u.
+        """
 
         self.r = {}
         self.phase = {}
         for index, key in enumerate(self.key_list):
-            self.r[key] = lsfit[0][index]
-            self.phase[key] = lsfit[0][index + len(self.key_list)] * rad2deg
+            self.r[key] = lsfit[index]
+            self.phase[key] = lsfit[index + len(self.key_list)] * rad2deg
+
+            # Written to also work on arrays of stations from
+            # batch_constituents.
+            negative = np.asarray(self.r[key]) < 0
+            self.r[key] = np.abs(self.r[key])
+            self.phase[key] = self.phase[key] + 180 * negative
+            self.phase[key] = np.mod(self.phase[key] + self.speed_dict[key]['VAU'], 360)
+
+    def streaming_constituents(self, chunks, start_date, end_date,
+                               rayleigh_comp=1.0, interval=None):
+        """
+        Linear least squares analysis of a record that is too large to hold
+        in memory.  The chunks are an iterable of (dates, elevation) arrays,
+        for example from open_chunks, that together cover start_date to
+        end_date.  Only the normal equations are kept between chunks, so
+        memory depends on the number of constituents, not the record length.
+        The 'auto' selection needs the sampling interval in minutes.
+        """
 
-            if self.r[key] < 0:
-                self.r[key] = abs(self.r[key])
-                self.phase[key] = self.phase[key] + 180
-            try:
-                self.phase[key] = np.mod(self.phase[key] + self.speed_dict[key]['VAU'], 360)[0]
-            except IndexError:
-                self.phase[key] = np.mod(self.phase[key] + self.speed_dict[key]['VAU'], 360)
+        if self.selection == 'auto' and interval is None:
+            print("The 'auto' selection needs the sampling interval of the chunks")
+            sys.exit()
+        self.dates = np.array([start_date, end_date])
+        package = self.astronomic(self.dates)
+        (self.zeta, self.nu, self.nup, self.nupp, self.kap_p, self.ii, self.R, self.Q, self.T, self.jd, self.s, self.h, self.N, self.p, self.p1) = package
+        (self.speed_dict, self.key_list) = self.which_constituents(len(self.dates),
+                                                                  package,
+                                                                  rayleigh_comp=rayleigh_comp,
+                                                                  interval=interval)
+
+        ncols = 2 * len(self.key_list) + 1
+        if self.linear_trend:
+            ncols = ncols + 1
+        normal = NormalEquations(ncols)
+        for dates, elevation in chunks:
+            package = self.astronomic(dates)
+            # Node factors for this chunk.  The speeds are always for the
+            # start of the record.
+            tidal_dict = self.tidal_table(len(dates), package)
+            ntimes = (package[9] - self.jd[0]) * 24
+            normal.add(self.design_matrix(ntimes, self.key_list, tidal_dict),
+                       np.asarray(elevation, dtype='f8'))
 
-        self.fitted_average = p0[-1]
-        self.slope = p0[-2]
-        # Should probably return something rather than change self.*
+        lsfit = self.harmonic_parameters(normal.solve(), self.key_list)
+        self.linear_constituents(lsfit)
 
     def cat_dates(self, dates, len_dates):
+        dates = datetime64_dates(dates)
         interval = dates[1:] - dates[:-1]
         interval.sort()
-        interval = interval[len(interval) / 2]
-        cnt = np.arange(1, len_dates + 1) * datetime.timedelta(minutes=interval.seconds / 60)
+        interval = interval[len(interval) // 2]
+        cnt = np.arange(1, len_dates + 1) * interval
         bdate = dates[0] - cnt[::-1]
         edate = dates[-1] + cnt
         return np.concatenate((bdate, dates, edate))
@@ -1191,13 +2719,15 @@ class tappy(Util):
 
         if self.pad_filters == "tide":
             tnelevation = np.concatenate((np.array([np.average(nelevation[0:half_kern])]), nelevation, np.array([np.average(nelevation[-half_kern:])])))
+            ndates = datetime64_dates(ndates)
             interval = ndates[1:] - ndates[:-1]
             interval.sort()
-            interval = interval[len(interval) / 2]
-            deltat = datetime.timedelta(minutes=interval.seconds / 60)
-            tndates = np.concatenate((np.array([ndates[0] - blen * deltat]), ndates, np.array([ndates[-1] + alen * deltat])))
+            deltat = interval[len(interval) // 2]
+            tndates = np.concatenate(([ndates[0] - blen * deltat], ndates, [ndates[-1] + alen * deltat]))
             (cndates, nelevation) = self.missing('fill', tndates, tnelevation)
 
+        from numpy import pad
+
         if self.pad_filters == "minimum":
             nelevation = pad.minimum(nelevation, (blen, alen))
         if self.pad_filters == "maximum":
@@ -1223,8 +2753,55 @@ class tappy(Util):
     def delta_sum(self, elev, delta):
         return elev[delta:] + elev[:-delta]
 
+    def mstha(self, dates, elevation):
+        """
+        Multiple short term harmonic analysis of hourly dates and elevation
+        over a sliding 25 hour window.  Returns the dates and, at the center
+        of each window, the fitted average, the fitted slope in elevation
+        per hour, and dictionaries of the amplitude and phase in degrees of
+        M2, K1, M3 and M4 relative to the center of the window.  Since the
+        window and its times are always the same the linear least squares
+        fit is a constant projection (the pseudo-inverse of the window's
+        design matrix), so each fitted parameter is a correlation of the
+        series with a row of it.
+        """
+
+        blen = 12
+        s_list = ['M2', 'K1', 'M3', 'M4']
+        nkeys = len(s_list)
+
+        (dates, elevation) = self.missing('fill', datetime64_dates(dates),
+                                          np.asarray(elevation, dtype='f8'))
+        new_dates = np.concatenate(([dates[0] - np.timedelta64(blen, 'h')],
+                                    dates,
+                                    [dates[-1] + np.timedelta64(blen, 'h')]))
+        new_elevation = np.concatenate(([elevation[0]],
+                                        elevation,
+                                        [elevation[-1]]))
+        (new_dates, new_elev) = self.missing('fill', new_dates, new_elevation)
+
+        # Times relative to the center of the window.
+        ntimes = np.arange(-blen, blen + 1, dtype='f8')
+        X = np.empty((len(ntimes), 2 * nkeys + 2))
+        for index, key in enumerate(s_list):
+            X[:, index] = np.cos(self.tidal_dict[key]['speed'] * ntimes)
+            X[:, index + nkeys] = np.sin(self.tidal_dict[key]['speed'] * ntimes)
+        X[:, -2] = ntimes
+        X[:, -1] = 1.0
+        fit = [np.correlate(new_elev, row, mode='valid')
+               for row in np.linalg.pinv(X)]
+
+        r = {}
+        phase = {}
+        for index, key in enumerate(s_list):
+            (a, b) = (fit[index], fit[index + nkeys])
+            r[key] = np.hypot(a, b)
+            phase[key] = np.mod(np.arctan2(b, a) * rad2deg, 360)
+        return dates, fit[-1], fit[-2], r, phase
+
     def filters(self, nstype, dates, elevation, pad_type=None):
-        delta_dt = datetime.timedelta(hours=1)
+        dates = datetime64_dates(dates)
+        delta_dt = np.timedelta64(3600, 's')
 
         # For the time being the filters and padding can only work on hourly data.
 
@@ -1237,26 +2814,20 @@ class tappy(Util):
         nelevation = elevation
         if np.any(interval < delta_dt):
 
-            # Probably the worst way you can get the average for the hour...
-
-            dt = dates[0]
-            dates_filled = []
-            while dt <= (dates[-1] + datetime.timedelta(minutes=1)):
-                dates_filled.append(dt)
-                dt = dt + delta_dt
-            dates_filled = np.array(dates_filled)
-
-            new_elev = []
-            ind = []
-            for index, d in enumerate(dates_filled):
-                sl = np.logical_and(dates > datetime.datetime(d.year, d.month, d.day, d.hour) - delta_dt/2, dates <= d + delta_dt/2)
-                if len(elevation[sl]) == 0:
-                    continue
-                ind.append(index)
-                new_elev.append(np.average(elevation[sl]))
+            # The average of the values from half an hour before the hour to
+            # half an hour after each date.  The dates are increasing, so
+            # each average is of a slice.
+            dates_filled = np.arange(dates[0],
+                                     dates[-1] + np.timedelta64(61, 's'),
+                                     delta_dt)
+            hour = dates_filled.astype('datetime64[h]').astype('datetime64[s]')
+            first = np.searchsorted(dates, hour - delta_dt // 2, side='right')
+            last = np.searchsorted(dates, dates_filled + delta_dt // 2, side='right')
+            ind = np.flatnonzero(last > first)
 
             dates_filled = dates_filled[ind]
-            nelevation = np.array(new_elev)
+            nelevation = np.array([np.average(elevation[first[index]:last[index]])
+                                   for index in ind])
         dates_filled, nelevation = self.missing('fill', dates_filled, nelevation)
         relevation = np.empty_like(nelevation)
 
@@ -1413,29 +2984,8 @@ class tappy(Util):
             return dates_filled[nslice], relevation[nslice]
 
         if nstype == 'mstha':
-            blen = 12
-            s_list = ['M2', 'K1', 'M3', 'M4']
-
-            p0 = [1.0] * (len(s_list) * 2 + 2)
-            p0[-2] = 0.0
-            new_dates = np.concatenate(([ndates[0] - datetime.timedelta(hours=blen)],
-                                        ndates,
-                                        [ndates[-1] + datetime.timedelta(hours=blen)]))
-            new_elevation = np.concatenate(([nelevation[0]],
-                                            nelevation,
-                                            [nelevation[-1]]))
-            (new_dates, new_elev) = self.missing('fill', new_dates, new_elevation)
-            slope = []
-            new_dates = self.dates2jd(new_dates)
-            ntimes = np.arange(2 * blen + 1)
-            for d in range(len(new_dates))[blen:-blen]:
-                # ntimes = (new_dates[d-12:d+12] - new_dates[d]) * 24
-                nelev = new_elev[d-blen:d+blen+1]
-                lsfit = leastsq(self.residuals, p0, args=(nelev, ntimes, s_list))
-                slope.append(lsfit[0][-2])
-
-            relevation = slope
-            return dates_filled[nslice], relevation[nslice]
+            (dates_filled, average, slope, r, phase) = self.mstha(dates_filled, nelevation)
+            return dates_filled, average
 
         if nstype == 'wavelet':
             import pywt
@@ -1663,7 +3213,7 @@ class tappy(Util):
         pass
 
 
-def TAPPY(data, noisy=False):
+def TAPPY(data, noisy=False, solver='nonlinear'):
     """
     Uses a slightly modified version of TAPPY which can be imported as a module
     to perform the harmonic analysis. The returned arrays are identical in
@@ -1675,6 +3225,12 @@ def TAPPY(data, noisy=False):
     data : ndarray
         Array of [YYYY, MM, DD, hh, mm, ss, ZZ], where ZZ is time series data
         (e.g. surface elevation, velocity components etc.).
+    noisy : bool, optional
+        Set to True to enable verbose output.
+    solver : str, optional
+        Least squares method, one of 'nonlinear' (the default) or 'linear'.
+        'linear' calculates the inferred constituents after the fit rather
+        than fitting them.
 
     Returns
     -------
@@ -1710,20 +3266,21 @@ def TAPPY(data, noisy=False):
     include_inferred = True
 
     # Create a tappy object.
-    x = tappy.tappy(outputts=outputts,
-                    outputxml=outputxml,
-                    quiet=quiet,
-                    debug=debug,
-                    ephemeris=ephemeris,
-                    rayleigh=rayleigh,
-                    print_vau_table=print_vau_table,
-                    missing_data=missing_data,
-                    linear_trend=linear_trend,
-                    remove_extreme=remove_extreme,
-                    zero_ts=zero_ts,
-                    filter=filter,
-                    pad_filters=pad_filters,
-                    include_inferred=include_inferred)
+    x = tappy(outputts=outputts,
+              outputxml=outputxml,
+              quiet=quiet,
+              debug=debug,
+              ephemeris=ephemeris,
+              rayleigh=rayleigh,
+              print_vau_table=print_vau_table,
+              missing_data=missing_data,
+              linear_trend=linear_trend,
+              remove_extreme=remove_extreme,
+              zero_ts=zero_ts,
+              filter=filter,
+              pad_filters=pad_filters,
+              include_inferred=include_inferred,
+              solver=solver)
 
     # Add the time series to the TAPPY object
     x.dates = []
@@ -1736,16 +3293,11 @@ def TAPPY(data, noisy=False):
     x.dates = np.asarray(x.dates)
     x.elevation = np.asarray(x.elevation)
 
-    package = x.astronomic(x.dates)
-    (x.zeta, x.nu, x.nup, x.nupp, x.kap_p, x.ii, x.R, x.Q, x.T, x.jd, x.s, x.h, x.N, x.p, x.p1) = package
-
     if rayleigh:
         ray = float(rayleigh)
     else:
         ray = 1.0
-    (x.speed_dict, x.key_list) = x.which_constituents(len(x.dates),
-                                                      package,
-                                                      rayleigh_comp=ray)
+    x.prepare(rayleigh_comp=ray)
 
     x.constituents()  # the analysis
 
@@ -1763,7 +3315,7 @@ def TAPPY(data, noisy=False):
     klist = [i[0] for i in x.sortbyvalue(ndict)]
     for i in klist:
         cName.append(i)
-        cSpeed.append(x.speed_dict[i]['speed'] * tappy.rad2deg)
+        cSpeed.append(x.speed_dict[i]['speed'] * rad2deg)
         cPhase.append(x.phase[i])
         cAmplitude.append(x.r[i])
         cInference.append(False)
@@ -1775,7 +3327,7 @@ def TAPPY(data, noisy=False):
     klist = [i[0] for i in x.sortbyvalue(ndict)]
     for i in klist:
         cName.append(i)
-        cSpeed.append(x.tidal_dict[i]['speed'] * tappy.rad2deg)
+        cSpeed.append(x.tidal_dict[i]['speed'] * rad2deg)
         cPhase.append(x.inferred_phase[i])
         cAmplitude.append(x.inferred_r[i])
         cInference.append(True)
@@ -1783,6 +3335,495 @@ def TAPPY(data, noisy=False):
     return cName, cSpeed, cPhase, cAmplitude, cInference
 
 
+def parallel_options(**kwds):
+    """
+    Returns the tappy options for parallel_constituents with the same
+    defaults as TAPPY, updated with kwds.
+    """
+
+    options = dict(quiet=True,
+                   debug=False,
+                   outputts=False,
+                   outputxml=False,
+                   ephemeris=False,
+                   rayleigh=1.0,
+                   print_vau_table=False,
+                   missing_data='ignore',
+                   linear_trend=False,
+                   remove_extreme=False,
+                   zero_ts=None,
+                   filter=None,
+                   pad_filters=None,
+                   include_inferred=True,
+                   solver='nonlinear')
+    options.update(kwds)
+    return options
+
+
+# Set in each worker process by parallel_init.
+parallel_state = None
+
+
+def parallel_init(ephemeris_name, elevation_name, shape, dates, T, options):
+    """
+    Initializes a parallel_constituents worker process.  The ephemeris and
+    elevation arrays are attached from shared memory rather than pickled.
+    """
+
+    from multiprocessing import shared_memory
+
+    global parallel_state
+
+    ephemeris_shm = shared_memory.SharedMemory(name=ephemeris_name)
+    elevation_shm = shared_memory.SharedMemory(name=elevation_name)
+    ephemeris = np.ndarray((14, shape[0]), dtype='f8', buffer=ephemeris_shm.buf)
+    elevation = np.ndarray(shape, dtype='f8', buffer=elevation_shm.buf)
+
+    package = tuple(ephemeris[:8]) + (T,) + tuple(ephemeris[8:])
+
+    x = tappy(**options)
+    # Only the first and last dates are needed, the times come from jd.
+    x.dates = np.array(dates)
+    (speed_dict, key_list) = x.which_constituents(shape[0],
+                                                  package,
+                                                  rayleigh_comp=float(options['rayleigh']))
+
+    # Keep the SharedMemory objects so the buffers stay attached.
+    parallel_state = (elevation, options, x.dates, package,
+                      x.tidal_dict, speed_dict, key_list,
+                      ephemeris_shm, elevation_shm)
+
+
+def parallel_station(station):
+    """
+    Analyzes one column of the shared elevation array in a worker process.
+    Each station gets a new tappy and its own copies of the constituents
+    so that nothing left by the analysis of one station is used by the
+    next.
+    """
+
+    (elevation, options, dates, package,
+     tidal_dict, speed_dict, key_list) = parallel_state[:7]
+    x = tappy(**options)
+    x.dates = dates
+    (x.zeta, x.nu, x.nup, x.nupp, x.kap_p, x.ii, x.R, x.Q, x.T, x.jd, x.s, x.h, x.N, x.p, x.p1) = package
+    x.tidal_dict = tidal_dict
+    x.speed_dict = copy.deepcopy(speed_dict)
+    x.key_list = list(key_list)
+    x.elevation = np.array(elevation[:, station])
+    x.constituents()
+    return (x.r, x.phase, x.inferred_r, x.inferred_phase, x.fitted_average,
+            x.slope)
+
+
+def parallel_constituents(dates, elevation, workers=None, **kwds):
+    """
+    Analyzes many stations that share the same dates in a pool of worker
+    processes, one station per column of elevation.  The ephemeris is
+    calculated once and, with the elevation, placed in shared memory so that
+    the workers do not have to pickle the large arrays.
+
+    Parameters
+    ----------
+    dates : ndarray
+        Increasing datetime.datetime dates shared by all of the stations.
+    elevation : ndarray
+        Array of elevations with one row per date and one column per
+        station.
+    workers : int, optional
+        Number of worker processes.  The default is the number of CPUs.
+    kwds : optional
+        Options passed to tappy, for example solver='linear'.  The defaults
+        are the same as TAPPY.
+
+    Returns
+    -------
+    results : list
+        One (r, phase, inferred_r, inferred_phase, fitted_average, slope)
+        tuple per station, in the same order as the columns of elevation.
+
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    options = parallel_options(**kwds)
+    elevation = np.asarray(elevation, dtype='f8')
+    if elevation.ndim == 1:
+        elevation = elevation[:, np.newaxis]
+
+    difference = np.diff(datetime64_dates(dates))
+    if np.any(difference < np.timedelta64(0, 's')):
+        print("Let's do the time warp again!")
+        print("The date values reverse - they must be constantly increasing.")
+        sys.exit()
+
+    x = tappy(**options)
+    package = x.astronomic(dates)
+    T = package[8]
+    arrays = package[:8] + package[9:]
+
+    ephemeris_shm = shared_memory.SharedMemory(create=True,
+                                               size=14 * len(dates) * 8)
+    elevation_shm = shared_memory.SharedMemory(create=True,
+                                               size=elevation.nbytes)
+    ephemeris = np.ndarray((14, len(dates)), dtype='f8',
+                           buffer=ephemeris_shm.buf)
+    shared = np.ndarray(elevation.shape, dtype='f8', buffer=elevation_shm.buf)
+    try:
+        for index, item in enumerate(arrays):
+            ephemeris[index] = item
+        shared[:] = elevation
+
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=parallel_init,
+                initargs=(ephemeris_shm.name,
+                          elevation_shm.name,
+                          elevation.shape,
+                          [dates[0], dates[-1]],
+                          T,
+                          options)) as executor:
+            chunksize = max(1, elevation.shape[1] // (4 * (workers or os.cpu_count() or 1)))
+            results = list(executor.map(parallel_station,
+                                        range(elevation.shape[1]),
+                                        chunksize=chunksize))
+    finally:
+        # The views have to go before the shared memory can be closed.
+        del ephemeris, shared
+        ephemeris_shm.close()
+        ephemeris_shm.unlink()
+        elevation_shm.close()
+        elevation_shm.unlink()
+
+    return results
+
+
+def read_constituents(xml_filename, include_inferred=True):
+    """
+    Reads the constituents from an IHOTC XML transfer format file.
+
+    Parameters
+    ----------
+    xml_filename : str
+        The tidal constituents in IHOTC XML transfer format.
+    include_inferred : bool, optional
+        Include the inferred constituents.
+
+    Returns
+    -------
+    r : dict
+        Amplitude of each constituent.
+    phase : dict
+        Phase in degrees of each constituent.
+    key_list : list
+        The constituent names in the order of the file.
+
+    """
+
+    import xml.etree.ElementTree as et
+    tree = et.parse(xml_filename)
+    root = tree.getroot()
+    rin = {}
+    phasein = {}
+    skey_list = []
+    for constituent in root.iter('Harmonic'):
+        inf = constituent.findtext('inferred')
+        if (not include_inferred) and (inf.lower() == 'true'):
+            continue
+        nam = constituent.findtext('name')
+        amp = constituent.findtext('amplitude')
+        pha = constituent.findtext('phaseAngle')
+        rin[nam] = float(amp)
+        phasein[nam] = float(pha)
+        skey_list.append(nam)
+    return rin, phasein, skey_list
+
+
+def read_stations(xml_filenames, include_inferred=True):
+    """
+    Reads the constituents of many stations.
+
+    Parameters
+    ----------
+    xml_filenames : str
+        IHOTC XML transfer format file names or glob patterns separated by
+        commas.
+    include_inferred : bool, optional
+        Include the inferred constituents.
+
+    Returns
+    -------
+    names : list
+        The file names without directory or extension.
+    stations : list
+        One (r, phase) pair of dictionaries per file.
+
+    """
+
+    import glob
+
+    filenames = []
+    for pattern in xml_filenames.split(','):
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print("No files match %s" % pattern, file=sys.stderr)
+            sys.exit(1)
+        filenames.extend(matches)
+    stations = []
+    for filename in filenames:
+        (rin, phasein, skey_list) = read_constituents(
+            filename, include_inferred=include_inferred)
+        stations.append((rin, phasein))
+    names = [os.path.splitext(os.path.basename(filename))[0]
+             for filename in filenames]
+    return names, stations
+
+
+def station_coefficients(stations):
+    """
+    Returns the sorted constituents of all of the stations, the matrix with
+    one row per station of R * cos(phase) of each constituent followed by
+    R * sin(phase) of each constituent, and the column of Z0 of each
+    station, so that a station's heights are its row times the stacked
+    FF * cos(speed * t + VAU) and FF * sin(speed * t + VAU), plus Z0.
+    """
+
+    keys = sorted(set(key for (r, phase) in stations for key in r
+                      if key != 'Z0'))
+    index = dict((key, i) for i, key in enumerate(keys))
+    # cos(speed * t + VAU - phase) = cos(phase) * cos(speed * t + VAU) +
+    # sin(phase) * sin(speed * t + VAU)
+    coefficients = np.zeros((len(stations), 2 * len(keys)))
+    mean = np.zeros((len(stations), 1))
+    for row, (r, phase) in enumerate(stations):
+        for key in r:
+            if key == 'Z0':
+                mean[row] = r[key]
+                continue
+            coefficients[row, index[key]] = r[key] * np.cos(phase[key] * deg2rad)
+            coefficients[row, len(keys) + index[key]] = r[key] * np.sin(phase[key] * deg2rad)
+    return keys, coefficients, mean
+
+
+def predict_stations(stations, start_date, end_date, interval, chunk=100000,
+                     dtype=np.float64, **options):
+    """
+    Generator of the predictions of many stations over the same dates, in
+    blocks of at most chunk dates as Util.predict_iter.  The ephemeris, node
+    factors, and V + u are calculated once per block for all of the
+    stations, and the heights of all of the stations are one matrix product
+    of the station coefficients with the constituent signals.
+
+    Parameters
+    ----------
+    stations : list
+        One (r, phase) pair of dictionaries per station, as returned by
+        read_constituents.  Z0 is added to the heights if it is in r.
+    start_date : datetime.datetime
+        First date of the prediction.
+    end_date : datetime.datetime
+        Last date of the prediction.
+    interval : int
+        Minutes between dates.
+    chunk : int, optional
+        Most dates in each block.
+    dtype : dtype, optional
+        Type of the heights, np.float32 is faster.
+    options : optional
+        Util options such as ephemeris_backend or node_interval.
+
+    Yields
+    ------
+    dates : ndarray
+        The dates of the block.
+    heights : ndarray
+        Array with one row per station and one column per date.
+
+    """
+
+    (keys, coefficients, mean) = station_coefficients(stations)
+    coefficients = coefficients.astype(dtype)
+
+    u = Util(None, None)
+    for name, value in options.items():
+        setattr(u, name, value)
+    (start, step, length) = time_grid(start_date, end_date, interval)
+    for begin in range(0, length, chunk):
+        dates = start + np.arange(begin, min(begin + chunk, length)) * step
+        u.dates = dates
+        package = u.astronomic(dates)
+        table = ConstituentTable(u.tidal_table(len(dates), package), keys,
+                                 len(dates))
+        hours = np.arange(len(dates), dtype=np.float64) * interval / 60.0
+        arg = np.outer(table.speed, hours) + table.VAU[:, np.newaxis] * deg2rad
+        signals = np.vstack([table.FF * np.cos(arg),
+                             table.FF * np.sin(arg)]).astype(dtype)
+        heights = np.dot(coefficients, signals)
+        heights += mean
+        yield dates, heights
+
+
+def predict_extrema(stations, start_date, end_date, interval=60,
+                    chunk=100000, steps=1, **options):
+    """
+    Returns the high and low waters of many stations from start_date to
+    end_date.  The time derivative of the harmonic sum is calculated
+    analytically every interval minutes, each change of its sign brackets a
+    high or low water, and the time of each is refined from the secant
+    between the bracketing dates with Halley steps on the derivative, which
+    also use its analytic second and third derivatives.  One step finds the
+    times to about a second from an hourly search.  The ephemeris and V + u
+    are calculated once per block of chunk dates for all of the stations,
+    and the node factors are taken from the start of each bracket.
+
+    Parameters
+    ----------
+    stations : list
+        One (r, phase) pair of dictionaries per station, as returned by
+        read_constituents.  Z0 is added to the heights if it is in r.
+    start_date : datetime.datetime
+        First date of the search.
+    end_date : datetime.datetime
+        Last date of the search.
+    interval : int, optional
+        Minutes between the dates where the derivative is calculated.  It
+        has to be less than the time between a high and the next low water,
+        or both are missed, so it needs to be smaller where shallow water
+        constituents give double high or low waters.
+    chunk : int, optional
+        Most dates in each block.
+    steps : int, optional
+        Number of Halley steps.
+    options : optional
+        Util options such as ephemeris_backend or node_interval.
+
+    Returns
+    -------
+    extrema : list
+        One (dates, heights, highs) tuple per station of the
+        numpy.datetime64 dates to the second, the heights, and whether each
+        is a high water.
+
+    """
+
+    (keys, coefficients, mean) = station_coefficients(stations)
+    nkeys = len(keys)
+
+    u = Util(None, None)
+    for name, value in options.items():
+        setattr(u, name, value)
+    (start, step, length) = time_grid(start_date, end_date, interval)
+    last = np.datetime64(end_date, 's')
+    found = [[] for station in stations]
+    # Consecutive blocks share a date, so that every pair of dates is
+    # searched once.
+    for begin in range(0, max(length - 1, 1), chunk):
+        end = min(begin + chunk, length - 1)
+        dates = start + np.arange(begin, end + 1) * step
+        u.dates = dates
+        package = u.astronomic(dates)
+        table = ConstituentTable(u.tidal_table(len(dates), package), keys,
+                                 len(dates))
+        speed = table.speed[:, np.newaxis]
+        VAU = table.VAU[:, np.newaxis] * deg2rad
+        hours = np.arange(len(dates), dtype=np.float64) * interval / 60.0
+        arg = speed * hours + VAU
+        # d/dt cos(speed * t + VAU - phase) in the same form.
+        slope = np.dot(coefficients,
+                       np.vstack([-speed * table.FF * np.sin(arg),
+                                  speed * table.FF * np.cos(arg)]))
+        rising = slope > 0
+        (station, index) = np.nonzero(rising[:, :-1] != rising[:, 1:])
+        if len(index) == 0:
+            continue
+
+        before = slope[station, index]
+        after = slope[station, index + 1]
+        lower = hours[index]
+        upper = hours[index + 1]
+        t = lower + (upper - lower) * before / (before - after)
+        heights = np.empty(len(t))
+        # Small groups of brackets stay in the processor cache.
+        group = max(1, 2**16 // nkeys)
+        for first in range(0, len(t), group):
+            sl = slice(first, first + group)
+            ff = table.FF[:, index[sl]]
+            cc = coefficients[station[sl], :nkeys].T * ff
+            cs = coefficients[station[sl], nkeys:].T * ff
+            for i in range(steps + 1):
+                arg = speed * t[sl] + VAU
+                c = np.cos(arg)
+                s = np.sin(arg, out=arg)
+                # The terms of the height, and of the derivative divided
+                # by the speeds.
+                x = cc * c
+                x += cs * s
+                if i == steps:
+                    break
+                y = cs * c
+                y -= cc * s
+                # Halley's step on the first derivative.
+                d1 = np.dot(table.speed, y)
+                d2 = -np.dot(table.speed**2, x)
+                d3 = -np.dot(table.speed**3, y)
+                denominator = 2 * d2**2 - d1 * d3
+                denominator[denominator == 0] = np.inf
+                t[sl] = np.clip(t[sl] - 2 * d1 * d2 / denominator,
+                                lower[sl], upper[sl])
+            heights[sl] = np.sum(x, axis=0) + mean[station[sl], 0]
+
+        extreme_dates = dates[0] + (np.round(t * 3600).astype(np.int64) *
+                                    np.timedelta64(1, 's'))
+        highs = rising[station, index]
+        keep = extreme_dates <= last
+        (station, extreme_dates, heights, highs) = (
+            station[keep], extreme_dates[keep], heights[keep], highs[keep])
+        # np.nonzero gives the brackets in the order of the stations.
+        bounds = np.searchsorted(station, np.arange(len(stations) + 1))
+        for row in range(len(stations)):
+            sl = slice(bounds[row], bounds[row + 1])
+            found[row].append((extreme_dates[sl], heights[sl], highs[sl]))
+
+    extrema = []
+    for blocks in found:
+        if blocks:
+            extrema.append(tuple(np.concatenate(parts)
+                                 for parts in zip(*blocks)))
+        else:
+            extrema.append((np.array([], dtype='datetime64[s]'),
+                            np.array([]), np.array([], dtype=bool)))
+    return extrema
+
+
+# The Util options that a prediction_init worker copies.
+prediction_options = ['ephemeris_backend', 'node_interval', 'node_tolerance',
+                      'node_table']
+
+# Set in each worker process by prediction_init.
+prediction_state = None
+
+
+def prediction_init(r, phase, options):
+    """
+    Initializes a Util.predict_iter worker process.
+    """
+
+    global prediction_state
+
+    prediction_state = Util(r, phase)
+    for name, value in options.items():
+        setattr(prediction_state, name, value)
+
+
+def prediction_block(*args, **kwds):
+    """
+    Calculates one block of Util.predict_iter in a worker process.
+    """
+
+    return prediction_state.predict_block(*args, **kwds)
+
+
 def run_TAPPY(data, sparseDef=False, noisy=False, deleteFile=True, tappy='/usr/bin/tappy.py'):
     """
     A simple wrapper to perform a harmonic analysis on the supplied data.
@@ -1867,6 +3908,8 @@ def run_TAPPY(data, sparseDef=False, noisy=False, deleteFile=True, tappy='/usr/b
 
 if __name__ == '__main__':
 
+    import baker
+
     @baker.command()
     def writeconfig(iniconffile=sys.argv[0] + '.ini'):
         """OVERWRITES an ini style config file that holds all of default the
@@ -1878,6 +3921,37 @@ if __name__ == '__main__':
 
         baker.writeconfig(iniconffile=iniconffile)
 
+    @baker.command()
+    def build_parameter_database():
+        """Rewrite the compact form of tappy_lib/parameter_database.py that is loaded at import, after changing parameter_database.py.
+        """
+        write_parameter_database()
+
+    @baker.command()
+    def build_node_table(
+            filename,
+            start_date='1900-01-01T00:00:00',
+            end_date='2100-01-01T00:00:00',
+            interval=24,
+            ephemeris_backend='numpy'):
+        """Precompute node factors and equilibrium arguments for every constituent into a file for the node_table option.
+
+        :param filename: The node table file to write.
+        :param start_date: The start date as a ISO 8601 string. '1900-01-01T00:00:00'
+        :param end_date: The end date as a ISO 8601 string. '2100-01-01T00:00:00'
+        :param interval: The interval as the number of hours, 24 for daily
+            or 1 for hourly. [default: 24]
+        :param ephemeris_backend: Where the astronomic arguments come from,
+            one of 'astronomia' or 'numpy'. [default: numpy]
+        """
+        u = Util(None, None)
+        u.ephemeris_backend = ephemeris_backend
+        u.write_node_table(
+            filename,
+            datetime.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%S'),
+            datetime.datetime.strptime(end_date, '%Y-%m-%dT%H:%M:%S'),
+            interval=float(interval))
+
     @baker.command()
     def prediction(
             xml_filename,
@@ -1885,6 +3959,14 @@ if __name__ == '__main__':
             end_date,
             interval,
             include_inferred=True,
+            ephemeris_backend='astronomia',
+            node_interval=0,
+            node_tolerance=1.0e-6,
+            node_table='',
+            single=False,
+            method='direct',
+            chunk=100000,
+            workers=1,
             fname='-'):
         """Prediction based upon earlier constituent analysis saved in IHOTC XML transfer format.
 
@@ -1893,56 +3975,186 @@ if __name__ == '__main__':
         :param end_date: The end date as a ISO 8601 string. '2011-01-01T00:00:00:00'
         :param interval: The interval as the number of minutes.
         :param include_inferred: Include the inferred constituents.
+        :param ephemeris_backend: Where the astronomic arguments come from,
+            one of 'astronomia' or 'numpy'. [default: astronomia]
+        :param node_interval: Evaluate the ephemeris and node factors about
+            this many hours apart and interpolate in between.  The default
+            of 0 evaluates them at every date.
+        :param node_tolerance: Largest allowed interpolation error of the
+            node factors and mean longitudes (radians) when node_interval
+            is used. [default: 1.0e-6]
+        :param node_table: Read the node factors and equilibrium arguments
+            from this file written by build_node_table.
+        :param single: Sum the constituents in single precision, which is
+            faster and accurate to about 1e-6 of the amplitudes.
+        :param method: 'direct' calculates the cosine of every constituent
+            at every date, 'recurrence' rotates the phasor of each
+            constituent from one date to the next, which is several times
+            faster for long predictions. [default: direct]
+        :param chunk: Calculate and write the prediction this many dates at
+            a time, each with its own node factors and V + u, so that memory
+            does not depend on the length of the prediction.
+            [default: 100000]
+        :param workers: Calculate the chunks in this many processes.  The
+            result is the same as with one. [default: 1]
         :param fname: Output filename, default is '-' to print to screen.
         """
-        import xml.etree.ElementTree as et
-        tree = et.parse(xml_filename)
-        root = tree.getroot()
-        rin = {}
-        phasein = {}
-        skey_list = []
-        for constituent in root.getiterator('Harmonic'):
-            inf = constituent.findtext('inferred')
-            if (not include_inferred) and (inf.lower() == 'true'):
-                continue
-            nam = constituent.findtext('name')
-            amp = constituent.findtext('amplitude')
-            pha = constituent.findtext('phaseAngle')
-            rin[nam] = float(amp)
-            phasein[nam] = float(pha)
-            skey_list.append(nam)
+        (rin, phasein, skey_list) = read_constituents(
+            xml_filename, include_inferred=include_inferred)
 
         u = Util(rin, phasein)
-        u.dates = [datetime.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%S')]
-        delta = datetime.timedelta(minutes=int(interval))
-        nextdate = u.dates[0] + delta
-        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%dT%H:%M:%S') + datetime.timedelta(minutes=1)
-        while nextdate < end_date:
-            u.dates.append(nextdate)
-            nextdate = u.dates[-1] + delta
-
-        package = u.astronomic(u.dates)
-        (zeta, nu, nup, nupp, kap_p, ii, R, Q, T, u.jd, s, h, Nv, p, p1) = package
-
-        # Should change this - runs ONLY to get tidal_dict filled in...
-        (speed_dict, key_list) = u.which_constituents(len(u.dates), package)
+        u.ephemeris_backend = ephemeris_backend
+        u.node_interval = float(node_interval)
+        u.node_tolerance = float(node_tolerance)
+        u.node_table = node_table
+        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%S')
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%dT%H:%M:%S')
+
+        dtype = np.float64
+        if single:
+            dtype = np.float32
+        # Each block is written as soon as it is calculated.
+        mode = 'w'
+        for dates, prediction in u.predict_iter(skey_list, start_date,
+                                                end_date, int(interval),
+                                                chunk=int(chunk),
+                                                dtype=dtype, method=method,
+                                                workers=int(workers)):
+            u.write_file(dates, prediction, fname=fname, mode=mode)
+            mode = 'a'
+
+    @baker.command(name='predict-batch')
+    def predict_batch(
+            xml_filenames,
+            start_date,
+            end_date,
+            interval,
+            include_inferred=True,
+            ephemeris_backend='astronomia',
+            node_interval=0,
+            node_tolerance=1.0e-6,
+            node_table='',
+            single=False,
+            chunk=100000,
+            fname='-'):
+        """Prediction for many stations from IHOTC XML transfer format files, one column per station.
 
-        prediction = 0.0
-        try:
-            prediction = rin['Z0']
-        except KeyError:
-            pass
+        :param xml_filenames: The tidal constituents of each station in IHOTC
+            XML transfer format, as file names or glob patterns separated
+            by commas.  'stations/*.xml'
+        :param start_date: The start date as a ISO 8601 string. '2010-01-01T00:00:00'
+        :param end_date: The end date as a ISO 8601 string. '2011-01-01T00:00:00:00'
+        :param interval: The interval as the number of minutes.
+        :param include_inferred: Include the inferred constituents.
+        :param ephemeris_backend: Where the astronomic arguments come from,
+            one of 'astronomia' or 'numpy'. [default: astronomia]
+        :param node_interval: Evaluate the ephemeris and node factors about
+            this many hours apart and interpolate in between.  The default
+            of 0 evaluates them at every date.
+        :param node_tolerance: Largest allowed interpolation error of the
+            node factors and mean longitudes (radians) when node_interval
+            is used. [default: 1.0e-6]
+        :param node_table: Read the node factors and equilibrium arguments
+            from this file written by build_node_table.
+        :param single: Calculate in single precision, which is faster.
+        :param chunk: Calculate and write the prediction this many dates at
+            a time. [default: 100000]
+        :param fname: Output filename, default is '-' to print to screen.
+            The first line has the station names, taken from the XML file
+            names, and then each line has the date and the height of every
+            station.
+        """
+        (names, stations) = read_stations(xml_filenames,
+                                          include_inferred=include_inferred)
+
+        dtype = np.float64
+        if single:
+            dtype = np.float32
+        if fname == '-':
+            fpo = sys.stdout
+        else:
+            fpo = open(fname, 'w')
+        fpo.write("date %s\n" % ' '.join(names))
+        row = "%s" + " %f" * len(names) + "\n"
+        for dates, heights in predict_stations(
+                stations,
+                datetime.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%S'),
+                datetime.datetime.strptime(end_date, '%Y-%m-%dT%H:%M:%S'),
+                int(interval),
+                chunk=int(chunk),
+                dtype=dtype,
+                ephemeris_backend=ephemeris_backend,
+                node_interval=float(node_interval),
+                node_tolerance=float(node_tolerance),
+                node_table=node_table):
+            for d, values in zip(datetime_dates(dates), heights.T):
+                fpo.write(row % ((d.isoformat(), ) + tuple(values)))
+        if fpo is not sys.stdout:
+            fpo.close()
 
-        try:
-            skey_list.remove('Z0')
-        except ValueError:
-            pass
+    @baker.command()
+    def extrema(
+            xml_filenames,
+            start_date,
+            end_date,
+            interval=60,
+            include_inferred=True,
+            ephemeris_backend='astronomia',
+            node_interval=0,
+            node_tolerance=1.0e-6,
+            node_table='',
+            chunk=100000,
+            fname='-'):
+        """High and low waters for one or many stations from IHOTC XML transfer format files.
 
-        calcdates = np.array(range(len(u.dates)),
-                             dtype=np.float64) * float(interval) / 60.0
-        prediction = prediction + u.sum_signals(skey_list, calcdates, u.tidal_dict)
+        :param xml_filenames: The tidal constituents of each station in IHOTC
+            XML transfer format, as file names or glob patterns separated
+            by commas.  'stations/*.xml'
+        :param start_date: The start date as a ISO 8601 string. '2010-01-01T00:00:00'
+        :param end_date: The end date as a ISO 8601 string. '2011-01-01T00:00:00:00'
+        :param interval: Search for the high and low waters this many
+            minutes apart, each is then found to about a second.  It has to
+            be less than the time from a high to the next low water.
+            [default: 60]
+        :param include_inferred: Include the inferred constituents.
+        :param ephemeris_backend: Where the astronomic arguments come from,
+            one of 'astronomia' or 'numpy'. [default: astronomia]
+        :param node_interval: Evaluate the ephemeris and node factors about
+            this many hours apart and interpolate in between.  The default
+            of 0 evaluates them at every date.
+        :param node_tolerance: Largest allowed interpolation error of the
+            node factors and mean longitudes (radians) when node_interval
+            is used. [default: 1.0e-6]
+        :param node_table: Read the node factors and equilibrium arguments
+            from this file written by build_node_table.
+        :param chunk: Calculate the search this many dates at a time.
+            [default: 100000]
+        :param fname: Output filename, default is '-' to print to screen.
+            Each line has the station name, taken from the XML file name,
+            the date, the height, and H for high or L for low water.
+        """
+        (names, stations) = read_stations(xml_filenames,
+                                          include_inferred=include_inferred)
 
-        u.write_file(u.dates, prediction, fname=fname)
+        if fname == '-':
+            fpo = sys.stdout
+        else:
+            fpo = open(fname, 'w')
+        for name, (dates, heights, highs) in zip(names, predict_extrema(
+                stations,
+                datetime.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%S'),
+                datetime.datetime.strptime(end_date, '%Y-%m-%dT%H:%M:%S'),
+                interval=float(interval),
+                chunk=int(chunk),
+                ephemeris_backend=ephemeris_backend,
+                node_interval=float(node_interval),
+                node_tolerance=float(node_tolerance),
+                node_table=node_table)):
+            for d, height, high in zip(datetime_dates(dates), heights, highs):
+                fpo.write("%s %s %f %s\n" % (name, d.isoformat(), height,
+                                             'H' if high else 'L'))
+        if fpo is not sys.stdout:
+            fpo.close()
 
 
     # =============================
@@ -1965,6 +4177,13 @@ if __name__ == '__main__':
             filter=None,
             pad_filters=None,
             include_inferred=True,
+            solver='nonlinear',
+            ephemeris_backend='astronomia',
+            node_interval=0,
+            node_tolerance=1.0e-6,
+            node_table='',
+            selection='standard',
+            chunk=0,
             xmlname='A port in a storm',
             xmlcountry='A man without a country',
             xmllatitude=0.0,
@@ -2005,6 +4224,40 @@ if __name__ == '__main__':
             ["tide", "minimum", "maximum", "mean", "median", "reflect", "wrap"]
         :param include_inferred: Do not incorporate any inferred constituents
             into the least squares fit.
+        :param solver: One of 'nonlinear' or 'linear'.  'nonlinear' fits
+            amplitude and phase with scipy's leastsq, 'linear' fits the
+            in-phase and quadrature coefficients in a single linear least
+            squares solve.  With 'linear' the inferred constituents are
+            calculated from the fitted constituents after the solve, rather
+            than fitted with them as by 'nonlinear', so the two only give
+            the same constituents without include_inferred.
+            [default: nonlinear]
+        :param ephemeris_backend: Where the astronomic arguments come from.
+            'astronomia' uses the astronomia package, 'numpy' uses the
+            same polynomials evaluated in numpy over all dates at once
+            without importing astronomia. [default: astronomia]
+        :param node_interval: Evaluate the ephemeris and node factors about
+            this many hours apart and interpolate in between, which is much
+            faster for long records with short intervals.  The interval is
+            halved until the interpolation is within node_tolerance.  The
+            default of 0 evaluates them at every date.
+        :param node_tolerance: Largest allowed interpolation error of the
+            node factors and mean longitudes (radians) when node_interval
+            is used. [default: 1.0e-6]
+        :param node_table: Read the node factors and equilibrium arguments
+            from this file written by build_node_table instead of
+            calculating them, if it covers the record.
+        :param selection: Which constituents to fit.  'standard' uses the
+            usual set for the record length, 'auto' admits any constituent
+            in the parameter database that the Rayleigh criterion can
+            separate from its neighbours and that is below the Nyquist
+            frequency of the sampling. [default: standard]
+        :param chunk: Read and analyze the data file this many records at a
+            time with a linear least squares fit of accumulated normal
+            equations, so that memory does not depend on the record length.
+            Cannot be used with missing_data='fill', remove_extreme,
+            zero_ts, filter, or outputts.  The default of 0 reads the whole
+            file.
         :param print_vau_table: For debugging - will print a table of V and u
             values to compare against Schureman.
         :param outputxml: File name to output constituents as IHOTC XML format.
@@ -2050,6 +4303,12 @@ if __name__ == '__main__':
             filter=filter,
             pad_filters=pad_filters,
             include_inferred=include_inferred,
+            solver=solver,
+            ephemeris_backend=ephemeris_backend,
+            node_interval=float(node_interval),
+            node_tolerance=float(node_tolerance),
+            node_table=node_table,
+            selection=selection,
             )
 
         if ephemeris:
@@ -2057,66 +4316,87 @@ if __name__ == '__main__':
         if print_vau_table:
             x.print_v_u_table()
 
-        x.open(data_filename, def_filename = def_filename)
-
-        if x.missing_data == 'fail':
-            x.dates_filled, x.elevation_filled = x.missing(x.missing_data,
-                                                           x.dates,
-                                                           x.elevation)
-
-        if x.remove_extreme:
-            x.remove_extreme_values()
-
-        package = x.astronomic(x.dates)
-        (x.zeta, x.nu, x.nup, x.nupp, x.kap_p, x.ii, x.R, x.Q, x.T, x.jd, x.s, x.h, x.N, x.p, x.p1) = package
-
         if rayleigh:
             ray = float(rayleigh)
         else:
             ray = 1.0
-        (x.speed_dict, x.key_list) = x.which_constituents(len(x.dates),
-                                                          package,
-                                                          rayleigh_comp=ray)
-        if x.zero_ts:
-            # FIX - have to run the constituents package here in order to have
-            # filters available , and then run AGAIN later on.
+
+        if chunk:
+            if (x.missing_data == 'fill' or x.remove_extreme or x.zero_ts or
+                    x.filter or x.outputts):
+                print("chunk cannot be used with missing_data='fill', remove_extreme, zero_ts, filter, or outputts")
+                sys.exit()
+            # First pass to find the extent and sampling interval of the
+            # record, second pass to accumulate the normal equations.
+            start_date = None
+            intervals = []
+            for dates, elevation in x.open_chunks(data_filename,
+                                                  def_filename=def_filename,
+                                                  chunk=int(chunk)):
+                if start_date is None:
+                    start_date = dates[0]
+                end_date = dates[-1]
+                if len(dates) > 1:
+                    intervals.append(np.median(np.diff(dates) / np.timedelta64(60, 's')))
+            if start_date is None:
+                print('No data was found in the input file.')
+                sys.exit()
+            x.streaming_constituents(x.open_chunks(data_filename,
+                                                   def_filename=def_filename,
+                                                   chunk=int(chunk)),
+                                     start_date,
+                                     end_date,
+                                     rayleigh_comp=ray,
+                                     interval=np.median(intervals) if intervals else None)
+        else:
+            x.open(data_filename, def_filename = def_filename)
+
+            if x.missing_data == 'fail':
+                x.dates_filled, x.elevation_filled = x.missing(x.missing_data,
+                                                               x.dates,
+                                                               x.elevation)
+
+            if x.remove_extreme:
+                x.remove_extreme_values()
+
+            package = x.prepare(rayleigh_comp=ray)
+
+            if x.zero_ts:
+                # FIX - have to run the constituents package here in order to have
+                # filters available , and then run AGAIN later on.
+                x.constituents()
+                print(len(x.dates), len(x.elevation))
+                x.dates_filled, x.elevation_filled = x.missing('fill',
+                                                               x.dates,
+                                                               x.elevation)
+                print(len(x.dates_filled), len(x.elevation_filled))
+                x.dates, filtered = x.filters(zero_ts,
+                                              x.dates_filled,
+                                              x.elevation_filled)
+                print(len(x.dates), len(filtered))
+                x.elevation = x.elevation_filled - filtered
+                package = x.prepare(rayleigh_comp=ray)
+
             x.constituents()
-            print(len(x.dates), len(x.elevation))
-            x.dates_filled, x.elevation_filled = x.missing('fill',
-                                                           x.dates,
-                                                           x.elevation)
-            print(len(x.dates_filled), len(x.elevation_filled))
-            x.dates, filtered = x.filters(zero_ts,
-                                          x.dates_filled,
-                                          x.elevation_filled)
-            print(len(x.dates), len(filtered))
-            x.elevation = x.elevation_filled - filtered
-            package = x.astronomic(x.dates)
-            (x.zeta, x.nu, x.nup, x.nupp, x.kap_p, x.ii, x.R, x.Q, x.T, x.jd, x.s, x.h, x.N, x.p, x.p1) = package
-            (x.speed_dict, x.key_list) = x.which_constituents(len(x.dates),
-                                                              package,
-                                                              rayleigh_comp=ray)
-
-        x.constituents()
-
-        if x.missing_data == 'fill':
-            x.dates_filled, x.elevation_filled = x.missing(x.missing_data,
+
+            if x.missing_data == 'fill':
+                x.dates_filled, x.elevation_filled = x.missing(x.missing_data,
+                                                               x.dates,
+                                                               x.elevation)
+                x.write_file( x.dates_filled,
+                                x.elevation_filled,
+                                fname='outts_filled.dat')
+
+            if x.filter:
+                for item in x.filter.split(','):
+                    if item in ['mstha', 'wavelet', 'cd', 'boxcar', 'usgs', 'doodson', 'lecolazet1', 'kalman', 'transform']:# 'lecolazet', 'godin', 'sfa']:
+                        filtered_dates, result = x.filters(item,
                                                            x.dates,
                                                            x.elevation)
-            x.write_file( x.dates_filled,
-                            x.elevation_filled,
-                            fname='outts_filled.dat')
-
-        if x.filter:
-            for item in x.filter.split(','):
-                if item in ['mstha', 'wavelet', 'cd', 'boxcar', 'usgs', 'doodson', 'lecolazet1', 'kalman', 'transform']:# 'lecolazet', 'godin', 'sfa']:
-                    filtered_dates, result = x.filters(item,
-                                                       x.dates,
-                                                       x.elevation)
-                    x.write_file(filtered_dates, result, fname='outts_filtered_%s.dat' % (item,))
-            (x.speed_dict, x.key_list) = x.which_constituents(len(x.dates),
-                                                            package,
-                                                            rayleigh_comp=ray)
+                        x.write_file(filtered_dates, result, fname='outts_filtered_%s.dat' % (item,))
+                (x.speed_dict, x.key_list) = x.which_constituents(len(x.dates),
+                                                                package,
+                                                                rayleigh_comp=ray)
 
         if not x.quiet:
             x.print_con()
@@ -2181,13 +4461,13 @@ if __name__ == '__main__':
             units.text = str(xmlunits)
 
             observationstart = et.SubElement(port, 'observationStart')
-            observationstart.text = x.dates[0].isoformat()
+            observationstart.text = datetime_dates(x.dates[:1])[0].isoformat()
 
             comments = et.SubElement(port, 'comments')
             comments.text = xmlcomments
 
             observationend = et.SubElement(port, 'observationEnd')
-            observationend.text = x.dates[-1].isoformat()
+            observationend.text = datetime_dates(x.dates[-1:])[0].isoformat()
 
             ndict = {'Z0': 0.0}
             for k in x.key_list + x.inferred_key_list:
@@ -2197,8 +4477,8 @@ if __name__ == '__main__':
             if xmldecimalplaces == 'ihotc':
                 ampformatstr = '{0:.3f}'
                 phaformatstr = '{0:.1f}'
-                daterange = x.dates[-1] - x.dates[0]
-                if daterange < datetime.timedelta(days=90):
+                daterange = datetime64_dates(x.dates[-1]) - datetime64_dates(x.dates[0])
+                if daterange < np.timedelta64(90, 'D'):
                     ampformatstr = '{0:.2f}'
                     phaformatstr = '{0:.0f}'
             elif xmldecimalplaces == 'full':
@@ -1,3 +1,3 @@
-import filter
-import sparser
-import parameter_database
+# The modules filter, sparser, and parameter_database are imported where
+# they are used, rather than here, since sparser imports pyparsing which is
+# slow to import.
@@ -446,6 +446,10 @@ class ParseFileLineByLine:
             else:
                 raise DefinitionFileNotFoundError(def_filename)
         if self.parsedef:
+            # The definition file appends to grammar and extra_dict, which
+            # would otherwise still hold the definition of the last file.
+            del grammar[:]
+            extra_dict.clear()
             exec(open(self.parsedef).read())
             self.grammar = And(grammar[1:] + [restOfLine])
 
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Times importing tappy in a fresh interpreter, which is what a short
+prediction job pays for before it does anything, and lists the slow
+modules that were imported along with it.
+
+    python benchmark_import.py [repeat]
+"""
+
+import os
+import os.path
+import subprocess
+import sys
+
+# directory dance to find tappy in directory above benchmark_import.py
+file_loc = os.path.abspath(__file__)
+cur_path = os.path.dirname(file_loc)
+tappy_loc = os.path.dirname(cur_path)
+
+slow_modules = ['scipy.optimize', 'pyparsing', 'baker', 'astronomia',
+               'tappy_lib.sparser', 'tappy_lib.parameter_database']
+
+# tappy/tappy.py is imported from its own directory, as when it is run as a
+# script, so that it is the module that is timed rather than the package
+# __init__.
+code = """
+import sys
+import time
+
+
+def imported():
+    return ' '.join([m for m in %r if m in sys.modules])
+
+start = time.time()
+import tappy
+print(time.time() - start)
+print(imported())
+%%s
+print(imported())
+""" % slow_modules
+
+# An analysis of the example, which needs all of the slow modules but
+# baker and parameter_database.
+analysis = """
+x = tappy.tappy(quiet=True, debug=False, outputts=False, outputxml=False,
+                ephemeris=False, rayleigh=1.0, print_vau_table=False,
+                missing_data='ignore', linear_trend=False,
+                remove_extreme=False, zero_ts=None, filter=None,
+                pad_filters=None, include_inferred=True)
+x.open(%r, %r)
+x.prepare()
+x.constituents()
+""" % (os.path.join(tappy_loc, 'example', 'mayport_florida_8720220_data.txt'),
+       os.path.join(tappy_loc, 'example', 'mayport_florida_8720220_data_def.txt'))
+
+
+def import_time(use=''):
+    """
+    Returns the seconds to import tappy in a new interpreter, the slow
+    modules that were imported, and the slow modules that were imported
+    after then running the code in use.
+    """
+
+    output = subprocess.Popen([sys.executable, '-c', code % use],
+                              cwd=os.path.join(tappy_loc, 'tappy'),
+                              stdout=subprocess.PIPE).communicate()[0]
+    lines = output.decode('utf-8').splitlines()
+    return float(lines[0]), lines[1].split(), lines[-1].split()
+
+
+if __name__ == '__main__':
+    repeat = 10
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+    times = []
+    for i in range(repeat):
+        (seconds, imported, used) = import_time()
+        times.append(seconds)
+    times.sort()
+    print("import tappy: best %.1f ms, median %.1f ms of %d" % (
+        1000 * times[0], 1000 * times[len(times) // 2], repeat))
+    print("slow modules imported: %s" % (' '.join(imported) or 'none'))
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 import sys
 import unittest
 import glob
@@ -15,6 +17,65 @@ cur_path = os.path.dirname(file_loc)
 tappy_loc = os.path.dirname(cur_path)
 
 sys.path.insert(0, tappy_loc)
+# tappy.py imports tappy_lib from its own directory.
+sys.path.insert(1, os.path.join(tappy_loc, 'tappy'))
+
+
+def new_tappy(**kwds):
+    """
+    Returns a tappy with the defaults of the analysis command that doesn't
+    print or write anything.
+    """
+
+    from tappy import tappy
+    options = dict(quiet=True, debug=False, outputts=False, outputxml=False,
+                   ephemeris=False, rayleigh=1.0, print_vau_table=False,
+                   missing_data='ignore', linear_trend=False,
+                   remove_extreme=False, zero_ts=None, filter=None,
+                   pad_filters=None, include_inferred=True)
+    options.update(kwds)
+    return tappy.tappy(**options)
+
+
+def synthetic_record(r, phase, days, interval=60, noise=0.0):
+    """
+    Returns the dates and elevation of the prediction of the constituents
+    in r and phase every interval minutes for days from 2000-01-01, plus
+    normally distributed noise.
+    """
+
+    import datetime
+    import numpy as np
+    from tappy import tappy
+    u = tappy.Util(r, phase)
+    u.ephemeris_backend = 'numpy'
+    start = datetime.datetime(2000, 1, 1)
+    ((dates, elevation), ) = list(u.predict_iter(
+        list(r), start, start + datetime.timedelta(days=days), interval,
+        chunk=10**7))
+    random = np.random.RandomState(1)
+    return dates, elevation + noise * random.standard_normal(len(elevation))
+
+
+# Constituents of a mixed, mainly semidiurnal, tide.
+tide_r = {'M2': 0.6, 'S2': 0.1, 'N2': 0.12, 'K2': 0.03, 'K1': 0.09,
+          'O1': 0.06, 'P1': 0.03, 'M4': 0.02, 'Z0': 0.5}
+tide_phase = {'M2': 22.0, 'S2': 60.0, 'N2': 5.0, 'K2': 58.0, 'K1': 100.0,
+              'O1': 110.0, 'P1': 98.0, 'M4': 30.0, 'Z0': 0.0}
+
+
+def analysis(dates, elevation, **kwds):
+    """
+    Returns a tappy after the analysis of dates and elevation.
+    """
+
+    kwds.setdefault('ephemeris_backend', 'numpy')
+    x = new_tappy(**kwds)
+    x.dates = dates
+    x.elevation = elevation
+    x.prepare()
+    x.constituents()
+    return x
 
 class TappyTest(unittest.TestCase):
     def setUp(self):
@@ -43,7 +104,7 @@ class TappyTest(unittest.TestCase):
             d = difflib.Differ()
             result = list(d.compare(alines, blines))
             result = [i for i in result if i[0] in ['+', '-', '?']]
-            print ''.join(result),
+            print(''.join(result), end='')
             self.assertEqual(result, [])
 
     def test_closure(self):
@@ -73,10 +134,826 @@ class TappyTest(unittest.TestCase):
         d = difflib.Differ()
         result = list(d.compare(alines, blines))
         result = [i for i in result if i[0] in ['+', '-', '?']]
-        print ''.join(result),
+        print(''.join(result), end='')
         self.assertEqual(result, [])
 
 
+class UtilTest(unittest.TestCase):
+    def test_numpy_backend(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        dates = [datetime.datetime(year, 1, 1) + datetime.timedelta(days=day)
+                 for year in range(1600, 2101, 5)
+                 for day in [0, 91, 182, 273]]
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'astronomia'
+        apackage = u.astronomic(dates)
+        u.ephemeris_backend = 'numpy'
+        npackage = u.astronomic(dates)
+        for a, b in zip(apackage, npackage):
+            diff = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+            diff = np.mod(diff + np.pi, 2*np.pi) - np.pi
+            self.assertTrue(np.all(np.abs(diff) < 1.0e-6))
+
+    def test_dates2jd(self):
+        import datetime
+        import numpy as np
+        import astronomia.calendar as cal
+        from tappy import tappy
+        dates = []
+        for year in [1600, 1700, 1800, 1899, 1900, 1904, 1999, 2000, 2001,
+                     2004, 2100]:
+            for (month, day) in [(1, 1), (2, 28), (3, 1), (12, 31)]:
+                dates.append(datetime.datetime(year, month, day, 23, 59, 59))
+                dates.append(datetime.datetime(year, month, day, 0, 0, 0))
+            if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+                dates.append(datetime.datetime(year, 2, 29, 12, 30, 1))
+        dates.append(datetime.datetime(1066, 10, 14, 9, 7, 13))
+        expected = np.array([cal.cal_to_jd(i.year, i.month, i.day) +
+                             cal.hms_to_fday(i.hour, i.minute, i.second)
+                             for i in dates]).flatten()
+        u = tappy.Util(None, None)
+        self.assertTrue(np.array_equal(u.dates2jd(dates), expected))
+        self.assertTrue(np.array_equal(
+            u.dates2jd(np.array(dates, dtype='datetime64[s]')), expected))
+
+    def test_node_interval(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'numpy'
+        u.dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(minutes=6*i)
+                   for i in range(24*10*90)]
+        exact = u.tidal_table(len(u.dates), u.astronomic(u.dates))
+        u.node_interval = 24
+        self.assertTrue(len(u.node_index(u.dates2jd(u.dates))) < 100)
+        coarse = u.tidal_table(len(u.dates), u.astronomic(u.dates))
+        # The table node_index built on its grid is interpolated from.
+        self.assertTrue(coarse.sources[0] is u.node_index_table[1])
+        for key in exact:
+            self.assertTrue(np.all(np.abs(exact[key]['FF'] - coarse[key]['FF']) < 1.0e-6))
+            self.assertAlmostEqual(exact[key]['VAU'], coarse[key]['VAU'], places=9)
+        # So is the astronomic package, through the jump of Q by pi on
+        # 2000-06-13.
+        u.dates = np.datetime64('2000-06-01') + np.arange(24*10*30) * np.timedelta64(360, 's')
+        coarse = u.astronomic(u.dates)
+        self.assertEqual(len(u.node_index_package[9]), len(u.node_index_value))
+        u.node_interval = 0
+        exact = u.astronomic(u.dates)
+        for (a, b) in zip(exact, coarse):
+            diff = np.mod(np.asarray(a) - b + np.pi, 2 * np.pi) - np.pi
+            self.assertTrue(np.all(np.abs(diff) < 1.0e-5))
+
+    def test_node_table(self):
+        import datetime
+        import tempfile
+        import numpy as np
+        from tappy import tappy
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'numpy'
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        u.write_node_table(filename, datetime.datetime(1999, 12, 1),
+                           datetime.datetime(2000, 3, 1), rows=30)
+        u.dates = [datetime.datetime(2000, 1, 1, 5) + datetime.timedelta(minutes=6*i)
+                   for i in range(24*10*30)]
+        exact = u.tidal_table(len(u.dates), u.astronomic(u.dates))
+        u.node_table = filename
+        table = u.tidal_table(len(u.dates), u.astronomic(u.dates))
+        # Only the constituents looked up are read from the table.
+        self.assertTrue(isinstance(table, tappy.LazyDict))
+        self.assertEqual(sorted(table['M4']), ['FF', 'V', 'VAU', 'speed'])
+        self.assertEqual(list(table.built), ['M4'])
+        for key in exact:
+            self.assertTrue(np.all(np.abs(exact[key]['FF'] - table[key]['FF']) < 1.0e-6))
+            for field in ('V', 'VAU'):
+                diff = np.mod(exact[key][field] - table[key][field] + 180, 360) - 180
+                # u is interpolated between daily rows.
+                self.assertTrue(abs(diff) < 1.0e-4)
+            self.assertAlmostEqual(exact[key]['speed'], table[key]['speed'], places=9)
+        # A table built from another backend isn't used.
+        u.ephemeris_backend = 'astronomia'
+        table = u.tidal_table(len(u.dates), u.astronomic(u.dates))
+        self.assertTrue(isinstance(table, tappy.LazyDict))
+        self.assertTrue(tappy.node_tables[(filename, 'astronomia')] is None)
+        # Rebuilding the table changes the basis_cache key.
+        x = new_tappy(ephemeris_backend='numpy', node_table=filename)
+        x.dates = u.dates
+        key = x.basis_key()
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertNotEqual(x.basis_key(), key)
+        del tappy.node_tables[(filename, 'numpy')]
+        del tappy.node_tables[(filename, 'astronomia')]
+        os.remove(filename)
+
+    def test_lazy_tidal_dict(self):
+        import datetime
+        from tappy import tappy
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'numpy'
+        u.dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=i)
+                   for i in range(24*31)]
+        package = u.astronomic(u.dates)
+        (speed_dict, key_list) = u.which_constituents(len(u.dates), package)
+        self.assertEqual(sorted(u.tidal_dict.built), sorted(key_list))
+        self.assertTrue(len(u.tidal_dict.built) < len(u.tidal_dict))
+        self.assertTrue(u.tidal_dict['M4']['FF'][0] == u.tidal_dict['M2']['FF'][0]**2)
+        # The full length raw entries are only kept for the constituents
+        # others are derived from, and reused.
+        (raw, ) = u.tidal_dict.sources
+        self.assertTrue('M2' in raw.built and 'S2' in raw.built)
+        self.assertFalse('M4' in raw.built or 'MS4' in raw.built)
+        M2 = raw.built['M2']
+        u.tidal_dict['3MS8']
+        self.assertTrue(raw.built['M2'] is M2)
+        self.assertFalse('3MS8' in raw.built)
+        # The node factors the raw entries share with the finished ones
+        # are counted once.
+        self.assertEqual(tappy.entry_nbytes(u.tidal_dict),
+                         tappy.entry_nbytes([u.tidal_dict.built, raw.built]))
+        self.assertTrue(tappy.entry_nbytes(u.tidal_dict) >
+                        tappy.entry_nbytes(u.tidal_dict.built))
+
+    def test_basis_cache(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        cache = tappy.BasisCache(max_bytes=2500)
+        self.assertTrue(cache.get('a') is None)
+        cache.put('a', {'x': np.zeros(100)})
+        cache.put('b', {'x': np.zeros(100), 'y': [np.zeros(50)]})
+        self.assertEqual(cache.nbytes, 2000)
+        self.assertTrue(cache.get('a') is not None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # 'b' is now the least recently used.
+        cache.put('c', {'x': np.zeros(100)})
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        # Replacing an entry doesn't count it twice.
+        cache.put('c', {'x': np.zeros(150)})
+        self.assertEqual(cache.nbytes, 2000)
+        # An entry too large by itself is not kept.
+        cache.put('d', {'x': np.zeros(1000)})
+        self.assertEqual(list(cache.entries), [])
+        self.assertEqual(cache.nbytes, 0)
+        # A tidal dictionary grows as constituents are looked up, which is
+        # measured the next time the cache is used.
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'numpy'
+        u.dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=i)
+                   for i in range(24*31)]
+        u.which_constituents(len(u.dates), u.astronomic(u.dates))
+        cache = tappy.BasisCache()
+        cache.put('a', {'x': np.zeros(100)})
+        cache.put('tides', {'tidal_dict': u.tidal_dict})
+        before = cache.nbytes
+        for key in u.tidal_dict:
+            u.tidal_dict[key]
+        cache.max_bytes = before + 1
+        self.assertTrue(cache.get('tides') is not None)
+        self.assertTrue(cache.nbytes > before)
+        self.assertEqual(list(cache.entries), ['tides'])
+        self.assertEqual(cache.nbytes,
+                         tappy.entry_nbytes({'tidal_dict': u.tidal_dict}))
+
+    def test_constituent_table(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'numpy'
+        u.dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=i)
+                   for i in range(24*31)]
+        package = u.astronomic(u.dates)
+        (speed_dict, key_list) = u.which_constituents(len(u.dates), package)
+        table = tappy.ConstituentTable(u.tidal_dict, key_list, len(u.dates))
+        self.assertEqual(table.FF.shape, (len(key_list), len(u.dates)))
+        for key in key_list:
+            i = table.index[key]
+            self.assertEqual(table.speed[i], u.tidal_dict[key]['speed'])
+            self.assertEqual(table.VAU[i], u.tidal_dict[key]['VAU'])
+            self.assertTrue(np.all(table.FF[i] == u.tidal_dict[key]['FF']))
+        short = tappy.ConstituentTable(u.tidal_dict, key_list, 10)
+        self.assertTrue(np.all(short.FF == 1.0))
+        head = table.head(key_list[:3])
+        self.assertEqual(head.names, key_list[:3])
+        self.assertTrue(np.shares_memory(head.FF, table.FF))
+        self.assertTrue(np.all(head.FF == table.FF[:3]))
+        # An analysis keeps the table of the fitted and inferred
+        # constituents with its basis, and the fitted constituents are a
+        # view of it.
+        (dates, elevation) = synthetic_record(tide_r, tide_phase, 30)
+        x = new_tappy(ephemeris_backend='numpy')
+        x.dates = dates
+        x.elevation = elevation
+        x.prepare()
+        t = (x.jd - x.jd[0]) * 24
+        x.compile_fit(t, x.key_list)
+        kept = x.basis_entry['table']
+        self.assertTrue(len(kept) > len(x.key_list))
+        X = x.design_matrix(t, x.key_list)
+        self.assertTrue(x.basis_entry['table'] is kept)
+        fitted = x.constituent_table(x.key_list, len(t))
+        self.assertEqual(fitted.names, x.key_list)
+        self.assertTrue(np.shares_memory(fitted.FF, kept.FF))
+        self.assertTrue(np.all(X[:, 0] == fitted.FF[0] * np.cos(fitted.speed[0] * t)))
+        self.assertTrue(tappy.entry_nbytes(x.basis_entry) >= kept.FF.nbytes +
+                        tappy.entry_nbytes(x.basis_entry['package']))
+
+    def test_auto_constituents(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'numpy'
+        u.dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=i)
+                   for i in range(24*40)]
+        jd = u.dates2jd(u.dates)
+        num_hours = (jd[-1] - jd[0]) * 24
+        speed = np.dot(tappy.doodson_matrix, u.argument_speeds(u.dates[0]))
+        names = u.auto_constituents(jd)
+        for key in ['M2', 'S2', 'N2', 'K1', 'O1', 'M4']:
+            self.assertTrue(key in names)
+        selected = np.sort([speed[tappy.doodson_index[key]] for key in names])
+        self.assertTrue(selected[0] >= 360.0 / num_hours)
+        self.assertTrue(np.all(np.diff(selected) >= 360.0 / num_hours))
+        self.assertTrue(selected[-1] < 180.0)
+        self.assertTrue(len(u.auto_constituents(jd, rayleigh_comp=2.0)) <
+                        len(names))
+        u.selection = 'auto'
+        (speed_dict, key_list) = u.which_constituents(len(u.dates),
+                                                      u.astronomic(u.dates))
+        self.assertEqual(key_list, sorted(names))
+
+    def test_auto_node_factors(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        self.assertEqual(tappy.compound_components('2MS2K2'),
+                         [('M2', 2), ('S2', 1), ('K2', -2)])
+        self.assertEqual(tappy.compound_components('M10'), [('M2', 5)])
+        self.assertEqual(tappy.compound_components('MK3'),
+                         [('M2', 1), ('K1', 1)])
+        u = tappy.Util(None, None)
+        u.ephemeris_backend = 'numpy'
+        u.dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(hours=i)
+                   for i in range(24*40)]
+        u.which_constituents(len(u.dates), u.astronomic(u.dates))
+        table = u.tidal_dict
+        # The same as the explicit M6 and the product of the components
+        self.assertTrue(np.allclose(table['3MS8']['FF'], table['M6']['FF']))
+        self.assertTrue(abs(table['3MS8']['VAU'] - table['M6']['VAU']) < 1e-6)
+        self.assertTrue(np.allclose(table['2MS2K2']['FF'],
+                                    table['M2']['FF']**2 *
+                                    table['K2']['FF']**2))
+        # MA2 is a satellite of M2
+        self.assertTrue(np.allclose(table['MA2']['FF'], table['M2']['FF']))
+        self.assertTrue(np.ptp(table['M10']['FF']) > 0)
+
+    def test_sum_signals(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        keys = ['M2', 'S2', 'K1', 'O1', 'M4']
+        u = tappy.Util(dict(zip(keys, [0.6, 0.1, 0.09, 0.06, 0.01])),
+                       dict(zip(keys, [22.0, 60.0, 100.0, 110.0, 250.0])))
+        u.ephemeris_backend = 'numpy'
+        u.dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(minutes=6*i)
+                   for i in range(24*10*60)]
+        u.which_constituents(len(u.dates), u.astronomic(u.dates))
+        hours = np.arange(len(u.dates)) * 0.1
+        expected = np.zeros(len(hours))
+        for key in keys:
+            entry = u.tidal_dict[key]
+            expected += u.r[key] * entry['FF'] * np.cos(
+                entry['speed'] * hours -
+                (u.phase[key] - entry['VAU']) * tappy.deg2rad)
+        total = u.sum_signals(keys, hours, u.tidal_dict)
+        self.assertTrue(np.allclose(total, expected, rtol=0, atol=1.0e-12))
+        out = np.empty(len(hours))
+        self.assertTrue(u.sum_signals(keys, hours, u.tidal_dict, out=out) is out)
+        self.assertTrue(np.all(out == total))
+        single = u.sum_signals(keys, hours, u.tidal_dict, dtype=np.float32)
+        self.assertEqual(single.dtype, np.float32)
+        self.assertTrue(np.allclose(single, expected, rtol=0, atol=1.0e-5))
+        recurrence = u.sum_signals(keys, hours, u.tidal_dict,
+                                   method='recurrence')
+        self.assertTrue(np.allclose(recurrence, expected, rtol=0, atol=1.0e-12))
+        constant = dict((key, dict(u.tidal_dict[key], FF=1.0)) for key in keys)
+        self.assertTrue(np.allclose(
+            u.sum_signals(keys, hours, constant, method='recurrence'),
+            u.sum_signals(keys, hours, constant), rtol=0, atol=1.0e-12))
+        # Hours that are not quite evenly spaced are summed at their own
+        # times.
+        random = np.random.RandomState(1)
+        jitter = np.cumsum(0.1 + 4.0e-7 * random.uniform(0, 1, len(hours)))
+        self.assertTrue(np.allclose(
+            u.sum_signals(keys, jitter, constant, method='recurrence'),
+            u.sum_signals(keys, jitter, constant), rtol=0, atol=1.0e-12))
+
+    def test_predict_iter(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        keys = ['M2', 'S2', 'K1', 'O1', 'Z0']
+        u = tappy.Util(dict(zip(keys, [0.6, 0.1, 0.09, 0.06, 0.5])),
+                       dict(zip(keys, [22.0, 60.0, 100.0, 110.0, 0.0])))
+        u.ephemeris_backend = 'numpy'
+        start = datetime.datetime(2000, 1, 1)
+        end = datetime.datetime(2000, 1, 11)
+        blocks = list(u.predict_iter(keys, start, end, 6, chunk=1000))
+        self.assertEqual([len(dates) for (dates, heights) in blocks],
+                         [1000, 1000, 401])
+        dates = np.concatenate([dates for (dates, heights) in blocks])
+        heights = np.concatenate([heights for (dates, heights) in blocks])
+        self.assertEqual(dates[0], start)
+        self.assertEqual(dates[-1], end)
+        (whole, ) = [heights for (dates, heights) in
+                     u.predict_iter(keys, start, end, 6, chunk=10000)]
+        u.dates = dates
+        u.tidal_dict = u.tidal_table(len(dates), u.astronomic(dates))
+        expected = 0.5 + u.sum_signals(keys[:-1], np.arange(len(dates)) * 0.1,
+                                       u.tidal_dict)
+        self.assertTrue(np.allclose(whole, expected, rtol=0, atol=1.0e-12))
+        # Each block has its own V + u, which moves slowly.
+        self.assertTrue(np.allclose(heights, whole, rtol=0, atol=1.0e-3))
+        parallel = list(u.predict_iter(keys, start, end, 6, chunk=1000,
+                                       workers=2))
+        self.assertEqual(len(parallel), len(blocks))
+        for (a, b) in zip(blocks, parallel):
+            self.assertEqual(list(a[0]), list(b[0]))
+            self.assertTrue(np.array_equal(a[1], b[1]))
+
+    def test_predict_iter_workers(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        keys = ['M2', 'S2', 'N2', 'K1', 'O1', 'M4', 'Z0']
+        u = tappy.Util(dict(zip(keys, [0.6, 0.1, 0.12, 0.09, 0.06, 0.02, 0.5])),
+                       dict(zip(keys, [22.0, 60.0, 5.0, 100.0, 110.0, 30.0, 0.0])))
+        u.ephemeris_backend = 'numpy'
+        u.node_interval = 24
+        start = datetime.datetime(2000, 1, 1)
+        end = datetime.datetime(2000, 3, 1)
+        for (dtype, method) in [(np.float64, 'direct'),
+                                (np.float32, 'recurrence')]:
+            serial = list(u.predict_iter(keys, start, end, 6, chunk=3000,
+                                         dtype=dtype, method=method,
+                                         workers=1))
+            parallel = list(u.predict_iter(keys, start, end, 6, chunk=3000,
+                                           dtype=dtype, method=method,
+                                           workers=2))
+            self.assertEqual(len(serial), 5)
+            self.assertEqual(len(parallel), len(serial))
+            for (a, b) in zip(serial, parallel):
+                self.assertTrue(np.array_equal(a[0], b[0]))
+                self.assertEqual(b[1].dtype, dtype)
+                self.assertTrue(np.array_equal(a[1], b[1]))
+
+    def test_time_grids(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        x = tappy.tappy(quiet=True, debug=False, outputts=False,
+                        outputxml=False, ephemeris=False, rayleigh=1.0,
+                        print_vau_table=False, missing_data='ignore',
+                        linear_trend=False, remove_extreme=False,
+                        zero_ts=None, filter=None, pad_filters=None,
+                        include_inferred=True)
+        x.r = {}
+        start = datetime.datetime(2000, 1, 1)
+        dates = np.array([start + datetime.timedelta(minutes=6 * i)
+                          for i in range(240) if not 50 <= i < 60])
+        elevation = np.cos(np.arange(len(dates)) / 10.0)
+        x.dates = dates
+        (filled, felevation) = x.missing('fill', dates, elevation)
+        self.assertEqual(filled.dtype, np.dtype('datetime64[s]'))
+        self.assertEqual(len(filled), 240)
+        self.assertEqual(filled[0], start)
+        self.assertEqual(filled[-1], dates[-1])
+        self.assertTrue(np.array_equal(np.isin(filled, dates.astype('datetime64[s]')),
+                                       [not 50 <= i < 60 for i in range(240)]))
+        (first, step, length) = tappy.time_grid(start, dates[-1], 6)
+        self.assertEqual(step, np.timedelta64(360, 's'))
+        self.assertEqual(length, 240)
+        self.assertTrue(np.array_equal(first + np.arange(length) * step, filled))
+        self.assertEqual(list(tappy.datetime_dates(filled)),
+                         [start + datetime.timedelta(minutes=6 * i)
+                          for i in range(240)])
+
+    def test_predict_stations(self):
+        import datetime
+        import tempfile
+        import numpy as np
+        from tappy import tappy
+        handle, filename = tempfile.mkstemp(suffix='.xml')
+        os.write(handle, b"""<Transfer><Port>
+<Harmonic><name>M2</name><inferred>false</inferred>
+<amplitude>0.6</amplitude><phaseAngle>22.0</phaseAngle></Harmonic>
+<Harmonic><name>K1</name><inferred>false</inferred>
+<amplitude>0.09</amplitude><phaseAngle>100.0</phaseAngle></Harmonic>
+<Harmonic><name>P1</name><inferred>true</inferred>
+<amplitude>0.03</amplitude><phaseAngle>98.0</phaseAngle></Harmonic>
+<Harmonic><name>Z0</name><inferred>false</inferred>
+<amplitude>0.5</amplitude><phaseAngle>0.0</phaseAngle></Harmonic>
+</Port></Transfer>""")
+        os.close(handle)
+        (r, phase, key_list) = tappy.read_constituents(filename)
+        os.remove(filename)
+        self.assertEqual(key_list, ['M2', 'K1', 'P1', 'Z0'])
+        self.assertEqual(r['K1'], 0.09)
+        self.assertEqual(phase['P1'], 98.0)
+        stations = [(r, phase),
+                    ({'M2': 0.4, 'S2': 0.1}, {'M2': 200.0, 'S2': 230.0})]
+        start = datetime.datetime(2000, 1, 1)
+        end = datetime.datetime(2000, 1, 6)
+        blocks = list(tappy.predict_stations(stations, start, end, 6,
+                                             chunk=500,
+                                             ephemeris_backend='numpy'))
+        self.assertEqual([heights.shape for (dates, heights) in blocks],
+                         [(2, 500), (2, 500), (2, 201)])
+        for row, (r, phase) in enumerate(stations):
+            u = tappy.Util(r, phase)
+            u.ephemeris_backend = 'numpy'
+            for (a, b) in zip(blocks, u.predict_iter(list(r), start, end, 6,
+                                                     chunk=500)):
+                self.assertEqual(list(a[0]), list(b[0]))
+                self.assertTrue(np.allclose(a[1][row], b[1], rtol=0,
+                                            atol=1.0e-12))
+
+    def test_extrema(self):
+        import datetime
+        import numpy as np
+        from tappy import tappy
+        keys = ['M2', 'S2', 'N2', 'K1', 'O1', 'M4', 'M6', 'Z0']
+        u = tappy.Util(dict(zip(keys, [0.6, 0.1, 0.12, 0.09, 0.06, 0.04, 0.01, 0.5])),
+                       dict(zip(keys, [22.0, 60.0, 5.0, 100.0, 110.0, 30.0, 200.0, 0.0])))
+        u.ephemeris_backend = 'numpy'
+        start = datetime.datetime(2000, 1, 1)
+        end = datetime.datetime(2000, 1, 11)
+        (dates, heights, highs) = u.extrema(keys, start, end)
+        self.assertEqual(dates.dtype, np.dtype('datetime64[s]'))
+        # Every minute.
+        ((mdates, mheights), ) = list(u.predict_iter(keys, start, end, 1,
+                                                      chunk=100000))
+        rising = np.diff(mheights) > 0
+        turn = np.flatnonzero(rising[:-1] != rising[1:]) + 1
+        self.assertEqual(len(turn), len(dates))
+        self.assertTrue(np.array_equal(rising[turn - 1], highs))
+        self.assertTrue(np.all(np.abs(mdates[turn] - dates) <= np.timedelta64(30, 's')))
+        self.assertTrue(np.allclose(mheights[turn], heights, rtol=0,
+                                    atol=1.0e-4))
+        # The same in blocks and for many stations at once.
+        stations = [({'M2': 0.4, 'S2': 0.1}, {'M2': 200.0, 'S2': 230.0}),
+                    (u.r, u.phase)]
+        (other, same) = tappy.predict_extrema(stations, start, end, chunk=50,
+                                              ephemeris_backend='numpy')
+        # Each block has its own V + u.
+        self.assertTrue(np.all(np.abs(same[0] - dates) <= np.timedelta64(5, 's')))
+        self.assertTrue(np.allclose(same[1], heights, rtol=0, atol=1.0e-3))
+        self.assertTrue(np.array_equal(same[2], highs))
+        u = tappy.Util(*stations[0])
+        u.ephemeris_backend = 'numpy'
+        (dates, heights, highs) = u.extrema(['M2', 'S2'], start, end)
+        self.assertTrue(np.all(np.abs(other[0] - dates) <= np.timedelta64(1, 's')))
+        self.assertTrue(np.array_equal(other[2], highs))
+
+    def test_linear_solver(self):
+        import numpy as np
+        (dates, elevation) = synthetic_record(tide_r, tide_phase, 30,
+                                              noise=0.01)
+        fits = dict(((solver, include_inferred),
+                     analysis(dates, elevation, solver=solver,
+                              include_inferred=include_inferred))
+                    for solver in ['nonlinear', 'linear']
+                    for include_inferred in [False, True])
+        # Without inferred constituents both fit the same model.
+        (a, b) = (fits['nonlinear', False], fits['linear', False])
+        self.assertEqual(a.key_list, b.key_list)
+        self.assertEqual(b.inferred_key_list, [])
+        for key in a.r:
+            self.assertAlmostEqual(a.r[key], b.r[key], places=6)
+            difference = np.mod(a.phase[key] - b.phase[key] + 180, 360) - 180
+            self.assertAlmostEqual(difference, 0.0, places=4)
+        # The linear solver calculates the inferred constituents from the
+        # same fit, where the nonlinear solver fits them too.
+        (c, d) = (fits['nonlinear', True], fits['linear', True])
+        self.assertEqual(c.inferred_key_list, d.inferred_key_list)
+        self.assertTrue(d.inferred_key_list)
+        for key in b.r:
+            self.assertEqual(b.r[key], d.r[key])
+            self.assertEqual(b.phase[key], d.phase[key])
+        self.assertTrue(max(abs(c.r[key] - d.r[key]) for key in c.r) <
+                        max(c.inferred_r.values()))
+
+    def test_TAPPY(self):
+        import numpy as np
+        from tappy import tappy
+        (dates, elevation) = synthetic_record(tide_r, tide_phase, 30,
+                                              noise=0.01)
+        data = np.column_stack([
+            [[d.year, d.month, d.day, d.hour, d.minute, d.second]
+             for d in dates.astype(object)], elevation])
+        (name, speed, phase, amplitude, inferred) = tappy.TAPPY(
+            data, solver='linear')
+        x = analysis(dates, elevation, solver='linear',
+                     ephemeris_backend='astronomia')
+        self.assertEqual(sorted(name),
+                         sorted(x.key_list + x.inferred_key_list))
+        self.assertEqual(inferred.count(True), len(x.inferred_key_list))
+        for (key, r, p) in zip(name, amplitude, phase):
+            if key in x.r:
+                self.assertAlmostEqual(r, x.r[key], places=10)
+                self.assertAlmostEqual(p, x.phase[key], places=8)
+        self.assertAlmostEqual(amplitude[name.index('M2')], tide_r['M2'],
+                               places=2)
+
+    def test_inference_matrix(self):
+        import numpy as np
+        from tappy import tappy
+        (dates, elevation) = synthetic_record(tide_r, tide_phase, 30)
+        x = new_tappy(ephemeris_backend='numpy')
+        x.dates = dates
+        x.elevation = elevation
+        x.prepare()
+        t = (x.jd - x.jd[0]) * 24
+        nkeys = len(x.key_list)
+        p = np.random.RandomState(1).uniform(-1.0, 7.0, 2 * nkeys + 2)
+        # One constituent at a time from inference_table, as residuals
+        # used to.
+        H = dict(zip(x.key_list, p[:nkeys]))
+        phase = dict(zip(x.key_list, p[nkeys:2 * nkeys]))
+        inferred = []
+        for (key, ref, ratio, pa, pb, k) in tappy.inference_table:
+            if pa not in x.key_list or pb not in x.key_list or key in x.key_list:
+                continue
+            inferred.append(key)
+            H[key] = ratio * H[ref]
+            phase[key] = phase[pa] + k * (phase[pa] - phase[pb])
+        self.assertTrue(inferred)
+        x.infer(dict(zip(x.key_list, p[:nkeys])),
+                dict(zip(x.key_list, p[nkeys:2 * nkeys])), x.key_list)
+        self.assertEqual(x.inferred_key_list, inferred)
+        for key in inferred:
+            r = abs(H[key])
+            ph = np.mod(phase[key] + 180.0 * (H[key] < 0) +
+                        x.tidal_dict[key]['VAU'], 360)
+            self.assertAlmostEqual(x.inferred_r[key], r, places=12)
+            self.assertAlmostEqual(x.inferred_phase[key], ph, places=9)
+        sumterm = np.zeros(len(t))
+        for key in x.key_list + inferred:
+            sumterm = sumterm + H[key] * np.squeeze(x.tidal_dict[key]['FF']) * np.cos(x.tidal_dict[key]['speed'] * t - phase[key])
+        x.compile_fit(t, x.key_list)
+        self.assertTrue(np.allclose(x.residuals(p, elevation, t, x.key_list),
+                                    elevation - (p[-1] + sumterm),
+                                    rtol=0, atol=1.0e-10))
+
+    def test_jacobian(self):
+        import numpy as np
+        from scipy.optimize import leastsq
+        (dates, elevation) = synthetic_record(tide_r, tide_phase, 30,
+                                              noise=0.01)
+        x = new_tappy(ephemeris_backend='numpy', linear_trend=True)
+        x.dates = dates
+        x.elevation = elevation
+        x.prepare()
+        t = (x.jd - x.jd[0]) * 24
+        x.compile_fit(t, x.key_list)
+        self.assertTrue(len(x.fit[0]) > len(x.key_list))
+        nkeys = len(x.key_list)
+        p = np.random.RandomState(1).uniform(0.1, 1.0, 2 * nkeys + 2)
+        args = (elevation, t, x.key_list)
+        jac = x.jacobian(p, *args)
+        self.assertEqual(jac.shape, (len(p), len(t)))
+        step = 1.0e-6
+        for i in range(len(p)):
+            dp = np.zeros(len(p))
+            dp[i] = step
+            central = (x.residuals(p + dp, *args) -
+                       x.residuals(p - dp, *args)) / (2 * step)
+            self.assertTrue(np.allclose(jac[i], central, rtol=0,
+                                        atol=1.0e-6 * (1 + np.abs(t).max())))
+        # The fit is the same as with leastsq's own finite differences.  The
+        # phases of the smallest constituents can end up a multiple of pi
+        # apart, so compare the fitted series.
+        p0 = [1.0] * (2 * nkeys + 2)
+        p0[-2] = 0.0
+        p0[-1] = np.average(elevation)
+        analytic = leastsq(x.residuals, p0, args=args, Dfun=x.jacobian,
+                           col_deriv=1)[0]
+        numeric = leastsq(x.residuals, p0, args=args)[0]
+        self.assertTrue(np.allclose(x.residuals(analytic, *args),
+                                    x.residuals(numeric, *args),
+                                    rtol=0, atol=1.0e-5))
+        for key in ['M2', 'S2', 'N2', 'K1', 'O1']:
+            i = x.key_list.index(key)
+            self.assertAlmostEqual(analytic[i], numeric[i], places=6)
+            self.assertAlmostEqual(analytic[i + nkeys], numeric[i + nkeys],
+                                   places=5)
+
+    def test_batch_constituents(self):
+        import numpy as np
+        other_r = dict((key, 0.5 * value) for key, value in tide_r.items())
+        other_phase = dict((key, value + 40.0)
+                           for key, value in tide_phase.items())
+        records = [synthetic_record(tide_r, tide_phase, 30, noise=0.01),
+                   synthetic_record(other_r, other_phase, 30, noise=0.02)]
+        dates = records[0][0]
+        elevation = np.column_stack([e for (d, e) in records])
+        x = new_tappy(ephemeris_backend='numpy', solver='linear')
+        x.dates = dates
+        x.elevation = elevation[:, 0]
+        x.prepare()
+        (r, phase) = x.batch_constituents(elevation)
+        for column, (d, e) in enumerate(records):
+            y = analysis(dates, e, solver='linear')
+            self.assertEqual(sorted(r), sorted(y.r))
+            for key in y.r:
+                self.assertAlmostEqual(r[key][column], y.r[key], places=10)
+                self.assertAlmostEqual(phase[key][column], y.phase[key],
+                                       places=7)
+            for key in y.inferred_r:
+                self.assertAlmostEqual(x.inferred_r[key][column],
+                                       y.inferred_r[key], places=10)
+                self.assertAlmostEqual(x.inferred_phase[key][column],
+                                       y.inferred_phase[key], places=7)
+            self.assertAlmostEqual(x.fitted_average[column],
+                                   y.fitted_average, places=10)
+
+    def test_read_stations(self):
+        import tempfile
+        from tappy import tappy
+        directory = tempfile.mkdtemp()
+        pattern = os.path.join(directory, '*.xml')
+        with self.assertRaises(SystemExit) as context:
+            tappy.read_stations(pattern)
+        self.assertEqual(context.exception.code, 1)
+        os.rmdir(directory)
+
+    def test_online_update(self):
+        import numpy as np
+        (dates, elevation) = synthetic_record(tide_r, tide_phase, 40,
+                                              noise=0.01)
+        split = 24 * 30
+        x = new_tappy(ephemeris_backend='numpy', solver='linear')
+        x.dates = dates[:split]
+        x.elevation = elevation[:split]
+        x.prepare()
+        x.online_start()
+        for start in range(split, len(dates), 50):
+            x.online_update(dates[start:start + 50],
+                            elevation[start:start + 50])
+        # The batch solution for all of the dates and the same
+        # constituents.
+        y = new_tappy(ephemeris_backend='numpy', solver='linear')
+        y.dates = dates
+        y.elevation = elevation
+        y.prepare()
+        self.assertTrue(set(x.key_list) <= set(y.key_list))
+        y.key_list = list(x.key_list)
+        y.ntimes = (y.jd - y.jd[0]) * 24
+        y.linear_constituents(y.linear_leastsq(elevation, y.ntimes,
+                                               y.key_list))
+        for key in x.key_list:
+            self.assertAlmostEqual(x.r[key], y.r[key], places=8)
+            difference = np.mod(x.phase[key] - y.phase[key] + 180, 360) - 180
+            self.assertAlmostEqual(difference, 0.0, places=6)
+        self.assertAlmostEqual(x.fitted_average, y.fitted_average, places=8)
+
+    def test_parallel_constituents(self):
+        import numpy as np
+        from tappy import tappy
+        records = [synthetic_record(dict((key, scale * value)
+                                         for key, value in tide_r.items()),
+                                    tide_phase, 30, noise=0.01)
+                   for scale in [1.0, 0.5, 2.0]]
+        dates = records[0][0]
+        elevation = np.column_stack([e for (d, e) in records])
+        # Fewer workers than stations, so a worker analyzes more than one.
+        results = tappy.parallel_constituents(dates, elevation, workers=2,
+                                              ephemeris_backend='numpy')
+        self.assertEqual(len(results), len(records))
+        for (result, (d, e)) in zip(results, records):
+            x = analysis(dates, e)
+            (r, phase, inferred_r, inferred_phase, average, slope) = result
+            self.assertEqual(sorted(r), sorted(x.r))
+            self.assertEqual(sorted(inferred_r), sorted(x.inferred_r))
+            for key in x.r:
+                self.assertAlmostEqual(r[key], x.r[key], places=8)
+                self.assertAlmostEqual(phase[key], x.phase[key], places=6)
+            for key in x.inferred_r:
+                self.assertAlmostEqual(inferred_r[key], x.inferred_r[key],
+                                       places=8)
+            self.assertAlmostEqual(average, x.fitted_average, places=10)
+
+    def test_mstha_filter(self):
+        import numpy as np
+        keys = ['M2', 'K1', 'M4', 'Z0']
+        (dates, elevation) = synthetic_record(
+            dict((key, tide_r[key]) for key in keys),
+            dict((key, tide_phase[key]) for key in keys), 30)
+        hours = np.arange(len(dates), dtype='f8')
+        surge = 0.2 * np.sin(2 * np.pi * hours / 240.0)
+        x = analysis(dates, elevation + surge)
+        (fdates, filtered) = x.filters('mstha', dates, elevation + surge)
+        # The same shape as the other filters, a series that follows the
+        # non-tidal part of the record.
+        self.assertEqual(len(fdates), len(filtered))
+        self.assertEqual(filtered.shape, (len(dates), ))
+        (bdates, boxcar) = x.filters('boxcar', dates, elevation + surge)
+        self.assertEqual(np.ndim(boxcar), 1)
+        inside = slice(24, -24)
+        self.assertTrue(np.all(np.abs(filtered - 0.5 - surge)[inside] < 0.01))
+
+    def test_mstha(self):
+        import numpy as np
+        keys = ['M2', 'K1', 'M4', 'Z0']
+        (dates, elevation) = synthetic_record(
+            dict((key, tide_r[key]) for key in keys),
+            dict((key, tide_phase[key]) for key in keys), 30)
+        hours = np.arange(len(dates), dtype='f8')
+        trend = 0.002 * hours
+        x = analysis(dates, elevation)
+        (mdates, average, slope, r, phase) = x.mstha(dates, elevation + trend)
+        self.assertTrue(np.array_equal(mdates, dates))
+        for series in [average, slope] + list(r.values()) + list(phase.values()):
+            self.assertEqual(series.shape, (len(dates), ))
+        inside = slice(24, -24)
+        self.assertTrue(np.all(np.abs(slope - 0.002)[inside] < 1.0e-5))
+        self.assertTrue(np.all(np.abs(average - 0.5 - trend)[inside] < 1.0e-4))
+        self.assertTrue(np.all(np.abs(r['M2'] - tide_r['M2'])[inside] < 0.02))
+        self.assertTrue(np.all(r['M3'][inside] < 1.0e-4))
+        # The filter is the fitted average.
+        (fdates, filtered) = x.filters('mstha', dates, elevation + trend)
+        self.assertTrue(np.array_equal(filtered, average))
+
+    def test_streaming_constituents(self):
+        import numpy as np
+        from tappy import tappy
+        data = os.path.join(tappy_loc, 'example',
+                            'mayport_florida_8720220_data.txt')
+        definition = os.path.join(tappy_loc, 'example',
+                                  'mayport_florida_8720220_data_def.txt')
+        x = new_tappy(solver='linear', ephemeris_backend='numpy')
+        x.open(data, definition)
+        x.prepare()
+        x.constituents()
+        # 743 records, the last chunk has 43.
+        y = new_tappy(solver='linear', ephemeris_backend='numpy')
+        chunks = list(y.open_chunks(data, definition, chunk=100))
+        self.assertEqual([len(dates) for (dates, elevation) in chunks],
+                         [100] * 7 + [43])
+        self.assertTrue(np.array_equal(
+            np.concatenate([dates for (dates, elevation) in chunks]), x.dates))
+        y.streaming_constituents(chunks, x.dates[0], x.dates[-1])
+        self.assertEqual(y.key_list, x.key_list)
+        self.assertEqual(y.inferred_key_list, x.inferred_key_list)
+        for key in x.key_list:
+            self.assertAlmostEqual(x.r[key], y.r[key], places=8)
+            self.assertAlmostEqual(x.phase[key], y.phase[key], places=6)
+        self.assertAlmostEqual(x.fitted_average, y.fitted_average, places=8)
+        # The 'auto' selection takes the Nyquist frequency from the
+        # sampling interval, not from the start and end dates.
+        x = new_tappy(solver='linear', ephemeris_backend='numpy',
+                      selection='auto')
+        x.open(data, definition)
+        x.prepare()
+        x.constituents()
+        y = new_tappy(solver='linear', ephemeris_backend='numpy',
+                      selection='auto')
+        with self.assertRaises(SystemExit):
+            y.streaming_constituents(chunks, x.dates[0], x.dates[-1])
+        y.streaming_constituents(chunks, x.dates[0], x.dates[-1],
+                                 interval=60)
+        self.assertTrue(len(x.key_list) > 20)
+        self.assertEqual(y.key_list, x.key_list)
+        for key in x.key_list:
+            self.assertAlmostEqual(x.r[key], y.r[key], places=8)
+        # The normal equations of the rows in blocks are those of all of
+        # them.
+        X = np.random.RandomState(1).standard_normal((250, 5))
+        y = np.dot(X, np.arange(5.0)) + np.random.RandomState(2).standard_normal(250)
+        normal = tappy.NormalEquations(5)
+        for start in range(0, 250, 100):
+            normal.add(X[start:start + 100], y[start:start + 100])
+        self.assertEqual(normal.count, 250)
+        self.assertTrue(np.allclose(normal.solve(),
+                                    np.linalg.lstsq(X, y, rcond=None)[0],
+                                    rtol=0, atol=1.0e-12))
+
+    def test_import(self):
+        sys.path.insert(0, cur_path)
+        from benchmark_import import import_time, analysis
+        (seconds, imported, used) = import_time(analysis)
+        self.assertEqual(imported, [])
+        for name in ['scipy.optimize', 'astronomia', 'tappy_lib.sparser']:
+            self.assertTrue(name in used)
+
+
 if __name__ == '__main__':
     unittest.main()
 